@@ -69,6 +69,9 @@ class BooleanIndex(UnIndex):
     _index_value = 1
     _index_length = None
 
+    # the forward index only holds the documents of one value
+    itemsFrom = None
+
     def clear(self):
         self._index = IITreeSet()
         self._index_length = BTrees.Length.Length()
@@ -228,6 +231,13 @@ class BooleanIndex(UnIndex):
                                         self._unindex)
         return IISet()
 
+    def documentCount(self, value):
+        """Return the number of documents indexed under value."""
+        ilen = len(self._index)
+        if bool(value) is bool(self._index_value):
+            return ilen
+        return len(self._unindex) - ilen
+
     def indexSize(self):
         """Return distinct values, as an optimization we always claim 2."""
         return 2
@@ -152,6 +152,14 @@ class TestBooleanIndex(unittest.TestCase):
         res, idx = index._apply_index({'truth': False})
         self.assertEqual(list(res), list(range(80, 100)))
 
+    def test_documentCount(self):
+        index = self._makeOne()
+        for i in range(0, 100):
+            obj = Dummy(i, i < 80 and True or False)
+            index._index_object(obj.id, obj, attr='truth')
+        self.assertEqual(index.documentCount(True), 80)
+        self.assertEqual(index.documentCount(False), 20)
+
     def test_index_many_false(self):
         index = self._makeOne()
         for i in range(0, 100):
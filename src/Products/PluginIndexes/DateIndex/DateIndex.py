@@ -92,6 +92,9 @@ class DateIndex(UnIndex, PropertyManager):
                     'type': 'boolean',
                     'mode': 'w'},
                    {'id': 'precision',
+                    'type': 'int',
+                    'mode': 'w'},
+                   {'id': 'range_bucket_size',
                     'type': 'int',
                     'mode': 'w'},)
 
@@ -108,11 +111,20 @@ class DateIndex(UnIndex, PropertyManager):
         self._index = IOBTree()
         self._unindex = IIBTree()
         self._length = Length()
+        self._clear_range_index()
+        self._clear_value_counts()
         if self._counter is None:
             self._counter = Length()
         else:
             self._increment_counter()
 
+    def _updateProperty(self, id, value):
+        PropertyManager._updateProperty(self, id, value)
+        if id == 'range_bucket_size':
+            # e.g. 1440 keeps pre-unioned sets per day, 16 days, 256 days
+            # and 4096 days
+            self.setRangeBuckets(self.range_bucket_size)
+
     def _convert(self, value, default=None):
         """Convert Date/Time value to our internal representation"""
         if isinstance(value, DateTime):
@@ -356,6 +356,28 @@ class DateIndexTests(unittest.TestCase):
         index.clear()
         self.assertEqual(index.getCounter(), 3)
 
+    def test_range_buckets(self):
+        from DateTime import DateTime
+        index = self._makeOne()
+        index.manage_changeProperties(range_bucket_size=1440)
+        self.assertIsNotNone(index._range_index)
+        self._populateIndex(index)
+        values = self._getValues()
+        self._checkApply(index,
+                         {'date': {'query': DateTime('2032-05-08 15:16:17'),
+                                   'range': 'min'}},
+                         values[3:6] + values[8:])
+        self._checkApply(index,
+                         {'date': {'query': (DateTime(0),
+                                             DateTime('2034-01-01')),
+                                   'range': 'min:max'}},
+                         values[1:4] + values[6:8])
+        index.unindex_object(3)
+        self._checkApply(index,
+                         {'date': {'query': DateTime('2032-05-08 15:16:17'),
+                                   'range': 'min'}},
+                         values[4:6] + values[8:])
+
     def test_precision(self):
         from DateTime import DateTime
         precision = 5
@@ -17,6 +17,7 @@ from AccessControl.class_init import InitializeClass
 from AccessControl.Permissions import manage_zcatalog_indexes
 from AccessControl.Permissions import view
 from AccessControl.SecurityInfo import ClassSecurityInfo
+from Acquisition import aq_base
 from App.Common import package_home
 from App.special_dtml import DTMLFile
 from BTrees.IIBTree import IITreeSet
@@ -58,12 +59,22 @@ class DateRangeIndex(UnIndex):
       start date);
 
     - Objects which match only during a specific interval.
+
+    Optionally (`use_interval_tree`), documents with at least one boundary
+    are also kept in a segment tree over the minutes between `floor_value`
+    and `ceiling_value`.  Each interval is stored in the O(log n) aligned
+    power-of-two spans covering it, so a point query unions one set per
+    level instead of whole ranges of boundary values.
+
+    Besides point queries the index answers interval-overlap queries:
+    `{'query': (a, b), 'range': 'min:max'}` finds documents whose range
+    intersects [a, b], 'min' and 'max' alone leave the interval open.
     """
 
     security = ClassSecurityInfo()
 
     meta_type = 'DateRangeIndex'
-    query_options = ('query', )
+    query_options = ('query', 'range')
 
     manage_options = ({'label': 'Properties',
                        'action': 'manage_indexProperties'},
@@ -77,10 +88,14 @@ class DateRangeIndex(UnIndex):
     ceiling_value = 278751600
     # precision of indexed time interval in minutes
     precision_value = 1
+    # keep a segment tree for point queries
+    use_interval_tree = False
+    _segments = None
 
     def __init__(self, id, since_field=None, until_field=None,
                  caller=None, extra=None, floor_value=None,
-                 ceiling_value=None, precision_value=None):
+                 ceiling_value=None, precision_value=None,
+                 use_interval_tree=None):
 
         if extra:
             since_field = extra.since_field
@@ -88,10 +103,13 @@ class DateRangeIndex(UnIndex):
             floor_value = getattr(extra, 'floor_value', None)
             ceiling_value = getattr(extra, 'ceiling_value', None)
             precision_value = getattr(extra, 'precision_value', None)
+            use_interval_tree = getattr(extra, 'use_interval_tree', None)
 
         self._setId(id)
         self._edit(since_field, until_field, floor_value,
                    ceiling_value, precision_value)
+        if use_interval_tree:
+            self.use_interval_tree = True
         self.clear()
 
     @security.protected(view)
@@ -121,14 +139,21 @@ class DateRangeIndex(UnIndex):
         """ """
         return self.precision_value
 
+    @security.protected(view)
+    def getUseIntervalTree(self):
+        """ """
+        return self.use_interval_tree
+
     manage_indexProperties = DTMLFile('manageDateRangeIndex', _dtmldir)
 
     @security.protected(manage_zcatalog_indexes)
     def manage_edit(self, since_field, until_field, floor_value,
-                    ceiling_value, precision_value, REQUEST):
+                    ceiling_value, precision_value, REQUEST,
+                    use_interval_tree=False):
         """ """
         self._edit(since_field, until_field, floor_value, ceiling_value,
                    precision_value)
+        self.setUseIntervalTree(use_interval_tree)
         REQUEST['RESPONSE'].redirect('{}/manage_main'
                                      '?manage_tabs_message=Updated'.format(
                                          REQUEST.get('URL2')))
@@ -138,6 +163,7 @@ class DateRangeIndex(UnIndex):
               ceiling_value=None, precision_value=None):
         """Update the fields used to compute the range.
         """
+        bounds = (self.floor_value, self.ceiling_value)
         self._since_field = since_field
         self._until_field = until_field
         if floor_value not in (None, ''):
@@ -146,6 +172,28 @@ class DateRangeIndex(UnIndex):
             self.ceiling_value = int(ceiling_value)
         if precision_value not in (None, ''):
             self.precision_value = int(precision_value)
+        if self._segments is not None and \
+                bounds != (self.floor_value, self.ceiling_value):
+            # the segment tree is laid out from the floor to the ceiling
+            self._build_segments()
+
+    @security.protected(manage_zcatalog_indexes)
+    def setUseIntervalTree(self, flag):
+        """Enable or disable the segment tree, (re)building it from the
+        indexed data as needed.
+        """
+        flag = bool(flag)
+        if flag == bool(self.use_interval_tree):
+            return
+        self.use_interval_tree = flag
+        self._segments = None
+        if flag:
+            self._build_segments()
+
+    def _build_segments(self):
+        self._segments = IOBTree()
+        for documentId, (since, until) in self._unindex.items():
+            self._segment_insert(since, until, documentId)
 
     @security.protected(manage_zcatalog_indexes)
     def clear(self):
@@ -156,6 +204,7 @@ class DateRangeIndex(UnIndex):
         self._since = IOBTree()
         self._until = IOBTree()
         self._unindex = IOBTree()  # 'datum' will be a tuple of date ints
+        self._segments = IOBTree() if self.use_interval_tree else None
         self._length = Length()
         if self._counter is None:
             self._counter = Length()
@@ -245,20 +294,38 @@ class DateRangeIndex(UnIndex):
                         yield (key, len(value))
 
     def getRequestCacheKey(self, record, resultset=None):
-        term = self._convertDateTime(record.keys[0])
-        tid = str(term)
-
         # unique index identifier
         iid = '_{}_{}_{}'.format(self.__class__.__name__,
                                  self.id, self.getCounter())
+
         # record identifier
-        if resultset is None:
-            rid = f'_{tid}'
+        if record.get('range', None):
+            lo, hi = self._range_terms(record)
+            rid = f'_range_{lo}_{hi}'
         else:
-            rid = f'_inverse_{tid}'
+            term = self._convertDateTime(record.keys[0])
+            tid = str(term)
+            if resultset is None or self._segments is not None:
+                rid = f'_{tid}'
+            else:
+                rid = f'_inverse_{tid}'
 
         return (iid, rid)
 
+    def _range_terms(self, record):
+        # Return the bounds of an overlap query in minutes, None if open.
+        # Unlike indexed values, bounds outside floor and ceiling are kept.
+        range_parm = record.get('range', '')
+        keys = [datetime_to_minutes(k, self.precision_value)
+                for k in record.keys]
+        keys = [k for k in keys if k is not None]
+        lo = hi = None
+        if keys and 'min' in range_parm:
+            lo = min(keys)
+        if keys and 'max' in range_parm:
+            hi = max(keys)
+        return lo, hi
+
     def _apply_index(self, request, resultset=None):
         record = IndexQuery(request, self.id, self.query_options,
                             self.operators, self.useOperator)
@@ -267,7 +334,14 @@ class DateRangeIndex(UnIndex):
         return (self.query_index(record, resultset=resultset),
                 (self._since_field, self._until_field))
 
+    def query_count(self, record):
+        # there's no per-value document set to take the count from
+        return None
+
     def query_index(self, record, resultset=None):
+        overlap = bool(record.get('range', None))
+        direct = (resultset is None or overlap or
+                  self._segments is not None)
         cache = self.getRequestCache()
         if cache is not None:
             cachekey = self.getRequestCacheKey(record, resultset)
@@ -275,26 +349,26 @@ class DateRangeIndex(UnIndex):
             if cached is not None:
                 if resultset is None:
                     return cached
+                elif direct:
+                    return intersection(resultset, cached)
                 else:
                     return difference(resultset, cached)
 
+        if overlap:
+            result = self._overlap_result(*self._range_terms(record))
+            if cache is not None:
+                cache[cachekey] = result
+            return intersection(resultset, result)
+
         term = self._convertDateTime(record.keys[0])
-        if resultset is None:
-            # Aggregate sets for each bucket separately, to avoid
-            # large-small union penalties.
-            until_only = multiunion(self._until_only.values(term))
-            since_only = multiunion(self._since_only.values(None, term))
-            until = multiunion(self._until.values(term))
-            since = multiunion(self._since.values(None, term))
-            bounded = intersection(until, since)
-
-            # Merge from smallest to largest.
-            result = multiunion([bounded, until_only, since_only,
-                                 self._always])
+        if direct:
+            result = self._window_result(term)
+            if result is None:
+                result = self._full_result(term)
             if cache is not None:
                 cache[cachekey] = result
 
-            return result
+            return intersection(resultset, result)
         else:
             # Compute the inverse and subtract from res
             until_only = multiunion(self._until_only.values(None, term - 1))
@@ -308,6 +382,145 @@ class DateRangeIndex(UnIndex):
 
             return difference(resultset, result)
 
+    def _overlap_result(self, lo, hi):
+        # Indexed values outside floor and ceiling are open ended, a query
+        # beyond them only matches the intervals open towards it.
+        if hi is not None and hi < self.floor_value:
+            return multiunion(
+                [multiunion(self._until_only.values()), self._always])
+        if lo is not None and lo > self.ceiling_value:
+            return multiunion(
+                [multiunion(self._since_only.values()), self._always])
+
+        # an interval overlaps [lo, hi] if it contains lo or starts
+        # within (lo, hi]
+        lo = self.floor_value if lo is None else max(lo, self.floor_value)
+        hi = self.ceiling_value if hi is None else \
+            min(hi, self.ceiling_value)
+        result = self._full_result(lo)
+        if lo < hi:
+            result = multiunion(
+                [result,
+                 multiunion(self._since_only.values(lo + 1, hi)),
+                 multiunion(self._since.values(lo + 1, hi))])
+        return result
+
+    def _full_result(self, term):
+        if self._segments is not None and term is not None:
+            return self._segment_result(term)
+
+        # Aggregate sets for each bucket separately, to avoid
+        # large-small union penalties.
+        until_only = multiunion(self._until_only.values(term))
+        since_only = multiunion(self._since_only.values(None, term))
+        until = multiunion(self._until.values(term))
+        since = multiunion(self._since.values(None, term))
+        bounded = intersection(until, since)
+
+        # Merge from smallest to largest.
+        return multiunion([bounded, until_only, since_only, self._always])
+
+    def _window_result(self, term):
+        """Return the result for 'term' from the volatile window cache.
+
+        The window keeps the result of the last term queried on this
+        connection across requests.  It is dropped whenever the index
+        counter changes and moved incrementally when the term changes,
+        which is the common case of querying for "now" rounded to the
+        precision of the index.
+        """
+        if term is None:
+            return None
+
+        counter = self.getCounter()
+        window = getattr(aq_base(self), '_v_window', None)
+        if window is None or window[0] != counter:
+            result = self._full_result(term)
+        else:
+            old_term, result = window[1], window[2]
+            if term == old_term:
+                return result
+            result = self._move_window(result, old_term, term)
+
+        self._v_window = (counter, term, result)
+        return result
+
+    def _move_window(self, result, old_term, term):
+        # Moving forward, documents whose start falls into (old, new] enter
+        # and documents whose end falls into [old, new) leave; moving
+        # backwards it's the other way around.  A document entering and
+        # leaving within the step is part of both sets and thus removed.
+        if term > old_term:
+            lo, hi = old_term + 1, term
+            entering = multiunion(
+                [multiunion(self._since_only.values(lo, hi)),
+                 multiunion(self._since.values(lo, hi))])
+            lo, hi = old_term, term - 1
+            leaving = multiunion(
+                [multiunion(self._until_only.values(lo, hi)),
+                 multiunion(self._until.values(lo, hi))])
+        else:
+            lo, hi = term, old_term - 1
+            entering = multiunion(
+                [multiunion(self._until_only.values(lo, hi)),
+                 multiunion(self._until.values(lo, hi))])
+            lo, hi = term + 1, old_term
+            leaving = multiunion(
+                [multiunion(self._since_only.values(lo, hi)),
+                 multiunion(self._since.values(lo, hi))])
+
+        return difference(multiunion([result, entering]), leaving)
+
+    def _segment_nodes(self, since, until):
+        """Yield the (level, node) pairs of the aligned spans covering the
+        interval, in minutes above `floor_value`.
+        """
+        lo = 0 if since is None else since - self.floor_value
+        hi = (self.ceiling_value if until is None else until) \
+            - self.floor_value
+        level = 0
+        while lo <= hi:
+            if lo & 1:
+                yield level, lo
+                lo += 1
+            if not hi & 1:
+                yield level, hi
+                hi -= 1
+            lo >>= 1
+            hi >>= 1
+            level += 1
+
+    def _segment_insert(self, since, until, documentId):
+        if since is None and until is None:
+            # kept in _always
+            return
+        segments = self._segments
+        for level, node in self._segment_nodes(since, until):
+            nodes = segments.get(level, None)
+            if nodes is None:
+                nodes = segments[level] = IOBTree()
+            self._insert_migrate(nodes, node, documentId)
+
+    def _segment_remove(self, since, until, documentId):
+        if since is None and until is None:
+            return
+        segments = self._segments
+        for level, node in self._segment_nodes(since, until):
+            nodes = segments.get(level, None)
+            if nodes is not None:
+                self._remove_delete(nodes, node, documentId)
+
+    def _segment_result(self, term):
+        # the intervals containing term are stored in exactly one node per
+        # level, the one on the path from the leaf of term to the root
+        key = term - self.floor_value
+        setlist = [self._always]
+        for level, nodes in self._segments.items():
+            row = nodes.get(key >> level, None)
+            if row is not None:
+                setlist.append(row)
+        return multiunion(setlist)
+
     def _insert_migrate(self, tree, key, value):
         treeset = tree.get(key, None)
         if treeset is None:
@@ -334,6 +547,9 @@ class DateRangeIndex(UnIndex):
             self._insert_migrate(self._since, since, documentId)
             self._insert_migrate(self._until, until, documentId)
 
+        if self._segments is not None:
+            self._segment_insert(since, until, documentId)
+
     def _remove_delete(self, tree, key, value):
         treeset = tree.get(key, None)
         if treeset is not None:
@@ -357,6 +573,9 @@ class DateRangeIndex(UnIndex):
             self._remove_delete(self._since, since, documentId)
             self._remove_delete(self._until, until, documentId)
 
+        if self._segments is not None:
+            self._segment_remove(since, until, documentId)
+
     def _convertDateTime(self, value):
         value = datetime_to_minutes(value, self.precision_value)
 
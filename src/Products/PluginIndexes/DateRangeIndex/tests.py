@@ -299,6 +299,119 @@ class DateRangeIndexTests(unittest.TestCase):
                          matchingDummiesByUIDs([0, 5]),
                          resultset=IISet([0, 5, 7]))
 
+    def test_window(self):
+        index = self._makeOne('work', 'start', 'stop')
+        for i, dummy in dummies:
+            index.index_object(i, dummy)
+
+        terms = list(range(-1, 15)) + list(range(14, -2, -3)) + [20, 3]
+        for value in terms:
+            matches = matchingDummiesByTimeValue(value)
+            self._checkApply(index, {'work': value}, matches)
+            counter, term, result = index._v_window
+            self.assertEqual(term, value)
+            self.assertEqual(list(result), [i for i, dummy in matches])
+
+        # changes to the index drop the window
+        index.unindex_object(7)
+        self._checkApply(index, {'work': 3},
+                         matchingDummiesByUIDs([0, 1, 2, 4, 5, 6]))
+        self.assertEqual(index._v_window[0], index.getCounter())
+
+    def test_interval_tree(self):
+        index = self._makeOne('work', 'start', 'stop')
+        index.setUseIntervalTree(True)
+        for i, dummy in dummies:
+            index.index_object(i, dummy)
+
+        for value in range(-1, 15):
+            matches = matchingDummiesByTimeValue(value)
+            self._checkApply(index, {'work': value}, matches)
+            self.assertEqual(
+                list(index._segment_result(value)),
+                [i for i, dummy in matches])
+
+        self._checkApply(index, {'work': 11},
+                         matchingDummiesByUIDs([0, 5]),
+                         resultset=IISet([0, 5, 7]))
+
+        index.unindex_object(6)
+        self._checkApply(index, {'work': 11},
+                         matchingDummiesByUIDs([0, 1, 2, 3, 5]))
+
+        index.setUseIntervalTree(False)
+        self.assertIsNone(index._segments)
+        self._checkApply(index, {'work': 11},
+                         matchingDummiesByUIDs([0, 1, 2, 3, 5]))
+
+    def test_overlap(self):
+        for use_interval_tree in (False, True):
+            index = self._makeOne('work', 'start', 'stop')
+            index.setUseIntervalTree(use_interval_tree)
+            for i, dummy in dummies:
+                index.index_object(i, dummy)
+
+            self._checkApply(index, {'work': {'query': (5, 8),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([0, 1, 2, 5, 6, 7]))
+            self._checkApply(index, {'work': {'query': (3, 20),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([0, 1, 2, 3, 4, 5, 6, 7]))
+            self._checkApply(index, {'work': {'query': 12,
+                                              'range': 'min'}},
+                             matchingDummiesByUIDs([0, 1, 2, 3]))
+            self._checkApply(index, {'work': {'query': 1,
+                                              'range': 'max'}},
+                             matchingDummiesByUIDs([0, 1, 2, 4, 5, 6]))
+            self._checkApply(index, {'work': {'query': (5, 8),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([2, 7]),
+                             resultset=IISet([2, 3, 4, 7]))
+
+    def test_overlap_outside_bounds(self):
+        for use_interval_tree in (False, True):
+            index = self._makeOne('work', 'start', 'stop')
+            index.setUseIntervalTree(use_interval_tree)
+            for i, dummy in dummies:
+                index.index_object(i, dummy)
+            floor, ceiling = index.floor_value, index.ceiling_value
+
+            # only intervals open towards the query match
+            self._checkApply(index, {'work': {'query': (floor - 20,
+                                                        floor - 10),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([0, 1, 4, 5]))
+            self._checkApply(index, {'work': {'query': floor - 10,
+                                              'range': 'max'}},
+                             matchingDummiesByUIDs([0, 1, 4, 5]))
+            self._checkApply(index, {'work': {'query': (ceiling + 10,
+                                                        ceiling + 20),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([0, 1, 2, 3]))
+            self._checkApply(index, {'work': {'query': (floor - 10,
+                                                        ceiling + 10),
+                                              'range': 'min:max'}},
+                             dummies)
+            self._checkApply(index, {'work': {'query': (floor - 10, 1),
+                                              'range': 'min:max'}},
+                             matchingDummiesByUIDs([0, 1, 2, 4, 5, 6]))
+
+    def test_edit_bounds(self):
+        index = self._makeOne('work', 'start', 'stop')
+        index.setUseIntervalTree(True)
+        for i, dummy in dummies:
+            index.index_object(i, dummy)
+
+        index._edit('start', 'stop', floor_value=-1000, ceiling_value=1000)
+        for value in range(-1, 15):
+            matches = matchingDummiesByTimeValue(value)
+            self._checkApply(index, {'work': value}, matches)
+            self.assertEqual(
+                list(index._segment_result(value)),
+                [i for i, dummy in matches])
+        self._checkApply(index, {'work': 1000},
+                         matchingDummiesByUIDs([0, 1, 2, 3]))
+
     def test_getCounter(self):
         index = self._makeOne('work', 'start', 'stop')
         self.assertEqual(index.getCounter(), 0)
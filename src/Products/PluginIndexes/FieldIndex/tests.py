@@ -278,3 +278,120 @@ class FieldIndexTests(unittest.TestCase):
                   'foo_operator': 'and'}
 
         self.assertRaises(ValueError, self._checkApply, record, expect)
+
+    def testRangeBuckets(self):
+        import random
+        index = self._makeOne('foo', extra={'range_bucket_size': 4})
+        plain = self._makeOne('foo')
+        rnd = random.Random(42)
+        for i in range(500):
+            obj = Dummy(rnd.randint(-300, 300))
+            index.index_object(i, obj)
+            plain.index_object(i, obj)
+        for i in range(0, 500, 3):
+            index.unindex_object(i)
+            plain.unindex_object(i)
+        for i in range(1, 500, 7):
+            obj = Dummy(rnd.randint(-300, 300))
+            index.index_object(i, obj)
+            plain.index_object(i, obj)
+
+        for lo, hi in ((-300, 300), (-17, 255), (3, 3), (5, 4), (0, 130)):
+            for query in ({'query': (lo, hi), 'range': 'min:max'},
+                          {'query': lo, 'range': 'min'},
+                          {'query': hi, 'range': 'max'}):
+                record = {'foo': query}
+                self.assertEqual(
+                    list(index._apply_index(record)[0]),
+                    list(plain._apply_index(record)[0]), query)
+
+    def testRangeBucketsFloats(self):
+        index = self._makeOne('foo', extra={'range_bucket_size': 4})
+        for i, value in enumerate((1, 2.5, 3, 7)):
+            index.index_object(i, Dummy(value))
+        record = {'foo': {'query': (0, 50), 'range': 'min:max'}}
+        self.assertEqual(list(index._apply_index(record)[0]), [0, 1, 2, 3])
+        self.assertIsNone(index._range_setlist(0, 50))
+
+        # without floats the pyramid is used again
+        index.unindex_object(1)
+        self.assertEqual(list(index._apply_index(record)[0]), [0, 2, 3])
+        self.assertIsNotNone(index._range_setlist(0, 50))
+
+        index.setRangeBuckets(4)
+        index.index_object(1, Dummy(2.5))
+        index.setRangeBuckets(4)
+        self.assertEqual(index._range_others(), 1)
+        self.assertEqual(list(index._apply_index(record)[0]), [0, 1, 2, 3])
+
+    def testDictionaryEncoding(self):
+        from Products.PluginIndexes.encoding import EncodedUnindex
+        index = self._makeOne('foo', extra={'dictionary_encoding': True})
+        self.assertIsInstance(index._unindex, EncodedUnindex)
+        for k, v in self._values:
+            index.index_object(k, v)
+        self.assertEqual(index.getEntryForObject(5), 'abce')
+        self.assertEqual(index.documentToKeyMap()[2], 'abc')
+        self.assertEqual(index._unindex.valueCount(), 7)
+        self.assertEqual(list(index._apply_index(self._range_req)[0]),
+                         [2, 3, 4])
+
+        index.index_object(5, Dummy('b'))
+        index.index_object(6, Dummy('b'))
+        index.unindex_object(7)
+        # unused values stay until they are collected
+        self.assertIsNotNone(index._unindex.ordinal('abce'))
+        index._unindex.collect()
+        self.assertEqual(index._unindex.valueCount(), 6)
+        self.assertIsNone(index._unindex.ordinal('abce'))
+        self.assertIsNone(index._unindex.ordinal('0'))
+        self.assertEqual(index.numObjects(), 7)
+
+        index.setDictionaryEncoding(False)
+        self.assertNotIsInstance(index._unindex, EncodedUnindex)
+        self.assertEqual(dict(index._unindex.items()),
+                         {0: 'a', 1: 'ab', 2: 'abc', 3: 'abca', 4: 'abcd',
+                          5: 'b', 6: 'b'})
+
+    def testValueCounts(self):
+        index = self._makeOne('foo', extra={'value_counts': True})
+        for k, v in self._values:
+            index.index_object(k, v)
+        self.assertEqual(index.documentCount('abce'), 2)
+        self.assertEqual(index.documentCount('missing'), 0)
+        self.assertEqual(index.histogram(), {1: 6, 2: 1})
+
+        index.index_object(5, Dummy('a'))
+        index.unindex_object(6)
+        index.unindex_object(6)
+        self.assertEqual(index.documentCount('abce'), 0)
+        self.assertNotIn('abce', index._value_counts)
+        self.assertEqual(index.documentCount('a'), 2)
+        self.assertEqual(
+            list(index.uniqueValues(withLengths=True)),
+            [('0', 1), ('a', 2), ('ab', 1), ('abc', 1), ('abca', 1),
+             ('abcd', 1)])
+
+        self._populateIndex()
+        self.assertIsNone(self._index._value_counts)
+        self._index.setValueCounts(True)
+        self.assertEqual(list(self._index.uniqueValues(withLengths=True)),
+                         [('0', 1), ('a', 1), ('ab', 1), ('abc', 1),
+                          ('abca', 1), ('abcd', 1), ('abce', 2)])
+        self.assertEqual(self._index.histogram(), {1: 6, 2: 1})
+
+    def testSetRangeBuckets(self):
+        index = self._index
+        for i in range(100):
+            index.index_object(i, Dummy(i))
+        self.assertIsNone(index._range_index)
+        index.setRangeBuckets(2, fanout=4, levels=3)
+        self.assertEqual(list(index._range_index[(2, 1)]), list(range(32, 64)))
+        record = {'foo': {'query': (7, 60), 'range': 'min:max'}}
+        self.assertEqual(list(index._apply_index(record)[0]),
+                         list(range(7, 61)))
+        self.assertEqual(len(index._range_setlist(7, 60)), 10)
+        index.setRangeBuckets(0)
+        self.assertIsNone(index._range_index)
+        self.assertEqual(list(index._apply_index(record)[0]),
+                         list(range(7, 61)))
@@ -33,6 +33,10 @@ class KeywordIndex(UnIndex):
     """
     meta_type = 'KeywordIndex'
     query_options = ('query', 'range', 'not', 'operator')
+    _multi_valued = True
+
+    # documents are not stored under a single sort key
+    itemsFrom = None
 
     manage_options = (
         {'label': 'Settings', 'action': 'manage_main'},
@@ -291,3 +291,46 @@ class TestKeywordIndex(unittest.TestCase):
         # clear is a change
         index.clear()
         self.assertEqual(index.getCounter(), 3)
+
+    def test_dictionary_encoding(self):
+        from Products.PluginIndexes.encoding import EncodedUnindex
+        self._populateIndex()
+        self._index.setDictionaryEncoding(True)
+        self.assertIsInstance(self._index._unindex, EncodedUnindex)
+        self.assertEqual(self._index.getEntryForObject(3), ['a', 'b', 'c'])
+        self._checkApply(self._overlap_req, self._values[2:7])
+
+        self._index.index_object(6, Dummy(['f', 'g']))
+        self.assertEqual(self._index.getEntryForObject(6), ['f', 'g'])
+        self._checkApply(self._some_req, self._values[5:6])
+        self._index.unindex_object(7)
+        self._index._unindex.collect()
+        self.assertIsNone(self._index._unindex.ordinal('0'))
+        self.assertEqual(self._index.numObjects(), 7)
+
+    def test_value_counts(self):
+        index = self._makeOne('foo', extra={'value_counts': True})
+        for k, v in self._values:
+            index.index_object(k, v)
+        self.assertEqual(index.documentCount('a'), 7)
+        self.assertEqual(index.documentCount('e'), 2)
+        index.index_object(6, Dummy(['a', 'g']))
+        index.unindex_object(1)
+        self.assertEqual(index.documentCount('a'), 6)
+        self.assertEqual(index.documentCount('e'), 1)
+        self.assertEqual(index.documentCount('f'), 0)
+        self.assertEqual(dict(index.uniqueValues(withLengths=True)),
+                         {'0': 1, 'a': 6, 'b': 4, 'c': 4, 'd': 1, 'e': 1,
+                          'g': 1})
+
+    def test_range_buckets(self):
+        # a document stays in a bucket as long as any of its keywords is,
+        # so keyword indexes don't use the range pyramid
+        index = self._makeOne('foo', extra={'range_bucket_size': 4})
+        self.assertIsNone(index._range_index)
+        self.assertRaises(ValueError, index.setRangeBuckets, 4)
+        index.index_object(1, Dummy([1, 2]))
+        index.index_object(1, Dummy([1]))
+        result, _ = index._apply_index(
+            {'foo': {'query': (0, 3), 'range': 'min:max'}})
+        self.assertEqual(list(result), [1])
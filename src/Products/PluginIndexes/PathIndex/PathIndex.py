@@ -26,6 +26,7 @@ from OFS.SimpleItem import SimpleItem
 from Persistence import Persistent
 from zope.interface import implementer
 
+from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IPathIndex
 from Products.PluginIndexes.interfaces import IQueryIndex
 from Products.PluginIndexes.interfaces import ISortIndex
@@ -37,7 +38,8 @@ from Products.ZCatalog.query import IndexQuery
 LOG = getLogger('Zope.PathIndex')
 
 
-@implementer(IPathIndex, IQueryIndex, IUniqueValueIndex, ISortIndex)
+@implementer(ILimitedResultIndex, IPathIndex, IQueryIndex, IUniqueValueIndex,
+             ISortIndex)
 class PathIndex(Persistent, SimpleItem):
 
     """Index for paths returned by getPhysicalPath.
@@ -52,6 +54,17 @@ class PathIndex(Persistent, SimpleItem):
 
     - the value is a mapping 'level of the path component' to
       'all docids with this path component on this level'
+
+    Optionally (`use_subtree_index`) the index also keeps:
+
+    - a mapping of every path prefix to all docids below (and at) it
+      in self._subtree
+
+    - a mapping of every path prefix to 'relative depth below the prefix'
+      to 'all docids at this depth' in self._subtree_levels
+
+    Absolute (level 0) queries are then answered by a single lookup, and
+    queries limited by 'depth' by a union of at most depth + 1 sets.
     """
 
     meta_type = 'PathIndex'
@@ -59,14 +72,24 @@ class PathIndex(Persistent, SimpleItem):
 
     operators = ('or', 'and')
     useOperator = 'or'
-    query_options = ('query', 'level', 'operator')
+    query_options = ('query', 'level', 'operator', 'depth')
+
+    use_subtree_index = False
+    _subtree = None
+    _subtree_levels = None
 
     manage_options = (
         {'label': 'Settings', 'action': 'manage_main'},
     )
 
-    def __init__(self, id, caller=None):
+    def __init__(self, id, caller=None, extra=None):
         self.id = id
+        if isinstance(extra, dict):
+            use_subtree_index = extra.get('use_subtree_index', False)
+        else:
+            use_subtree_index = getattr(extra, 'use_subtree_index', False)
+        if use_subtree_index:
+            self.use_subtree_index = True
         self.clear()
 
     def __len__(self):
@@ -129,6 +152,8 @@ class PathIndex(Persistent, SimpleItem):
 
         for i in range(len(comps)):
             self.insertEntry(comps[i], docid, i)
+        if self._subtree is not None:
+            self._subtree_insert(comps, docid)
         self._unindex[docid] = path
         return 1
 
@@ -156,15 +181,19 @@ class PathIndex(Persistent, SimpleItem):
                 LOG.debug('Attempt to unindex document '
                           'with id %s failed', docid)
 
+        if self._subtree is not None:
+            self._subtree_remove(
+                list(filter(None, self._unindex[docid].split('/'))), docid)
+
         self._length.change(-1)
         del self._unindex[docid]
 
-    def _apply_index(self, request):
+    def _apply_index(self, request, resultset=None):
         record = IndexQuery(request, self.id, self.query_options,
                             self.operators, self.useOperator)
         if record.keys is None:
             return None
-        return (self.query_index(record), (self.id, ))
+        return (self.query_index(record, resultset=resultset), (self.id, ))
 
     def query_index(self, record, resultset=None):
         """See IPluggableIndex.
@@ -172,6 +201,7 @@ class PathIndex(Persistent, SimpleItem):
         o Unpacks record from catalog and map onto '_search'.
         """
         level = record.get('level', 0)
+        depth = int(record.get('depth', -1))
         operator = record.operator
 
         # depending on the operator we use intersection or union
@@ -182,7 +212,7 @@ class PathIndex(Persistent, SimpleItem):
 
         res = None
         for k in record.keys:
-            rows = self._search(k, level)
+            rows = self._search(k, level, depth, resultset)
             res = set_func(res, rows)
 
         if res:
@@ -206,6 +236,27 @@ class PathIndex(Persistent, SimpleItem):
         self._index = OOBTree()
         self._unindex = IOBTree()
         self._length = Length(0)
+        if self.use_subtree_index:
+            self._subtree = OOBTree()
+            self._subtree_levels = OOBTree()
+        else:
+            self._subtree = self._subtree_levels = None
+
+    def setUseSubtreeIndex(self, flag):
+        """Enable or disable the subtree index, (re)building it from the
+        indexed paths as needed.
+        """
+        flag = bool(flag)
+        if flag == bool(self.use_subtree_index):
+            return
+        self.use_subtree_index = flag
+        self._subtree = self._subtree_levels = None
+        if flag:
+            self._subtree = OOBTree()
+            self._subtree_levels = OOBTree()
+            for docid, path in self._unindex.items():
+                self._subtree_insert(
+                    list(filter(None, path.split('/'))), docid)
 
     # IUniqueValueIndex implementation
 
@@ -256,7 +307,67 @@ class PathIndex(Persistent, SimpleItem):
 
     # Helper methods
 
-    def _search(self, path, default_level=0):
+    def _subtree_insert(self, comps, docid):
+        depth = len(comps)
+        for i in range(depth + 1):
+            prefix = '/' + '/'.join(comps[:i])
+            row = self._subtree.get(prefix, None)
+            if row is None:
+                self._subtree[prefix] = row = IITreeSet()
+            row.insert(docid)
+
+            levels = self._subtree_levels.get(prefix, None)
+            if levels is None:
+                self._subtree_levels[prefix] = levels = IOBTree()
+            row = levels.get(depth - i, None)
+            if row is None:
+                levels[depth - i] = row = IITreeSet()
+            row.insert(docid)
+
+    def _subtree_remove(self, comps, docid):
+        depth = len(comps)
+        for i in range(depth + 1):
+            prefix = '/' + '/'.join(comps[:i])
+            row = self._subtree.get(prefix, None)
+            if row is not None and docid in row:
+                row.remove(docid)
+                if not row:
+                    del self._subtree[prefix]
+
+            levels = self._subtree_levels.get(prefix, None)
+            if levels is None:
+                continue
+            row = levels.get(depth - i, None)
+            if row is not None and docid in row:
+                row.remove(docid)
+                if not row:
+                    del levels[depth - i]
+            if not levels:
+                del self._subtree_levels[prefix]
+
+    def _search_subtree(self, comps, depth=-1, resultset=None):
+        prefix = '/' + '/'.join(comps)
+        if depth < 0:
+            row = self._subtree.get(prefix, None)
+            if row is None:
+                return IISet()
+            return intersection(resultset, row)
+        levels = self._subtree_levels.get(prefix, None)
+        if levels is None:
+            return IISet()
+        if resultset is None:
+            return multiunion(levels.values(0, depth))
+        return multiunion([intersection(resultset, row)
+                           for row in levels.values(0, depth)])
+
+    def _limit_depth(self, results, max_depth):
+        # fallback for depth limited queries without the subtree index
+        unindex = self._unindex
+        return IISet([docid for docid in results
+                      if len(list(filter(None, unindex[docid].split('/'))))
+                      <= max_depth])
+
+    def _search(self, path, default_level=0, depth=-1, resultset=None):
         """ Perform the actual search.
 
         ``path``
@@ -270,6 +381,15 @@ class PathIndex(Persistent, SimpleItem):
         ``level >= 0`` =>  match ``path`` only at the given level.
 
         ``level <  0`` =>  match ``path`` at *any* level
+
+        ``depth``
+            limit the result to documents at most ``depth`` levels below the
+            matched path (0 being the documents at the path itself), a
+            negative ``depth`` doesn't limit the result.
+
+        ``resultset``
+            if not None, only documents in this set are of interest; it
+            bounds the per-level intersections.
         """
         if isinstance(path, str):
             level = default_level
@@ -280,7 +400,7 @@ class PathIndex(Persistent, SimpleItem):
         if level < 0:
             # Search at every level, return the union of all results
             return multiunion(
-                [self._search(path, lvl)
+                [self._search(path, lvl, depth, resultset)
                  for lvl in range(self._depth + 1)])
 
         comps = list(filter(None, path.split('/')))
@@ -289,10 +409,21 @@ class PathIndex(Persistent, SimpleItem):
             # Our search is for a path longer than anything in the index
             return IISet()
 
-        if len(comps) == 0:
-            return IISet(self._unindex.keys())
+        if level == 0 and self._subtree is not None:
+            return self._search_subtree(comps, depth, resultset)
 
-        results = None
+        if len(comps) == 0:
+            if resultset is None:
+                results = IISet(self._unindex.keys())
+            else:
+                unindex = self._unindex
+                results = IISet([docid for docid in resultset
+                                 if docid in unindex])
+            if depth >= 0:
+                results = self._limit_depth(results, depth)
+            return results
+
+        results = resultset
         for i, comp in reversed(list(enumerate(comps))):
             tree = self._index.get(comp, None)
             if tree is None:
@@ -301,6 +432,10 @@ class PathIndex(Persistent, SimpleItem):
             if tree2 is None:
                 return IISet()
             results = intersection(results, tree2)
+            if not results:
+                return IISet()
+        if depth >= 0:
+            results = self._limit_depth(results, level + len(comps) + depth)
         return results
 
     manage = manage_main = DTMLFile('dtml/managePathIndex', globals())
@@ -61,10 +61,10 @@ class PathIndexTests(unittest.TestCase):
         from Products.PluginIndexes.PathIndex.PathIndex import PathIndex
         return PathIndex
 
-    def _makeOne(self, id='path', caller=_marker):
+    def _makeOne(self, id='path', caller=_marker, extra=None):
         if caller is not _marker:
-            return self._getTargetClass()(id, caller)
-        return self._getTargetClass()(id)
+            return self._getTargetClass()(id, caller, extra)
+        return self._getTargetClass()(id, extra=extra)
 
     def test_class_conforms_to_IPluggableIndex(self):
         from zope.interface.verify import verifyClass
@@ -102,6 +102,12 @@ class PathIndexTests(unittest.TestCase):
         from Products.PluginIndexes.interfaces import ISortIndex
         verifyObject(ISortIndex, self._makeOne())
 
+    def test_class_conforms_to_ILimitedResultIndex(self):
+        from zope.interface.verify import verifyClass
+
+        from Products.PluginIndexes.interfaces import ILimitedResultIndex
+        verifyClass(ILimitedResultIndex, self._getTargetClass())
+
     def test_class_conforms_to_IPathIndex(self):
         from zope.interface.verify import verifyClass
 
@@ -390,6 +396,81 @@ class PathIndexTests(unittest.TestCase):
         res = index._apply_index(dict(path='aa'))
         self.assertEqual(list(res[0].keys()), [])
 
+    def test__apply_index_depth(self):
+        for use_subtree_index in (False, True):
+            index = self._makeOne()
+            index.setUseSubtreeIndex(use_subtree_index)
+            index.index_object(1, Dummy("/ff"))
+            index.index_object(2, Dummy("/ff/gg"))
+            index.index_object(3, Dummy("/ff/gg/3.html"))
+            index.index_object(4, Dummy("/ff/gg/hh/4.html"))
+            index.index_object(5, Dummy("/xx/ff/gg"))
+            tests = [
+                # path, level, depth, expected
+                ('/ff', 0, -1, [1, 2, 3, 4]),
+                ('/ff', 0, 0, [1]),
+                ('/ff', 0, 1, [1, 2]),
+                ('/ff/gg', 0, 1, [2, 3]),
+                ('/ff/gg', 0, 2, [2, 3, 4]),
+                ('/', 0, 1, [1]),
+                ('/', 0, 2, [1, 2]),
+                ('/ff/gg', 1, 0, [5]),
+                ('/ff/gg', -1, 0, [2, 5]),
+                ('/zz', 0, 1, []),
+            ]
+            for path, level, depth, expected in tests:
+                query = {'path': {'query': path, 'level': level,
+                                  'depth': depth}}
+                res = index._apply_index(query)
+                self.assertEqual(list(res[0].keys()), expected,
+                                 (path, level, depth, use_subtree_index))
+
+    def test__apply_index_resultset(self):
+        from BTrees.IIBTree import IISet
+        resultset = IISet([2, 5, 11, 12, 17])
+        for use_subtree_index in (False, True):
+            index = self._makeOne()
+            index.setUseSubtreeIndex(use_subtree_index)
+            _populateIndex(index)
+            tests = [
+                # path, level, operator, expected
+                ('/aa', 0, 'or', [2, 5]),
+                ('/', 0, 'or', [2, 5, 11, 12, 17]),
+                (['/aa', '/bb/cc'], 0, 'or', [2, 5, 17]),
+                ('bb', 1, 'or', [5]),
+                ('bb', -1, 'or', [2, 5, 11, 12, 17]),
+                ([('aa', 0), ('bb', 2)], 0, 'and', [2, 5]),
+                ('/cc', 0, 'or', []),
+            ]
+            for path, level, operator, expected in tests:
+                query = {'path': {'query': path, 'level': level,
+                                  'operator': operator}}
+                res = index._apply_index(query, resultset)
+                self.assertEqual(list(res[0].keys()), expected,
+                                 (path, level, use_subtree_index))
+
+    def test_subtree_index(self):
+        index = self._makeOne(extra={'use_subtree_index': True})
+        _populateIndex(index)
+        self.assertEqual(list(index._subtree['/aa/bb']), [4, 5, 6])
+        self.assertEqual(list(index._subtree_levels['/aa'][3]),
+                         list(range(1, 10)))
+        self.assertEqual(len(index._subtree['/']), len(DUMMIES))
+
+        res = index._apply_index({'path': '/bb/cc'})
+        self.assertEqual(list(res[0].keys()), [16, 17, 18])
+
+        index.unindex_object(17)
+        res = index._apply_index({'path': '/bb/cc'})
+        self.assertEqual(list(res[0].keys()), [16, 18])
+        self.assertNotIn('/bb/cc/bb', index._subtree)
+        self.assertNotIn('/bb/cc/bb/17.html', index._subtree_levels)
+
+        index.setUseSubtreeIndex(False)
+        self.assertIsNone(index._subtree)
+        res = index._apply_index({'path': '/bb/cc'})
+        self.assertEqual(list(res[0].keys()), [16, 18])
+
     def test_numObjects_empty(self):
         index = self._makeOne()
         self.assertEqual(index.numObjects(), 0)
@@ -23,6 +23,7 @@ from OFS.SimpleItem import SimpleItem
 from Persistence import Persistent
 from zope.interface import implementer
 
+from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IQueryIndex
 from Products.PluginIndexes.interfaces import ITopicIndex
 from Products.PluginIndexes.interfaces import IUniqueValueIndex
@@ -34,7 +35,7 @@ _marker = []
 LOG = getLogger('Zope.TopicIndex')
 
 
-@implementer(ITopicIndex, IQueryIndex, IUniqueValueIndex)
+@implementer(ILimitedResultIndex, ITopicIndex, IQueryIndex, IUniqueValueIndex)
 class TopicIndex(Persistent, SimpleItem):
     """A TopicIndex maintains a set of FilteredSet objects.
 
@@ -95,27 +96,34 @@ class TopicIndex(Persistent, SimpleItem):
         if f is not None:
             return f.getIds()
 
-    def _apply_index(self, request):
+    def _apply_index(self, request, resultset=None):
         record = IndexQuery(request, self.id, self.query_options,
                             self.operators, self.useOperator)
         if record.keys is None:
             return None
-        return (self.query_index(record), (self.id, ))
+        return (self.query_index(record, resultset=resultset), (self.id, ))
 
     def query_index(self, record, resultset=None):
         """Hook for (Z)Catalog
         'record' --  mapping type (usually {"topic": "..." }
         """
         operator = record.operator
+        res = None
         if operator == 'or':
-            set_func = union
+            for filter_id in record.keys:
+                rows = self.search(filter_id)
+                if resultset is not None and rows is not None:
+                    rows = intersection(resultset, rows)
+                res = union(res, rows)
         else:
-            set_func = intersection
-
-        res = None
-        for filter_id in record.keys:
-            rows = self.search(filter_id)
-            res = set_func(res, rows)
+            for filter_id in record.keys:
+                rows = self.search(filter_id)
+                if rows is None:
+                    continue
+                # the first set found is bound by the resultset
+                res = intersection(resultset if res is None else res, rows)
+                if not res:
+                    break
 
         if res:
             return res
@@ -39,9 +39,9 @@ class TestBase(unittest.TestCase):
     def _searchOr(self, query, expected):
         return self._search(query, 'or', expected)
 
-    def _search(self, query, operator, expected):
+    def _search(self, query, operator, expected, resultset=None):
         res = self.TI._apply_index(
-            {'topic': {'query': query, 'operator': operator}})
+            {'topic': {'query': query, 'operator': operator}}, resultset)
         rows = sorted(res[0].keys())
         expected.sort()
         self.assertEqual(rows, expected, query)
@@ -68,6 +68,7 @@ class TestTopicIndex(TestBase):
     def test_interfaces(self):
         from zope.interface.verify import verifyClass
 
+        from Products.PluginIndexes.interfaces import ILimitedResultIndex
         from Products.PluginIndexes.interfaces import IPluggableIndex
         from Products.PluginIndexes.interfaces import ITopicIndex
         from Products.PluginIndexes.interfaces import IUniqueValueIndex
@@ -75,6 +76,7 @@ class TestTopicIndex(TestBase):
         verifyClass(ITopicIndex, TopicIndex)
         verifyClass(IPluggableIndex, TopicIndex)
         verifyClass(IUniqueValueIndex, TopicIndex)
+        verifyClass(ILimitedResultIndex, TopicIndex)
 
     def testOr(self):
         self._searchOr('doc1', [1, 2])
@@ -90,6 +92,15 @@ class TestTopicIndex(TestBase):
         self._searchAnd(['doc2'], [3, 4])
         self._searchAnd(['doc1', 'doc2'], [])
 
+    def testResultset(self):
+        from BTrees.IIBTree import IISet
+        resultset = IISet([0, 2, 3, 5])
+        self._search('doc1', 'or', [2], resultset)
+        self._search(['doc1', 'doc2'], 'or', [2, 3], resultset)
+        self._search(['doc1', 'unknown'], 'and', [2], resultset)
+        self._search(['doc1', 'doc2'], 'and', [], resultset)
+        self._search('doc1', 'and', [], IISet([5, 6]))
+
     def testRemoval(self):
         self.TI.index_object(1, Obj('1', 'doc2'))
         self._searchOr('doc1', [2])
@@ -0,0 +1,248 @@
+##############################################################################
+#
+# Copyright (c) 2002 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+from BTrees.IIBTree import IIBTree
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import multiunion
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
+from Persistence import Persistent
+
+
+# Ordinals are positive 32 bit integers.  New values are placed
+# `ORDINAL_GAP` apart, or halfway between their neighbours, so that the
+# ordinal order matches the value order.  Values for which there is no
+# room left between their neighbours are appended above all ordinals
+# until `EncodedUnindex.collect` renumbers them.
+ORDINAL_MAX = 2 ** 31 - 1
+ORDINAL_GAP = 2 ** 12
+
+_marker = object()
+
+
+class EncodedUnindex(Persistent):
+    """Reverse index storing dictionary-encoded values.
+
+    Behaves like the `IOBTree` mapping document ids to values used by
+    `UnIndex`, but stores every distinct value only once in a value table
+    and keeps a small integer ordinal per document instead (or an
+    `IITreeSet` of ordinals when `multi` is true, e.g. for keywords).
+    Ordinals are assigned in value order, so comparing ordinals gives the
+    same result as comparing the values as long as `ordered` is true.
+
+    Writes only touch the rows of their documents and, for new values, the
+    value table, so concurrent transactions indexing different documents
+    don't conflict.  Values no longer used by any document stay in the
+    table until `collect` removes them.
+
+    In `multi` mode values are sequences and are returned as sorted lists.
+    """
+
+    ordered = True
+
+    def __init__(self, multi=False, data=None):
+        self.multi = bool(multi)
+        self._ordinals = OIBTree()   # value -> ordinal
+        self._values = IOBTree()     # ordinal -> value
+        if self.multi:
+            self._rows = IOBTree()
+        else:
+            self._rows = IIBTree()
+        if data is not None:
+            for documentId, value in data.items():
+                self[documentId] = value
+
+    # value table
+
+    def ordinal(self, value, default=None):
+        """Return the ordinal of value or default if it isn't encoded."""
+        return self._ordinals.get(value, default)
+
+    def value(self, ordinal):
+        """Return the value encoded by ordinal."""
+        return self._values[ordinal]
+
+    def valueCount(self):
+        """Return the number of distinct encoded values, including values
+        not used anymore which haven't been collected yet."""
+        return len(self._values)
+
+    def _encode(self, value):
+        ordinal = self._ordinals.get(value, None)
+        if ordinal is None:
+            ordinal = self._assign(value)
+            if ordinal is None:
+                ordinal = self._append()
+            self._ordinals[value] = ordinal
+            self._values[ordinal] = value
+        return ordinal
+
+    def _append(self):
+        # Return an ordinal above all others for a value without room
+        # between its neighbours.
+        ordinal = self._values.maxKey() + 1
+        if ordinal > ORDINAL_MAX:
+            # out of room at the top too, renumber right away, keeping
+            # the values just encoded for a row not stored yet
+            self._renumber()
+            ordinal = self._values.maxKey() + 1
+        if self.ordered:
+            self.ordered = False
+        return ordinal
+
+    def _assign(self, value):
+        """Find a free ordinal between the neighbours of value.
+
+        Returns None if there is no room left between them.
+        """
+        ordinals = self._ordinals
+        try:
+            low = ordinals[ordinals.maxKey(value)]
+        except ValueError:
+            low = None
+        try:
+            high = ordinals[ordinals.minKey(value)]
+        except ValueError:
+            high = None
+
+        lower = 0 if low is None else low
+        upper = ORDINAL_MAX + 1 if high is None else high
+        if upper - lower < 2:
+            return None
+        middle = (lower + upper) // 2
+        if high is None:
+            ordinal = min(lower + ORDINAL_GAP, middle)
+        elif low is None:
+            ordinal = max(upper - ORDINAL_GAP, middle)
+        else:
+            ordinal = middle
+        if ordinal in self._values:
+            # taken by an appended value while the order is broken
+            return None
+        return ordinal
+
+    def _used(self):
+        # Return the set of ordinals referenced by rows.
+        if self.multi:
+            return multiunion(list(self._rows.values()))
+        return IISet(self._rows.values())
+
+    def collect(self):
+        """Remove the values not used by any document anymore and restore
+        the value order of the ordinals if needed.
+
+        This reads and, when renumbering, rewrites every row, it's meant
+        to run during maintenance like the compaction of the index.
+        Returns the number of values removed.
+        """
+        used = self._used()
+        unused = [o for o in self._values.keys() if o not in used]
+        for ordinal in unused:
+            del self._ordinals[self._values[ordinal]]
+            del self._values[ordinal]
+        if not self.ordered:
+            self._renumber(used)
+        return len(unused)
+
+    def _renumber(self, used=None):
+        """Spread the used ordinals, or all if used is None, evenly in
+        value order."""
+        if used is None:
+            used = self._values
+        gap = min(ORDINAL_GAP, ORDINAL_MAX // (len(used) + 2))
+        if gap < 2:
+            raise OverflowError('too many distinct values to encode')
+
+        mapping = {}
+        ordinals = OIBTree()
+        values = IOBTree()
+        i = 0
+        for value, old in self._ordinals.items():
+            if old not in used:
+                continue
+            i += 1
+            new = i * gap
+            mapping[old] = new
+            ordinals[value] = new
+            values[new] = value
+        self._ordinals = ordinals
+        self._values = values
+        self.ordered = True
+
+        rows = self._rows
+        for documentId, row in list(rows.items()):
+            if self.multi:
+                rows[documentId] = IITreeSet([mapping[o] for o in row])
+            else:
+                rows[documentId] = mapping[row]
+
+    def _decode(self, row):
+        if self.multi:
+            return [self._values[ordinal] for ordinal in row]
+        return self._values[row]
+
+    # mapping api
+
+    def __getitem__(self, documentId):
+        return self._decode(self._rows[documentId])
+
+    def get(self, documentId, default=None):
+        row = self._rows.get(documentId, _marker)
+        if row is _marker:
+            return default
+        return self._decode(row)
+
+    def __setitem__(self, documentId, value):
+        if self.multi:
+            # encode everything first, assigning new ordinals may renumber
+            value = list(value)
+            for v in value:
+                self._encode(v)
+            row = IITreeSet([self._ordinals[v] for v in value])
+        else:
+            row = self._encode(value)
+        self._rows[documentId] = row
+
+    def __delitem__(self, documentId):
+        del self._rows[documentId]
+
+    def __contains__(self, documentId):
+        return documentId in self._rows
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __bool__(self):
+        return bool(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows.keys())
+
+    def keys(self, *args, **kw):
+        return self._rows.keys(*args, **kw)
+
+    def values(self, *args, **kw):
+        for row in self._rows.values(*args, **kw):
+            yield self._decode(row)
+
+    def items(self, *args, **kw):
+        for documentId, row in self._rows.items(*args, **kw):
+            yield documentId, self._decode(row)
+
+    def ordinalMap(self):
+        """Return the raw mapping of document ids to ordinals (or sets of
+        ordinals in `multi` mode)."""
+        return self._rows
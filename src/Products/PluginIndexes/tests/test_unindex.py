@@ -231,3 +231,157 @@ class TestUnIndex(unittest.TestCase):
                     docs[r[0]: (r[1] + 1 if r[1] is not None else None)],
                     tuple(apply(dict(idx=query))[0]),
                     f"{op}: {r}")
+
+    def test_getThreshold(self):
+        from BTrees.IIBTree import IISet
+        from zope.testing.cleanup import cleanUp
+
+        from Products.ZCatalog.plan import DEFAULT_THRESHOLDS
+        from Products.ZCatalog.plan import catalog_id
+        from Products.ZCatalog.plan import set_thresholds
+        index = self._getTargetClass()('idx')
+        for i in range(10):
+            index.insertForwardIndexEntry(i % 5, i)
+        self.assertEqual(index.getThreshold('or_intersect_max'),
+                         DEFAULT_THRESHOLDS['or_intersect_max'])
+
+        record = IndexQuery({'idx': [1, 2]}, 'idx')
+        resultset = IISet(range(0, 10, 2))
+        expected = list(index.query_index(record, resultset))
+        set_thresholds(catalog_id(None), {'or_intersect_max': 1})
+        try:
+            self.assertEqual(index.getThreshold('or_intersect_max'), 1)
+            record = IndexQuery({'idx': [1, 2]}, 'idx')
+            result = index.query_index(record, resultset)
+            # without intersecting first the full union is returned
+            self.assertEqual(list(result), [1, 2, 6, 7])
+            self.assertEqual(expected, [2, 6])
+        finally:
+            cleanUp()
+
+    def test_itemsFrom(self):
+        index = self._makeOne('idx')
+        for i in range(10):
+            index.insertForwardIndexEntry(i % 5, i)
+        self.assertEqual([(k, list(v)) for k, v in index.itemsFrom(3)],
+                         [(3, [3, 8]), (4, [4, 9])])
+        self.assertEqual([k for k, v in index.itemsFrom(3, reverse=True)],
+                         [3, 2, 1, 0])
+        self.assertEqual([k for k, v in index.itemsFrom(reverse=True)],
+                         [4, 3, 2, 1, 0])
+
+
+class TestEncodedUnindex(unittest.TestCase):
+
+    def _makeOne(self, multi=False, data=None):
+        from Products.PluginIndexes.encoding import EncodedUnindex
+        return EncodedUnindex(multi=multi, data=data)
+
+    def _checkOrder(self, unindex):
+        ordinals = [unindex.ordinal(v) for v in unindex._ordinals.keys()]
+        self.assertEqual(ordinals, sorted(ordinals))
+
+    def test_mapping(self):
+        unindex = self._makeOne(data={1: 'b', 2: 'a', 3: 'b'})
+        self.assertEqual(len(unindex), 3)
+        self.assertEqual(unindex[1], 'b')
+        self.assertEqual(unindex.get(4, 'x'), 'x')
+        self.assertTrue(2 in unindex)
+        self.assertEqual(list(unindex.items()), [(1, 'b'), (2, 'a'), (3, 'b')])
+        self.assertEqual(unindex.valueCount(), 2)
+        self.assertLess(unindex.ordinal('a'), unindex.ordinal('b'))
+
+        unindex[1] = 'c'
+        del unindex[3]
+        # unused values stay until they are collected
+        self.assertEqual(unindex.valueCount(), 3)
+        self.assertEqual(unindex.collect(), 1)
+        self.assertEqual(unindex.valueCount(), 2)
+        self.assertIsNone(unindex.ordinal('b'))
+        self.assertRaises(KeyError, unindex.__delitem__, 3)
+        self._checkOrder(unindex)
+
+    def test_multi(self):
+        unindex = self._makeOne(multi=True)
+        unindex[1] = ['b', 'a', 'b']
+        unindex[2] = ('c', 'a')
+        self.assertEqual(unindex[1], ['a', 'b'])
+        del unindex[1]
+        self.assertEqual(unindex.collect(), 1)
+        self.assertIsNone(unindex.ordinal('b'))
+        self.assertEqual(unindex[2], ['a', 'c'])
+
+    def test_renumber(self):
+        from Products.PluginIndexes import encoding
+        unindex = self._makeOne(multi=True)
+        # insert between ever closer neighbours to exhaust the gaps
+        for i in range(40):
+            unindex[i] = [1.0 / (i + 3), 1.0 - 1.0 / (i + 3)]
+        # values without room between their neighbours are appended
+        self.assertFalse(unindex.ordered)
+        rows = dict(unindex.ordinalMap().items())
+        del unindex[0]
+        unindex.collect()
+        self.assertTrue(unindex.ordered)
+        self._checkOrder(unindex)
+        self.assertEqual(unindex.valueCount(), 78)
+        self.assertLessEqual(
+            max(unindex._values.keys()), encoding.ORDINAL_MAX)
+        for i in range(1, 40):
+            self.assertEqual(unindex[i], [1.0 / (i + 3), 1.0 - 1.0 / (i + 3)])
+        self.assertNotEqual(dict(unindex.ordinalMap().items()), rows)
+
+    def test_append_exhausted(self):
+        from Products.PluginIndexes import encoding
+        unindex = self._makeOne()
+        top = encoding.ORDINAL_MAX
+        unindex._ordinals.update({'a': top - 1, 'c': top})
+        unindex._values.update({top - 1: 'a', top: 'c'})
+        unindex._rows.update({1: top - 1, 2: top})
+        # no room between the neighbours nor at the top renumbers
+        unindex[3] = 'b'
+        self.assertEqual([unindex[i] for i in (1, 2, 3)], ['a', 'c', 'b'])
+        self.assertLess(max(unindex._values.keys()), top)
+
+    def test_concurrent_writes(self):
+        import shutil
+        import tempfile
+
+        import transaction
+        from ZODB.DB import DB
+        from ZODB.FileStorage import FileStorage
+
+        from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        db = DB(FileStorage(tmpdir + '/Data.fs'))
+        self.addCleanup(db.close)
+
+        class Dummy:
+            def __init__(self, foo):
+                self.foo = foo
+
+        tm1 = transaction.TransactionManager()
+        conn1 = db.open(transaction_manager=tm1)
+        index = conn1.root()['index'] = FieldIndex(
+            'foo', extra={'dictionary_encoding': True})
+        for i in range(10):
+            index.index_object(i, Dummy('a'))
+        tm1.commit()
+
+        # different documents indexed under the same value
+        tm2 = transaction.TransactionManager()
+        conn2 = db.open(transaction_manager=tm2)
+        conn2.root()['index'].index_object(20, Dummy('a'))
+        index.index_object(21, Dummy('a'))
+        tm2.commit()
+        tm1.commit()
+
+        conn3 = db.open()
+        index = conn3.root()['index']
+        self.assertEqual(index.getEntryForObject(20), 'a')
+        self.assertEqual(index.getEntryForObject(21), 'a')
+        self.assertEqual(len(index._index['a']), 12)
+        transaction.abort()
+        for conn in (conn1, conn2, conn3):
+            conn.close()
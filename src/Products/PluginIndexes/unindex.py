@@ -32,12 +32,16 @@ from ZODB.POSException import ConflictError
 from zope.interface import implementer
 
 from Products.PluginIndexes.cache import RequestCache
+from Products.PluginIndexes.encoding import EncodedUnindex
 from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IQueryIndex
 from Products.PluginIndexes.interfaces import IRequestCacheIndex
 from Products.PluginIndexes.interfaces import ISortIndex
 from Products.PluginIndexes.interfaces import IUniqueValueIndex
 from Products.PluginIndexes.util import safe_callable
+from Products.ZCatalog.plan import DEFAULT_THRESHOLDS
+from Products.ZCatalog.plan import catalog_id
+from Products.ZCatalog.plan import get_thresholds
 from Products.ZCatalog.query import IndexQuery
 
 
@@ -57,6 +61,27 @@ class UnIndex(SimpleItem):
     useOperator = 'or'
     query_options = ()
 
+    # Optional range pyramid for integer keys: pre-unioned document sets
+    # for aligned key spans of `range_bucket_size * range_bucket_fanout **
+    # level`.  A value of 0 disables the structure.  `_range_others`
+    # counts the keys which are not integers, while there are any range
+    # queries walk the forward index.
+    range_bucket_size = 0
+    range_bucket_fanout = 16
+    range_bucket_levels = 4
+    _range_index = None
+    _range_others = None
+
+    # Optional dictionary encoding of the reverse index, see
+    # `setDictionaryEncoding`.  `_multi_valued` is true for indexes storing
+    # a sequence of values per document.
+    dictionary_encoding = False
+    _multi_valued = False
+
+    # Optional per-value document counters, see `setValueCounts`.
+    value_counts = False
+    _value_counts = None
+
     def __init__(self, id, ignore_ex=None, call_methods=None,
                  extra=None, caller=None):
         """Create an unindex
@@ -88,7 +113,12 @@ class UnIndex(SimpleItem):
           'extra' -- a mapping object that keeps additional
           index-related parameters - subitem 'indexed_attrs'
           can be string with comma separated attribute names or
-          a list
+          a list, subitem 'range_bucket_size' enables the range
+          pyramid for integer values (see `setRangeBuckets`),
+          subitem 'dictionary_encoding' enables the dictionary
+          encoding of the reverse index (see `setDictionaryEncoding`),
+          subitem 'value_counts' enables per-value document counters
+          (see `setValueCounts`)
 
           'caller' -- reference to the calling object (usually
           a (Z)Catalog instance
@@ -116,6 +146,16 @@ class UnIndex(SimpleItem):
         if not self.indexed_attrs:
             self.indexed_attrs = [id]
 
+        range_bucket_size = int(_get(extra, 'range_bucket_size', 0) or 0)
+        if range_bucket_size:
+            self.range_bucket_size = range_bucket_size
+
+        if _get(extra, 'dictionary_encoding', False):
+            self.dictionary_encoding = True
+
+        if _get(extra, 'value_counts', False):
+            self.value_counts = True
+
         self.clear()
 
     def __len__(self):
@@ -127,7 +167,9 @@ class UnIndex(SimpleItem):
     def clear(self):
         self._length = Length()
         self._index = OOBTree()
-        self._unindex = IOBTree()
+        self._unindex = self._new_unindex()
+        self._clear_range_index()
+        self._clear_value_counts()
 
         if self._counter is None:
             self._counter = Length()
@@ -142,6 +184,12 @@ class UnIndex(SimpleItem):
         elements found at each point in the index.
         """
         histogram = {}
+        if self._value_counts is not None:
+            for counter in self._value_counts.values():
+                entry = counter()
+                histogram[entry] = histogram.get(entry, 0) + 1
+            return histogram
+
         for item in self._index.items():
             if isinstance(item, int):
                 entry = 1  # "set" length is 1
@@ -174,6 +222,10 @@ class UnIndex(SimpleItem):
                 if not indexRow:
                     del self._index[entry]
                     self._length.change(-1)
+                if self._value_counts is not None:
+                    self._count_remove(entry, not indexRow)
+                if self._range_index is not None:
+                    self._range_remove(entry, documentId, not indexRow)
             except ConflictError:
                 raise
             except AttributeError:
@@ -188,6 +240,10 @@ class UnIndex(SimpleItem):
                     self._length = self.__len__
                     del self.__len__
                 self._length.change(-1)
+                if self._value_counts is not None:
+                    self._count_remove(entry, True)
+                if self._range_index is not None:
+                    self._range_remove(entry, documentId, True)
             except Exception:
                 LOG.error('%(context)s: unindex_object could not remove '
                           'documentId %(doc_id)s from index %(index)r.  This '
@@ -211,22 +267,255 @@ class UnIndex(SimpleItem):
         This will also deal with creating the entire row if necessary.
         """
         indexRow = self._index.get(entry, _marker)
+        new_entry = indexRow is _marker
 
         # Make sure there's actually a row there already. If not, create
         # a set and stuff it in first.
-        if indexRow is _marker:
+        if new_entry:
             # We always use a set to avoid getting conflict errors on
             # multiple threads adding a new row at the same time
             self._index[entry] = IITreeSet((documentId, ))
             self._length.change(1)
+            added = 1
         else:
             try:
-                indexRow.insert(documentId)
+                added = indexRow.insert(documentId)
             except AttributeError:
                 # Inline migration: index row with one element was an int at
                 # first (before Zope 2.13).
                 indexRow = IITreeSet((indexRow, documentId))
                 self._index[entry] = indexRow
+                added = len(indexRow) - 1
+
+        if added and self._value_counts is not None:
+            self._count_insert(entry)
+
+        if self._range_index is not None:
+            self._range_insert(entry, documentId, new_entry)
+
+    def _new_unindex(self, data=None):
+        if self.dictionary_encoding:
+            return EncodedUnindex(multi=self._multi_valued, data=data)
+        unindex = IOBTree()
+        if data is not None:
+            for documentId, value in data.items():
+                unindex[documentId] = value
+        return unindex
+
+    def setDictionaryEncoding(self, flag):
+        """Enable or disable the dictionary encoding of the reverse index.
+
+        With dictionary encoding every distinct value is stored once in a
+        value table and the reverse index only holds integer ordinals,
+        which keeps pickles and the ZODB cache small for indexes with many
+        documents sharing few values.  Ordinals follow the value order.
+        The forward index is not affected.
+        """
+        flag = bool(flag)
+        if flag == isinstance(self._unindex, EncodedUnindex):
+            self.dictionary_encoding = flag
+            return
+        self.dictionary_encoding = flag
+        self._unindex = self._new_unindex(self._unindex)
+
+    def _clear_value_counts(self):
+        if self.value_counts:
+            self._value_counts = OOBTree()
+        else:
+            self._value_counts = None
+
+    def _count_insert(self, entry):
+        counter = self._value_counts.get(entry, None)
+        if counter is None:
+            self._value_counts[entry] = Length(1)
+        else:
+            counter.change(1)
+
+    def _count_remove(self, entry, emptied):
+        if emptied:
+            try:
+                del self._value_counts[entry]
+            except KeyError:
+                pass
+        else:
+            counter = self._value_counts.get(entry, None)
+            if counter is not None:
+                counter.change(-1)
+
+    def setValueCounts(self, flag):
+        """Enable or disable per-value document counters.
+
+        The counters are `Length` objects kept next to the forward index
+        and maintained on every insert and remove.  `Length` resolves
+        concurrent changes without conflicts, and `documentCount`,
+        `uniqueValues(withLengths=True)` and `histogram` answer from them
+        without loading any of the document sets.
+        """
+        self.value_counts = bool(flag)
+        self._clear_value_counts()
+        counts = self._value_counts
+        if counts is None:
+            return
+        for entry, row in self._index.items():
+            if isinstance(row, int):
+                counts[entry] = Length(1)
+            else:
+                counts[entry] = Length(len(row))
+
+    def documentCount(self, value):
+        """Return the number of documents indexed under value."""
+        if self._value_counts is not None:
+            counter = self._value_counts.get(value, None)
+            return counter is not None and counter() or 0
+        row = self._index.get(value, None)
+        if row is None:
+            return 0
+        if isinstance(row, int):
+            return 1
+        return len(row)
+
+    def _clear_range_index(self):
+        if self.range_bucket_size and not self._multi_valued:
+            self._range_index = OOBTree()
+            self._range_others = Length()
+        else:
+            self._range_index = None
+            self._range_others = None
+
+    def _range_buckets(self, entry):
+        """Return the keys of all range pyramid buckets containing entry.
+
+        Only integer values take part in the range pyramid.
+        """
+        if not isinstance(entry, int):
+            return ()
+        span = self.range_bucket_size
+        buckets = []
+        for level in range(self.range_bucket_levels):
+            buckets.append((level, entry // span))
+            span *= self.range_bucket_fanout
+        return buckets
+
+    def _range_insert(self, entry, documentId, new_entry=False):
+        if not isinstance(entry, int):
+            if new_entry:
+                self._range_others.change(1)
+            return
+        tree = self._range_index
+        for bucket in self._range_buckets(entry):
+            row = tree.get(bucket, None)
+            if row is None:
+                tree[bucket] = IITreeSet((documentId, ))
+            else:
+                row.insert(documentId)
+
+    def _range_remove(self, entry, documentId, emptied=False):
+        if not isinstance(entry, int):
+            if emptied:
+                self._range_others.change(-1)
+            return
+        tree = self._range_index
+        for bucket in self._range_buckets(entry):
+            row = tree.get(bucket, None)
+            if row is None:
+                continue
+            try:
+                row.remove(documentId)
+            except KeyError:
+                continue
+            if not row:
+                del tree[bucket]
+
+    def _build_range_index(self):
+        """(Re)build the range pyramid from the forward index."""
+        self._clear_range_index()
+        tree = self._range_index
+        if tree is None:
+            return
+        for entry, row in self._index.items():
+            if not isinstance(entry, int):
+                self._range_others.change(1)
+                continue
+            if isinstance(row, int):
+                row = IISet((row, ))
+            for bucket in self._range_buckets(entry):
+                bucket_row = tree.get(bucket, None)
+                if bucket_row is None:
+                    tree[bucket] = IITreeSet(row)
+                else:
+                    bucket_row.update(row)
+
+    def setRangeBuckets(self, size, fanout=None, levels=None):
+        """Enable, reconfigure or (with a size of 0) disable the range
+        pyramid.
+
+        The range pyramid keeps pre-unioned document sets for aligned spans
+        of `size * fanout ** level` integer keys, so that wide `range`
+        queries union a few bucket sets plus the values at the edges
+        instead of every distinct value in the range.  It is meant for
+        indexes holding a single integer value per document, e.g. a
+        DateIndex (minutes) or a FieldIndex of numbers.  Indexes holding
+        several values per document can't use it, a document would have
+        to be kept in a bucket as long as any of its values is.
+        """
+        if size and self._multi_valued:
+            raise ValueError('the range pyramid needs a single value per '
+                             'document')
+        self.range_bucket_size = int(size or 0)
+        if fanout is not None:
+            self.range_bucket_fanout = int(fanout)
+        if levels is not None:
+            self.range_bucket_levels = int(levels)
+        if self.range_bucket_fanout < 2 or self.range_bucket_levels < 1:
+            raise ValueError('range pyramid needs a fanout of at least 2 '
+                             'and at least one level')
+        self._build_range_index()
+
+    def _range_setlist(self, lo, hi):
+        """Return the sets whose union answers the range [lo, hi] using
+        the range pyramid, or None if the pyramid can't be used.
+        """
+        if self._range_index is None:
+            return None
+        others = self._range_others
+        if others is None or others():
+            # non-integer keys fall between the buckets
+            return None
+        index = self._index
+        if not index:
+            return []
+        if lo is None:
+            lo = index.minKey()
+        if hi is None:
+            hi = index.maxKey()
+        if not isinstance(lo, int) or not isinstance(hi, int):
+            return None
+        setlist = []
+        self._collect_range_sets(
+            lo, hi, self.range_bucket_levels - 1, setlist)
+        return setlist
+
+    def _collect_range_sets(self, lo, hi, level, setlist):
+        while level >= 0 and lo <= hi:
+            span = (self.range_bucket_size *
+                    self.range_bucket_fanout ** level)
+            first = -(-lo // span)
+            last = (hi + 1) // span - 1
+            if first <= last:
+                # the buckets first..last are fully covered, the remaining
+                # edges are handled by the finer levels
+                if lo < first * span:
+                    self._collect_range_sets(
+                        lo, first * span - 1, level - 1, setlist)
+                setlist.extend(self._range_index.values(
+                    (level, first), (level, last)))
+                if (last + 1) * span <= hi:
+                    self._collect_range_sets(
+                        (last + 1) * span, hi, level - 1, setlist)
+                return
+            level -= 1
+        if lo <= hi:
+            setlist.extend(self._index.values(lo, hi))
 
     def index_object(self, documentId, obj, threshold=None):
         """ wrapper to handle indexing of multiple attributes """
@@ -381,6 +670,15 @@ class UnIndex(SimpleItem):
 
         return cache
 
+    def getThreshold(self, name):
+        """Return a strategy threshold of the catalog holding the index."""
+        try:
+            cid = catalog_id(aq_parent(aq_inner(self)))
+        except AttributeError:
+            # not inside a catalog with a physical path
+            return DEFAULT_THRESHOLDS[name]
+        return get_thresholds(cid)[name]
+
     def getRequestCacheKey(self, record, resultset=None):
         """returns an unique key of a search record"""
         params = []
@@ -430,6 +728,27 @@ class UnIndex(SimpleItem):
             return None
         return (self.query_index(record, resultset=resultset), (self.id, ))
 
+    def query_count(self, record):
+        """Return the number of documents matching the IndexQuery record
+        without computing the result set, or None if that isn't cheap.
+
+        Only queries for a single value without further options are
+        answered, from the per-value counters or the length of the value's
+        document set.
+        """
+        if record.keys is None or len(record.keys) != 1:
+            return None
+        for option in ('not', 'range', 'usage'):
+            if record.get(option, None):
+                return None
+        key = self._convert(record.keys[0])
+        if key is None:
+            return 0
+        try:
+            return self.documentCount(key)
+        except TypeError:
+            return None
+
     def query_index(self, record, resultset=None):
         """Search the index with the given IndexQuery object.
 
@@ -534,10 +853,15 @@ class UnIndex(SimpleItem):
                 hi = max(record.keys)
             else:
                 hi = None
-            if hi:
-                setlist = index.values(lo, hi)
-            else:
-                setlist = index.values(lo)
+
+            setlist = None
+            if operator == 'or':
+                setlist = self._range_setlist(lo, hi or None)
+            if setlist is None:
+                if hi:
+                    setlist = index.values(lo, hi)
+                else:
+                    setlist = index.values(lo)
 
             # If we only use one key, intersect and return immediately
             if len(setlist) == 1:
@@ -652,7 +976,20 @@ class UnIndex(SimpleItem):
                 # the various indexes with it and doing the union later is
                 # faster than creating a multiunion first.
 
-                if resultset is not None and len(resultset) < 200:
+                plan = getattr(record, 'plan', None)
+                if resultset is None:
+                    intersect = False
+                elif plan is not None:
+                    intersect = len(resultset) < \
+                        plan.thresholds()['or_intersect_max']
+                else:
+                    intersect = len(resultset) < \
+                        self.getThreshold('or_intersect_max')
+                if plan is not None:
+                    plan.strategy('%s#or' % self.id,
+                                  intersect and 'intersect' or 'union')
+
+                if intersect:
                     smalllist = []
                     for s in setlist:
                         smalllist.append(intersection(resultset, s))
@@ -722,6 +1059,9 @@ class UnIndex(SimpleItem):
         if not withLengths:
             for key in self._index.keys():
                 yield key
+        elif self._value_counts is not None:
+            for key, counter in self._value_counts.items():
+                yield (key, counter())
         else:
             for key, value in self._index.items():
                 if isinstance(value, int):
@@ -729,6 +1069,26 @@ class UnIndex(SimpleItem):
                 else:
                     yield (key, len(value))
 
+    def itemsFrom(self, start=None, reverse=False):
+        """Iterate over (value, document set) pairs in value order,
+        beginning at the value start (inclusive) if it is given.
+
+        With reverse true the values are iterated in descending order.
+        """
+        index = self._index
+        if start is None:
+            items = index.items()
+        elif reverse:
+            items = index.items(max=start)
+        else:
+            items = index.items(min=start)
+        if reverse:
+            items = reversed(items)
+        for value, row in items:
+            if isinstance(row, int):
+                row = IISet((row, ))
+            yield value, row
+
     def keyForDocument(self, id):
         # This method is superseded by documentToKeyMap
         return self._unindex[id]
@@ -188,25 +188,25 @@ class BaseIndex(Persistent):
             # Upgrade document_count to Length object
             self.document_count = Length(self.document_count())
 
-    def search(self, term):
+    def search(self, term, resultset=None):
         wids = self._lexicon.termToWordIds(term)
         if not wids:
             return None  # All docs match
         wids = self._remove_oov_wids(wids)
-        return mass_weightedUnion(self._search_wids(wids))
+        return mass_weightedUnion(self._search_wids(wids, resultset))
 
-    def search_glob(self, pattern):
+    def search_glob(self, pattern, resultset=None):
         wids = self._lexicon.globToWordIds(pattern)
         wids = self._remove_oov_wids(wids)
-        return mass_weightedUnion(self._search_wids(wids))
+        return mass_weightedUnion(self._search_wids(wids, resultset))
 
-    def search_phrase(self, phrase):
+    def search_phrase(self, phrase, resultset=None):
         wids = self._lexicon.termToWordIds(phrase)
         cleaned_wids = self._remove_oov_wids(wids)
         if len(wids) != len(cleaned_wids):
             # At least one wid was OOV:  can't possibly find it.
             return IIBTree()
-        scores = self._search_wids(wids)
+        scores = self._search_wids(wids, resultset)
         hits = mass_weightedIntersection(scores)
         if not hits:
             return hits
@@ -224,11 +224,28 @@ class BaseIndex(Persistent):
     # Subclass must override.
     # The workhorse.  Return a list of (IIBucket, weight) pairs, one pair
     # for each wid t in wids.  The IIBucket, times the weight, maps D to
-    # TF(D,t) * IDF(t) for every docid D containing t.  wids must not
-    # contain any OOV words.
-    def _search_wids(self, wids):
+    # TF(D,t) * IDF(t) for every docid D containing t (and in resultset,
+    # if given).  wids must not contain any OOV words.
+    def _search_wids(self, wids, resultset=None):
         raise NotImplementedError
 
+    def _candidate_items(self, d2w, resultset):
+        # Return the (docid, value) items of the wordinfo mapping d2w,
+        # restricted to the docids in resultset.  Walk whichever of the
+        # two is smaller.
+        if resultset is None:
+            return d2w.items()
+        if len(resultset) < len(d2w):
+            get = d2w.get
+            items = []
+            for docid in resultset:
+                value = get(docid)
+                if value is not None:
+                    items.append((docid, value))
+            return items
+        return [(docid, value) for docid, value in d2w.items()
+                if docid in resultset]
+
     # Subclass must override.
     # It's not clear what it should do.  It must return an upper bound on
     # document scores for the query.  It would be nice if a document score
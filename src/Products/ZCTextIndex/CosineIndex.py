@@ -68,7 +68,7 @@ class CosineIndex(BaseIndex):
     #    W(q) = sqrt(sum(for t in q: w(q, t) ** 2))
     #        computed by self.query_weight()
 
-    def _search_wids(self, wids):
+    def _search_wids(self, wids, resultset=None):
         if not wids:
             return []
         N = float(self.document_count())
@@ -78,7 +78,9 @@ class CosineIndex(BaseIndex):
             assert wid in self._wordinfo  # caller responsible for OOV
             d2w = self._wordinfo[wid]  # maps docid to w(docid, wid)
             idf = inverse_doc_frequency(len(d2w), N)  # an unscaled float
-            if isinstance(d2w, DictType):
+            if resultset is not None:
+                d2w = IIBucket(self._candidate_items(d2w, resultset))
+            elif isinstance(d2w, DictType):
                 d2w = IIBucket(d2w)
             L.append((d2w, scaled_int(idf)))
         return L
@@ -77,7 +77,7 @@ class OkapiIndex(BaseIndex):
             # Opportunistically upgrade _totaldoclen attribute to Length object
             self._totaldoclen = Length(int(self._totaldoclen + delta))
 
-    def _search_wids(self, wids):
+    def _search_wids(self, wids, resultset=None):
         # The workhorse. Return a list of (IIBucket, weight) pairs, one pair
         # for each wid t in wids. The IIBucket, times the weight, maps D to
         # TF(D,t) * IDF(t) for every docid D containing t.
@@ -113,7 +113,7 @@ class OkapiIndex(BaseIndex):
 
             # inner score loop, was implemented in C before
             idf *= 1024.0  # float out part of the scaled_int computation
-            for docid, f in d2f.items():
+            for docid, f in self._candidate_items(d2f, resultset):
                 lenweight = B_from1 + B * docid2len[docid] / meandoclen
                 tf = f * K1_plus1 / (f + K1 * lenweight)
                 result[docid] = int(tf * idf + 0.5)
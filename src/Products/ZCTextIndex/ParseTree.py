@@ -52,7 +52,7 @@ class ParseTreeNode:
             t.extend(v.terms())
         return t
 
-    def executeQuery(self, index):
+    def executeQuery(self, index, resultset=None):
         raise NotImplementedError
 
 
@@ -63,7 +63,7 @@ class NotNode(ParseTreeNode):
     def terms(self):
         return []
 
-    def executeQuery(self, index):
+    def executeQuery(self, index, resultset=None):
         raise QueryError("NOT parse tree node cannot be executed directly")
 
 
@@ -71,12 +71,12 @@ class AndNode(ParseTreeNode):
 
     _nodeType = "AND"
 
-    def executeQuery(self, index):
+    def executeQuery(self, index, resultset=None):
         L = []
         Nots = []
         for subnode in self.getValue():
             if subnode.nodeType() == "NOT":
-                r = subnode.getValue().executeQuery(index)
+                r = subnode.getValue().executeQuery(index, resultset)
                 # If None, technically it matches every doc, but we treat
                 # it as if it matched none (we want
                 #     real_word AND NOT stop_word
@@ -84,7 +84,7 @@ class AndNode(ParseTreeNode):
                 if r is not None:
                     Nots.append((r, 1))
             else:
-                r = subnode.executeQuery(index)
+                r = subnode.executeQuery(index, resultset)
                 # If None, technically it matches every doc, so needn't be
                 # included.
                 if r is not None:
@@ -100,10 +100,10 @@ class OrNode(ParseTreeNode):
 
     _nodeType = "OR"
 
-    def executeQuery(self, index):
+    def executeQuery(self, index, resultset=None):
         weighted = []
         for node in self.getValue():
-            r = node.executeQuery(index)
+            r = node.executeQuery(index, resultset)
             # If None, technically it matches every doc, but we treat
             # it as if it matched none (we want
             #     real_word OR stop_word
@@ -120,21 +120,27 @@ class AtomNode(ParseTreeNode):
     def terms(self):
         return [self.getValue()]
 
-    def executeQuery(self, index):
-        return index.search(self.getValue())
+    def executeQuery(self, index, resultset=None):
+        if resultset is None:
+            return index.search(self.getValue())
+        return index.search(self.getValue(), resultset)
 
 
 class PhraseNode(AtomNode):
 
     _nodeType = "PHRASE"
 
-    def executeQuery(self, index):
-        return index.search_phrase(self.getValue())
+    def executeQuery(self, index, resultset=None):
+        if resultset is None:
+            return index.search_phrase(self.getValue())
+        return index.search_phrase(self.getValue(), resultset)
 
 
 class GlobNode(AtomNode):
 
     _nodeType = "GLOB"
 
-    def executeQuery(self, index):
-        return index.search_glob(self.getValue())
+    def executeQuery(self, index, resultset=None):
+        if resultset is None:
+            return index.search_glob(self.getValue())
+        return index.search_glob(self.getValue(), resultset)
@@ -31,10 +31,12 @@ from OFS.SimpleItem import SimpleItem
 from Persistence import Persistent
 from zope.interface import implementer
 
+from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IPluggableIndex
 from Products.PluginIndexes.interfaces import IQueryIndex
 from Products.PluginIndexes.util import safe_callable
 from Products.ZCatalog.query import IndexQuery
+from Products.ZCTextIndex.BaseIndex import BaseIndex
 from Products.ZCTextIndex.CosineIndex import CosineIndex
 from Products.ZCTextIndex.interfaces import ILexicon
 from Products.ZCTextIndex.interfaces import IZCLexicon
@@ -50,7 +52,7 @@ index_types = {'Okapi BM25 Rank': OkapiIndex,
                'Cosine Measure': CosineIndex}
 
 
-@implementer(IZCTextIndex, IQueryIndex, IPluggableIndex)
+@implementer(IZCTextIndex, ILimitedResultIndex, IQueryIndex, IPluggableIndex)
 class ZCTextIndex(Persistent, Implicit, SimpleItem):
 
     """Persistent text index.
@@ -188,18 +190,23 @@ class ZCTextIndex(Persistent, Implicit, SimpleItem):
         if self.index.has_doc(docid):
             self.index.unindex_doc(docid)
 
-    def _apply_index(self, request):
+    def _apply_index(self, request, resultset=None):
         record = IndexQuery(request, self.id, self.query_options)
         if record.keys is None:
             return None
-        return (self.query_index(record), (self.id, ))
+        return (self.query_index(record, resultset=resultset), (self.id, ))
 
     def query_index(self, record, resultset=None):
         query_str = ' '.join(record.keys)
         if not query_str:
             return None
         tree = QueryParser(self.getLexicon()).parseQuery(query_str)
-        results = tree.executeQuery(self.index)
+        if isinstance(self.index, BaseIndex):
+            # only score the documents which can still be part of the
+            # catalog result
+            results = tree.executeQuery(self.index, resultset)
+        else:
+            results = tree.executeQuery(self.index)
         return results
 
     def getEntryForObject(self, documentId, default=None):
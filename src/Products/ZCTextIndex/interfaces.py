@@ -168,11 +168,14 @@ class IQueryParseTree(Interface):
     def terms():
         """Return a list of all terms in this node, excluding NOT subtrees."""
 
-    def executeQuery(index):
+    def executeQuery(index, resultset=None):
         """Execute the query represented by this node against the index.
 
         The index argument must implement the IIndex interface.
 
+        If not None, only documents in resultset are of interest and the
+        result may be restricted to them.
+
         Return an IIBucket or IIBTree mapping document ids to scores
         (higher scores mean better results).
 
@@ -229,21 +232,25 @@ class IIndex(Interface):
     def get_words(docid):
         """Return a list of wordids for the given docid."""
 
-    def search(term):
+    def search(term, resultset=None):
         """Execute a search on a single term given as a string.
 
         Return an IIBTree mapping docid to score, or None if all docs
         match due to the lexicon returning no wids for the term (e.g.,
         if the term is entirely composed of stopwords).
+
+        If not None, only docids in resultset are scored and returned.
         """
 
-    def search_phrase(phrase):
+    def search_phrase(phrase, resultset=None):
         """Execute a search on a phrase given as a string.
 
         Return an IIBtree mapping docid to score.
+
+        If not None, only docids in resultset are scored and returned.
         """
 
-    def search_glob(pattern):
+    def search_glob(pattern, resultset=None):
         """Execute a pattern search.
 
         The pattern represents a set of words by using * and ?.  For
@@ -251,6 +258,8 @@ class IIndex(Interface):
         starting with "foo".
 
         Return an IIBTree mapping docid to score.
+
+        If not None, only docids in resultset are scored and returned.
         """
 
     def query_weight(terms):
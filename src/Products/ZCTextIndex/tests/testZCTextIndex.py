@@ -305,11 +305,13 @@ class CosineIndexTests(ZCIndexTestsBase, testIndex.CosineIndexTest):
     def test_z3interfaces(self):
         from zope.interface.verify import verifyClass
 
+        from Products.PluginIndexes.interfaces import ILimitedResultIndex
         from Products.PluginIndexes.interfaces import IPluggableIndex
         from Products.ZCTextIndex.interfaces import IZCTextIndex
 
         verifyClass(IPluggableIndex, ZCTextIndex)
         verifyClass(IZCTextIndex, ZCTextIndex)
+        verifyClass(ILimitedResultIndex, ZCTextIndex)
 
     def testRanking(self):
         self.words = ['cold', 'days', 'eat', 'hot', 'lot', 'nine', 'old',
@@ -606,6 +608,21 @@ class QueryTestsBase:
         dictkeys.sort()
         self.assertEqual(setkeys, dictkeys)
 
+    def testQueryIndexResultset(self):
+        from BTrees.IIBTree import IISet
+
+        from Products.ZCatalog.query import IndexQuery
+        resultset = IISet([2, 3])
+        for query in ('ham', 'foo AND ham', 'foo OR bar', 'ham AND NOT foo',
+                      '"bar ham"', 'fo*'):
+            record = IndexQuery({'name': query}, 'name')
+            full = self.zc_index.query_index(record)
+            record = IndexQuery({'name': query}, 'name')
+            limited = self.zc_index.query_index(record, resultset)
+            self.assertEqual(
+                dict(limited.items()),
+                {k: v for k, v in full.items() if k in resultset}, query)
+
 
 class CosineQueryTests(QueryTestsBase,
                        testQueryEngine.TestQueryEngine,
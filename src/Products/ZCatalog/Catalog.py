@@ -11,10 +11,18 @@
 #
 ##############################################################################
 
+import base64
+import json
 import logging
+import time
 from bisect import bisect
 from collections import defaultdict
+from datetime import date
+from datetime import datetime
 from functools import cmp_to_key
+from heapq import nlargest
+from heapq import nsmallest
+from itertools import islice
 from operator import itemgetter
 from random import randint
 
@@ -24,10 +32,12 @@ import ExtensionClass
 from Acquisition import aq_base
 from Acquisition import aq_parent
 from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
 from BTrees.IIBTree import intersection
 from BTrees.IIBTree import weightedIntersection
 from BTrees.IOBTree import IOBTree
 from BTrees.OIBTree import OIBTree
+from DateTime.DateTime import DateTime
 from Missing import MV
 from Persistence import Persistent
 from ZTUtils.Lazy import LazyCat
@@ -36,17 +46,31 @@ from ZTUtils.Lazy import LazyValues
 
 from Products.PluginIndexes.interfaces import ILimitedResultIndex
 from Products.PluginIndexes.interfaces import IQueryIndex
+from Products.PluginIndexes.interfaces import IRequestCacheIndex
 from Products.PluginIndexes.interfaces import ITransposeQuery
 from Products.PluginIndexes.util import safe_callable
+from Products.ZCatalog.calibration import calibrate
 from Products.ZCatalog.CatalogBrains import AbstractCatalogBrain
 from Products.ZCatalog.CatalogBrains import NoBrainer
 from Products.ZCatalog.plan import CatalogPlan
+from Products.ZCatalog.plan import PriorityMap
+from Products.ZCatalog.plan import catalog_id
+from Products.ZCatalog.plan import get_thresholds
+from Products.ZCatalog.prefetch import prefetch_query
+from Products.ZCatalog.prepared import PreparedQuery
 from Products.ZCatalog.ProgressHandler import ZLogHandler
 from Products.ZCatalog.query import IndexQuery
+from Products.ZCatalog.telemetry import IndexingTelemetry
 
 
 LOG = logging.getLogger('Zope.ZCatalog')
 
+# Facet counts are computed by intersecting the result set with the
+# document set of every value while that is estimated to be cheaper than
+# looking up the value of every result.  One value lookup is assumed to
+# cost as much as this many steps of a set intersection.
+FACET_LOOKUP_COST = 64
+
 
 class CatalogError(Exception):
     pass
@@ -275,11 +299,14 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         """ get an index wrapped in the catalog """
         return self.indexes[name].__of__(self)
 
-    def updateMetadata(self, object, uid, index):
+    def updateMetadata(self, object, uid, index, telemetry=None):
         """ Given an object and a uid, update the column data for the
         uid with the object data iff the object has changed """
+        if telemetry is not None:
+            start = telemetry.start()
+            outcome = 'unchanged'
         data = self.data
-        newDataRecord = self.recordify(object)
+        newDataRecord = self.recordify(object, telemetry=telemetry)
 
         if index is None:
             index = getattr(self, '_v_nextid', 0)
@@ -297,9 +324,13 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             # further reduces conflict and reduces churn in
             # here and it result sets when bulk indexing.
             self._v_nextid = index + 1
+            outcome = 'new'
         else:
             if data.get(index, 0) != newDataRecord:
                 data[index] = newDataRecord
+                outcome = 'changed'
+        if telemetry is not None:
+            telemetry.stop('metadata', 'record', start, outcome, self)
         return index
 
     # the cataloging API
@@ -324,17 +355,24 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         if idxs is None:
             idxs = []
 
+        telemetry = self.getIndexingTelemetry()
         index = self.uids.get(uid, None)
+        new = index is None
 
         if index is None:
             # we are inserting new data
-            index = self.updateMetadata(object, uid, None)
+            index = self.updateMetadata(object, uid, None,
+                                        telemetry=telemetry)
+            if telemetry is not None:
+                start = telemetry.start()
             self._length.change(1)
             self.uids[uid] = index
             self.paths[index] = uid
+            if telemetry is not None:
+                telemetry.stop('catalog', 'uids', start, owner=self)
         elif update_metadata:
             # we are updating and we need to update metadata
-            self.updateMetadata(object, uid, index)
+            self.updateMetadata(object, uid, index, telemetry=telemetry)
 
         # do indexing
         total = 0
@@ -359,7 +397,17 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         for name in use_indexes:
             x = self.getIndex(name)
             if hasattr(x, 'index_object'):
+                if telemetry is not None:
+                    start = telemetry.start()
                 blah = x.index_object(index, object, threshold)
+                if telemetry is not None:
+                    if new:
+                        outcome = 'new'
+                    elif blah:
+                        outcome = 'changed'
+                    else:
+                        outcome = 'unchanged'
+                    telemetry.stop('index', name, start, outcome, x)
                 total = total + blah
             else:
                 LOG.error('catalogObject was passed bad index '
@@ -385,14 +433,23 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         rid = uids.get(uid, None)
 
         if rid is not None:
+            telemetry = self.getIndexingTelemetry()
             for name in indexes:
                 x = self.getIndex(name)
                 if hasattr(x, 'unindex_object'):
+                    if telemetry is not None:
+                        start = telemetry.start()
                     x.unindex_object(rid)
+                    if telemetry is not None:
+                        telemetry.stop('unindex', name, start, owner=x)
+            if telemetry is not None:
+                start = telemetry.start()
             del data[rid]
             del paths[rid]
             del uids[uid]
             self._length.change(-1)
+            if telemetry is not None:
+                telemetry.stop('catalog', 'uids', start, owner=self)
 
         else:
             LOG.error('uncatalogObject unsuccessfully '
@@ -407,15 +464,19 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         """ return the rid if catalog contains an object with uid """
         return self.uids.get(uid)
 
-    def recordify(self, object):
+    def recordify(self, object, telemetry=None):
         """ turns an object into a record tuple """
         record = []
         # the unique id is always the first element
         for x in self.names:
+            if telemetry is not None:
+                start = telemetry.start()
             attr = getattr(object, x, MV)
             if (attr is not MV and safe_callable(attr)):
                 attr = attr()
             record.append(attr)
+            if telemetry is not None:
+                telemetry.stop('column', x, start)
         return tuple(record)
 
     def _maintain_zodb_cache(self):
@@ -543,7 +604,7 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             sequence.reverse()
         return (sequence, slen)
 
-    def _search_index(self, cr, index_id, query, rs):
+    def _search_index(self, cr, index_id, query, rs, index_query=None):
         cr.start_split(index_id)
 
         index_rs = None
@@ -551,9 +612,12 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         limit_result = ILimitedResultIndex.providedBy(index)
 
         if IQueryIndex.providedBy(index):
-            index_query = IndexQuery(query, index.id, index.query_options,
-                                     index.operators, index.useOperator)
+            if index_query is None:
+                index_query = IndexQuery(query, index.id,
+                                         index.query_options,
+                                         index.operators, index.useOperator)
             if index_query.keys is not None:
+                index_query.plan = cr
                 index_rs = index.query_index(index_query, rs)
         else:
             if limit_result:
@@ -572,13 +636,7 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             # Provide detailed info about the pure intersection time.
             intersect_id = index_id + '#intersection'
             cr.start_split(intersect_id)
-            # weightedIntersection preserves the values from any mappings
-            # we get, as some indexes don't return simple sets.
-            if hasattr(rs, 'items') or hasattr(index_rs, 'items'):
-                _, rs = weightedIntersection(rs, index_rs)
-            else:
-                rs = intersection(rs, index_rs)
-
+            rs = _intersect_results(rs, index_rs)
             cr.stop_split(intersect_id)
 
         # Consider the time it takes to intersect the index result
@@ -587,8 +645,46 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
 
         return rs
 
+    def _search_indexes(self, cr, query):
+        # Apply all indexes of the query plan, return the raw result set.
+        plan = cr.plan()
+        if not plan:
+            plan = self._sorted_search_indexes(query)
+        if cr.prefetch:
+            prefetch_query(self, plan, query)
+
+        rs = None  # result set
+        for index_id in plan:
+            # The actual core loop over all indices.
+            if index_id not in self.indexes:
+                # We can have bogus keys or the plan can contain index names
+                # that have been removed in the meantime.
+                continue
+
+            rs = self._search_index(cr, index_id, query, rs)
+            if not rs:
+                break
+        return rs
+
+    def _count_shortcut(self, query):
+        # Return the number of results if a single index can tell it
+        # without computing the result set, otherwise None.
+        plan = self._sorted_search_indexes(query)
+        if len(plan) != 1:
+            return None
+        index = self.getIndex(plan[0])
+        if not IQueryIndex.providedBy(index) or \
+                not hasattr(index, 'query_count'):
+            return None
+        index_query = IndexQuery(query, index.id, index.query_options,
+                                 index.operators, index.useOperator)
+        if index_query.keys is None:
+            return None
+        return index.query_count(index_query)
+
     def search(self, query,
-               sort_index=None, reverse=False, limit=None, merge=True):
+               sort_index=None, reverse=False, limit=None, merge=True,
+               count_only=False, rids_only=False):
         """Iterate through the indexes, applying the query to each one. If
         merge is true then return a lazy result set (sorted if appropriate)
         otherwise return the raw (possibly scored) results for later merging.
@@ -596,7 +692,11 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
         the catalog how many results you are really interested in. The catalog
         can then use optimizations to save time and memory. The number of
         results is not guaranteed to fall within the limit however, you should
-        still slice or batch the results as usual."""
+        still slice or batch the results as usual.
+
+        If count_only is true only the number of results is returned, if
+        rids_only is true an unsorted IISet of the record ids.  Both skip
+        sorting and the creation of brains."""
 
         # Indexes fulfill a fairly large contract here. We hand each
         # index the query mapping we are given (which may be composed
@@ -611,26 +711,39 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
 
         cr = self.getCatalogPlan(query)
         cr.start()
-
-        plan = cr.plan()
-        if not plan:
-            plan = self._sorted_search_indexes(query)
-
-        rs = None  # result set
-        for index_id in plan:
-            # The actual core loop over all indices.
-            if index_id not in self.indexes:
-                # We can have bogus keys or the plan can contain index names
-                # that have been removed in the meantime.
-                continue
-
-            rs = self._search_index(cr, index_id, query, rs)
+        try:
+            if count_only:
+                count = self._count_shortcut(query)
+                if count is not None:
+                    cr.stop()
+                    return count
+
+            rs = self._search_indexes(cr, query)
+            return self._search_result(cr, query, rs, sort_index, reverse,
+                                       limit, merge, count_only, rids_only)
+        except BaseException:
+            cr.abort()
+            raise
+
+    def _search_result(self, cr, query, rs, sort_index, reverse, limit,
+                       merge, count_only=False, rids_only=False):
+        # Turn the raw result set of the indexes into the search result and
+        # stop the query plan.
+        if count_only or rids_only:
+            cr.stop()
+            if count_only:
+                return rs and len(rs) or 0
             if not rs:
-                break
+                return IISet()
+            if not isinstance(rs, IISet):
+                rs = IISet(rs)
+            return rs
 
         if not rs:
             # None of the indexes found anything to do with the query.
             result = LazyCat([])
+            if 'search_after' in query:
+                result.next_search_after = None
             cr.stop()
             return result
 
@@ -640,6 +753,20 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
 
         # We got some results from the indexes, sort and convert to sequences.
         rlen = len(rs)
+        if 'search_after' in query:
+            # Keyset pagination, only the next batch is collected.
+            if sort_index is None and hasattr(rs, 'items'):
+                raise CatalogError(
+                    'search_after needs sort_on for results ranked by '
+                    'relevance')
+            cr.start_split(sort_report_name or 'search_after')
+            result = self._search_after(
+                rs, sort_index, reverse, b_size or limit,
+                query['search_after'], rlen, plan=cr)
+            cr.stop_split(sort_report_name or 'search_after', None)
+            cr.stop()
+            return result
+
         if sort_index is None and hasattr(rs, 'items'):
             # Having a 'items' means we have a data structure with
             # scores. Build a new result set, sort it by score, reverse
@@ -694,7 +821,8 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             cr.start_split(sort_report_name)
             result = self.sortResults(
                 rs, sort_index, reverse, limit, merge,
-                actual_result_count=rlen, b_start=b_start, b_size=b_size)
+                actual_result_count=rlen, b_start=b_start, b_size=b_size,
+                plan=cr)
             cr.stop_split(sort_report_name, None)
 
         cr.stop()
@@ -914,14 +1042,254 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
 
         return (actual_result_count, 0, result)
 
+    def facets(self, rs, index_names, limit=None):
+        """Count the documents of the result set rs per value of each of
+        the indexes named in index_names.
+
+        rs is a set (or scored mapping) of record ids, e.g. as returned by
+        the indexes.  Returns a mapping of index name to a list of
+        (value, count) tuples ordered by descending count, limited to the
+        `limit` most frequent values if given.  Values not occurring in rs
+        are left out.  No brains are created.
+        """
+        return self._facets(rs, index_names, limit)
+
+    def _facets(self, rs, index_names, limit=None, query_key=None):
+        # The counts are kept in the request cache if query_key identifies
+        # the result set, see `_query_key`.
+        if isinstance(index_names, str):
+            index_names = [index_names]
+        if not rs:
+            rs = IISet()
+        elif hasattr(rs, 'keys'):
+            rs = rs.keys()
+        if not isinstance(rs, (IISet, IITreeSet)):
+            rs = IISet(rs)
+
+        result = {}
+        for name in index_names:
+            if name not in self.indexes:
+                raise CatalogError(f'Unknown index {name!r}')
+            index = self.getIndex(name)
+            if not hasattr(index, 'documentToKeyMap'):
+                raise CatalogError(
+                    f'The index {name!r} cannot be used for facets')
+
+            cache = None
+            if query_key is not None and \
+                    IRequestCacheIndex.providedBy(index):
+                cache = index.getRequestCache()
+            if cache is not None:
+                cachekey = ('_facets', index.getId(), index.getCounter(),
+                            query_key)
+                counts = cache.get(cachekey, None)
+                if counts is None:
+                    counts = cache[cachekey] = self._facet_counts(index, rs)
+            else:
+                counts = self._facet_counts(index, rs)
+
+            if limit is None:
+                result[name] = sorted(counts, key=itemgetter(1),
+                                      reverse=True)
+            else:
+                result[name] = nlargest(limit, counts, key=itemgetter(1))
+        return result
+
+    def _facet_counts(self, index, rs):
+        # Return a list of (value, count) tuples in value order.
+        rlen = len(rs)
+        if not rlen:
+            return []
+
+        if (hasattr(index, 'items') and
+                len(index) * rlen + len(self) < FACET_LOOKUP_COST * rlen):
+            # few values compared to the result set size
+            key_map = index.documentToKeyMap()
+            counts = []
+            for value, docids in index.items():
+                hits = intersection(rs, docids)
+                if hits:
+                    # report the value as stored for the documents like
+                    # the lookup below does, e.g. 1 not True
+                    stored = key_map.get(hits.minKey(), value)
+                    if not isinstance(stored, list):
+                        value = stored
+                    counts.append((value, len(hits)))
+            return counts
+
+        counts = {}
+        key_map = index.documentToKeyMap()
+        for rid in rs:
+            value = key_map.get(rid, None)
+            if value is None:
+                continue
+            # multi valued indexes like the KeywordIndex store lists
+            if not isinstance(value, list):
+                value = (value, )
+            for v in value:
+                counts[v] = counts.get(v, 0) + 1
+        try:
+            return sorted(counts.items())
+        except TypeError:
+            # values of different types
+            return list(counts.items())
+
+    def _search_after(self, rs, sort_index, reverse, b_size, token,
+                      actual_result_count, plan=None):
+        # Return the b_size results following the position encoded in token
+        # in (sort keys, rid) order.  The result has a `next_search_after`
+        # attribute holding the token for the next batch or None.  The
+        # chosen algorithm is recorded in the query plan, if one is passed.
+        if not b_size:
+            raise ValueError('search_after needs b_size or sort_limit')
+        if sort_index is None:
+            sort_indexes = []
+        elif isinstance(sort_index, list):
+            sort_indexes = sort_index
+        else:
+            sort_indexes = [sort_index]
+        if not isinstance(reverse, list):
+            reverse = [reverse]
+        reverse = [bool(r) for r in reverse][:len(sort_indexes)]
+        reverse += [reverse and reverse[0] or False] * (
+            len(sort_indexes) - len(reverse))
+        names = [i.getId() for i in sort_indexes]
+        cursor = _decode_search_after(token, names, reverse)
+
+        if hasattr(rs, 'keys'):
+            rs = rs.keys()
+        if not isinstance(rs, (IISet, IITreeSet)):
+            rs = IISet(rs)
+
+        if not sort_indexes:
+            # result sets are ordered by rid
+            if cursor is None:
+                rids = rs.keys()
+            else:
+                rids = rs.keys(min=cursor[1], excludemin=True)
+            result = [((), rid) for rid in islice(rids, b_size)]
+        else:
+            result = self._search_after_sorted(
+                rs, sort_indexes, reverse, b_size, cursor, plan)
+
+        next_token = None
+        if len(result) == b_size:
+            keys, rid = result[-1]
+            next_token = _encode_search_after(names, reverse, keys, rid)
+        rids = [rid for keys, rid in result]
+        result = LazyMap(self.__getitem__, rids, len(rids),
+                         actual_result_count=actual_result_count)
+        result.next_search_after = next_token
+        return result
+
+    def _search_after_sorted(self, rs, sort_indexes, reverse, b_size,
+                             cursor, plan=None):
+        primary = sort_indexes[0]
+        items_from = getattr(primary, 'itemsFrom', None)
+        if items_from is None:
+            raise CatalogError(
+                'The index %r cannot be used with search_after' %
+                primary.getId())
+        key_maps = [i.documentToKeyMap() for i in sort_indexes[1:]]
+        sort_spec = [r and -1 or 1 for r in reverse]
+
+        def comparer(left, right):
+            # compare ((keys), rid) entries, rids follow the first index
+            for a, b, order in zip(left[0], right[0], sort_spec):
+                if a == b:
+                    continue
+                if a is None:
+                    return -order
+                if b is None:
+                    return order
+                return order * ((a > b) - (a < b))
+            return sort_spec[0] * ((left[1] > right[1]) -
+                                   (left[1] < right[1]))
+
+        rlen = len(rs)
+        if rlen * rlen < len(primary) * b_size:
+            # Walking the index passes about len(primary) * b_size / rlen
+            # sort values before the batch is full, with many distinct
+            # values compared to the result size sorting the result set
+            # after the cursor is cheaper.
+            if plan is not None:
+                plan.strategy('sort_on', 'search_after_resultset')
+            key_map = primary.documentToKeyMap()
+            entries = []
+            for rid in rs:
+                key = key_map.get(rid, None)
+                if key is None:
+                    # not in the index, so never returned by itemsFrom
+                    continue
+                keys = (key, )
+                for km in key_maps:
+                    keys += (km.get(rid, None), )
+                entries.append((keys, rid))
+            if cursor is not None:
+                entries = [e for e in entries if comparer(e, cursor) > 0]
+            return nsmallest(b_size, entries, key=cmp_to_key(comparer))
+
+        if plan is not None:
+            plan.strategy('sort_on', 'search_after_index')
+        start = None
+        if cursor is not None:
+            start = cursor[0][0]
+        result = []
+        for key, docids in items_from(start, reverse=reverse[0]):
+            if len(docids) * 8 < rlen:
+                hits = [rid for rid in docids if rid in rs]
+            else:
+                hits = intersection(rs, docids)
+            if not hits:
+                continue
+            entries = []
+            for rid in hits:
+                keys = (key, )
+                for km in key_maps:
+                    keys += (km.get(rid, None), )
+                entries.append((keys, rid))
+            entries.sort(key=cmp_to_key(comparer))
+            if cursor is not None and key == start:
+                entries = [e for e in entries if comparer(e, cursor) > 0]
+            result.extend(entries[:b_size - len(result)])
+            if len(result) >= b_size:
+                break
+        return result
+
+    def _sort_strategy(self, rlen, sort_index, sort_index_length, limit,
+                       merge, first_reverse, thresholds):
+        # Choose one of the sort algorithms, return it and the reason.
+        if merge and limit is None and (
+                rlen > (len(sort_index) *
+                        (rlen / thresholds['sort_index_ratio'] + 1))):
+            return (self._sort_iterate_index,
+                    'few distinct sort values for the result size')
+        if limit is None:
+            return (self._sort_iterate_resultset, 'no limit')
+        if sort_index_length > 1:
+            return (self._sort_iterate_resultset, 'several sort indexes')
+        if limit * thresholds['sort_nbest_factor'] > rlen:
+            return (self._sort_iterate_resultset,
+                    'limit close to the result size')
+        if first_reverse:
+            return (self._sort_nbest, 'limit small compared to the result')
+        return (self._sort_nbest_reverse,
+                'limit small compared to the result')
+
     def sortResults(self, rs, sort_index,
                     reverse=False, limit=None, merge=True,
-                    actual_result_count=None, b_start=0, b_size=None):
+                    actual_result_count=None, b_start=0, b_size=None,
+                    plan=None):
         # Sort a result set using one or more sort indexes. Both sort_index
         # and reverse can be lists of indexes and reverse specifications.
         # Return a lazy result set in sorted order if merge is true otherwise
         # returns a list of (sortkey, uid, getter_function) tuples, where
-        # sortkey can be a tuple on its own.
+        # sortkey can be a tuple on its own. The chosen algorithm is
+        # recorded in the query plan, if one is passed.
+        if plan is None:
+            thresholds = get_thresholds(catalog_id(self))
+        else:
+            thresholds = plan.thresholds()
         second_indexes = None
         second_indexes_key_map = None
         sort_index_length = 1
@@ -982,20 +1350,14 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
                 sort_spec.append(reverse and -1 or 1)
             first_reverse = reverse
 
-        # Special first condition, as it changes post-processing.
-        iterate_sort_index = (
-            merge and limit is None and (
-                rlen > (len(sort_index) * (rlen / 100 + 1))))
-
         # Choose one of the sort algorithms.
-        if iterate_sort_index:
-            sort_func = self._sort_iterate_index
-        elif limit is None or (limit * 4 > rlen) or sort_index_length > 1:
-            sort_func = self._sort_iterate_resultset
-        elif first_reverse:
-            sort_func = self._sort_nbest
-        else:
-            sort_func = self._sort_nbest_reverse
+        sort_func, reason = self._sort_strategy(
+            rlen, sort_index, sort_index_length, limit, merge,
+            first_reverse, thresholds)
+        # Special first condition, as it changes post-processing.
+        iterate_sort_index = sort_func == self._sort_iterate_index
+        if plan is not None:
+            plan.strategy('sort_on', sort_func.__name__.lstrip('_'))
 
         actual_result_count, length, result = sort_func(
             actual_result_count, result, rs,
@@ -1061,10 +1423,22 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             return sort_indexes
         return None
 
-    def searchResults(self, query=None, _merge=True, **kw):
+    def searchResults(self, query=None, _merge=True, count_only=False,
+                      rids_only=False, **kw):
         # You should pass in a simple dictionary as the first argument,
         # which only contains the relevant query.
         query = self.merge_query_args(query, **kw)
+        if count_only or rids_only:
+            return self.search(query, count_only=count_only,
+                               rids_only=rids_only)
+        sort_indexes, reverse, sort_limit = self._sort_arguments(query)
+        # Perform searches with indexes and sort_index
+        return self.search(query, sort_indexes, reverse, sort_limit, _merge)
+
+    __call__ = searchResults
+
+    def _sort_arguments(self, query):
+        # Return the sort indexes, sort order and sort limit of a query.
         sort_indexes = self._getSortIndex(query)
         sort_limit = self._get_sort_attr('limit', query)
         reverse = False
@@ -1080,17 +1454,393 @@ class Catalog(Persistent, Acquisition.Implicit, ExtensionClass.Base):
             if len(reverse) == 1:
                 # be nice and keep the old API intact for single sort_order
                 reverse = reverse[0]
-        # Perform searches with indexes and sort_index
-        return self.search(query, sort_indexes, reverse, sort_limit, _merge)
+        return (sort_indexes, reverse, sort_limit)
+
+    def _clause_signature(self, index_id, query):
+        # Return a hashable key for the part of query used by an index or
+        # None if the clause can't be compared.
+        index = self.indexes[index_id]
+        parts = []
+        for name in self._get_index_query_names(index):
+            for key, value in query.items():
+                if key == name or key.startswith(name + '_'):
+                    parts.append((key, value))
+        try:
+            return (index_id, _freeze(sorted(parts)))
+        except TypeError:
+            return None
 
-    __call__ = searchResults
+    def prepare(self, query):
+        """Return a `PreparedQuery` for the given query shape.
+
+        Keys with a value of None (or a dictionary with a 'query' of None)
+        are parameters bound on every execution, e.g.
+        `catalog.prepare({'portal_type': None})(portal_type='Document')`.
+        """
+        return PreparedQuery(self, query)
+
+    def searchMany(self, queries, _merge=True):
+        """Search the catalog with several queries at once and return a
+        list of results in the same order.
+
+        Index clauses which are identical in two or more queries are
+        evaluated only once, as is the intersection of the shared clauses
+        of a query.  The remaining clauses, sorting and batching are done
+        per query, each with its own query plan and time reporting.
+        """
+        prepared = []
+        counts = defaultdict(int)
+        for query in queries:
+            query = self.make_query(self.merge_query_args(query))
+            cr = self.getCatalogPlan(query)
+            plan = cr.plan()
+            if not plan:
+                plan = self._sorted_search_indexes(query)
+            plan = [i for i in plan if i in self.indexes]
+            signatures = [self._clause_signature(i, query) for i in plan]
+            for signature in set(signatures):
+                if signature is not None:
+                    counts[signature] += 1
+            prepared.append((query, cr, plan, signatures))
+
+        shared_results = {}
+        prefixes = {}
+        results = []
+        try:
+            for query, cr, plan, signatures in prepared:
+                cr.start()
+                shared = []
+                rest = []
+                for index_id, signature in zip(plan, signatures):
+                    if signature is not None and counts[signature] > 1:
+                        shared.append((index_id, signature))
+                    else:
+                        rest.append(index_id)
+
+                prefix = frozenset(signature for index_id, signature in shared)
+                if prefix in prefixes:
+                    rs = prefixes[prefix]
+                else:
+                    rs = None
+                    for index_id, signature in shared:
+                        if signature in shared_results:
+                            index_rs = shared_results[signature]
+                        else:
+                            # evaluated without a limiting result set, so the
+                            # result can be used by all queries
+                            index_rs = self._search_index(
+                                cr, index_id, query, None)
+                            shared_results[signature] = index_rs
+                        if not index_rs:
+                            rs = None
+                            break
+                        rs = _intersect_results(rs, index_rs)
+                        if not rs:
+                            break
+                    prefixes[prefix] = rs
+
+                if not shared or rs:
+                    for index_id in rest:
+                        rs = self._search_index(cr, index_id, query, rs)
+                        if not rs:
+                            break
+
+                sort_indexes, reverse, sort_limit = self._sort_arguments(query)
+                results.append(self._search_result(
+                    cr, query, rs, sort_indexes, reverse, sort_limit, _merge))
+        except BaseException:
+            cr.abort()
+            raise
+        return results
+
+    def searchFacets(self, query, index_names, limit=None):
+        """Run the query and return the facet counts of its result for
+        the indexes in index_names, see `facets`.
+        """
+        query = self.make_query(query)
+        cr = self.getCatalogPlan(query)
+        cr.start()
+        try:
+            rs = self._search_indexes(cr, query)
+        except BaseException:
+            cr.abort()
+            raise
+        cr.stop()
+        return self._facets(rs, index_names, limit, self._query_key(query))
+
+    def _query_key(self, query):
+        # Return a key for the result set of a canonical query which changes
+        # with every change to the indexes searched, or None if one of them
+        # has no change counter.
+        counters = []
+        for name in self._sorted_search_indexes(query):
+            get_counter = getattr(self.getIndex(name), 'getCounter', None)
+            if get_counter is None:
+                return None
+            counters.append((name, get_counter()))
+        return (repr(sorted(query.items(), key=itemgetter(0))),
+                tuple(counters))
+
+    def explain(self, query, analyze=False):
+        """Describe how a query is executed.
+
+        Returns a dict with the canonical query, its plan key, the index
+        order and whether it comes from the benchmarks of earlier queries
+        or the default order, a step per index and the sort strategy.
+        Each step holds the query record, whether the request cache holds
+        the index result and the result set size before and after the
+        index.  The index clauses are evaluated to get these sizes, the
+        sort strategy is predicted from the result size.
+
+        If analyze is true, every step is timed, the objects loaded from
+        the ZODB are counted and the results are sorted.  Durations are
+        provided in millisecond.  The query plan isn't updated either way.
+        """
+        query = self.make_query(query)
+        parent = aq_base(aq_parent(self))
+        threshold = getattr(parent, 'long_query_time', 0.1)
+        cr = CatalogPlan(self, query, threshold, loads=analyze)
+        benchmark = PriorityMap.value.get(cr.cid, {}).get(cr.key) or {}
+
+        plan = cr.plan()
+        source = 'benchmark'
+        if not plan:
+            plan = self._sorted_search_indexes(query)
+            source = 'default'
+
+        cr.start()
+        steps = []
+        rs = None
+        for index_id in plan:
+            if index_id not in self.indexes:
+                continue
+            index = self.getIndex(index_id)
+            step = {
+                'index': index_id,
+                'limited': ILimitedResultIndex.providedBy(index),
+                'record': None,
+                'cached': None,
+                'benchmark': None,
+                'input': None if rs is None else len(rs),
+            }
+            if index_id in benchmark:
+                step['benchmark'] = {
+                    'duration': benchmark[index_id].duration * 1000,
+                    'hits': benchmark[index_id].hits,
+                }
+
+            record = None
+            if IQueryIndex.providedBy(index):
+                record = IndexQuery(query, index.id, index.query_options,
+                                    index.operators, index.useOperator)
+                if record.keys is not None:
+                    step['record'] = _describe_record(record)
+                    if IRequestCacheIndex.providedBy(index):
+                        cache = index.getRequestCache()
+                        if cache is not None:
+                            key = index.getRequestCacheKey(record, rs)
+                            step['cached'] = key in cache
+
+            first = len(cr.res)
+            rs = self._search_index(cr, index_id, query, rs,
+                                    index_query=record)
+            step['output'] = len(rs) if rs else 0
+            if analyze:
+                for measurement in cr.res[first:]:
+                    name = 'duration'
+                    if measurement.name != index_id:
+                        name = 'intersection'
+                    step[name] = measurement.duration * 1000
+                    if measurement.loads is not None:
+                        step[name + '_loads'] = measurement.loads._asdict()
+            steps.append(step)
+            if not rs:
+                break
+
+        result = {
+            'query': query,
+            'key': cr.key,
+            'source': source,
+            'order': [step['index'] for step in steps],
+            'steps': steps,
+            'result': len(rs) if rs else 0,
+            'sort': self._explain_sort(cr, query, rs, analyze),
+        }
+        if analyze:
+            result['duration'] = (
+                time.perf_counter_ns() - cr.start_time) / 1e6
+            loads = cr._loads_since(cr.start_loads)
+            if loads is not None:
+                result['loads'] = loads._asdict()
+        return result
+
+    def _explain_sort(self, cr, query, rs, analyze):
+        # Describe the sort strategy for the result set rs of a query.
+        sort_indexes, reverse, sort_limit = self._sort_arguments(query)
+        if not rs:
+            return None
+        if sort_indexes is None:
+            if hasattr(rs, 'items'):
+                return {'indexes': [], 'strategy': 'score',
+                        'reason': 'ranked result without sort index'}
+            return None
+
+        b_start, b_size, limit, sort_report_name = \
+            self._sort_limit_arguments(query, sort_indexes, reverse,
+                                       sort_limit)
+        rlen = len(rs)
+        if limit is not None and limit >= rlen:
+            limit = rlen
+        indexes = sort_indexes
+        if not isinstance(indexes, list):
+            indexes = [indexes]
+        first_reverse = reverse
+        if isinstance(reverse, list):
+            first_reverse = reverse[0]
+        sort_func, reason = self._sort_strategy(
+            rlen, indexes[0], len(indexes), limit, True, first_reverse,
+            cr.thresholds())
+        info = {
+            'indexes': [index.getId() for index in indexes],
+            'reverse': reverse,
+            'limit': limit,
+            'strategy': sort_func.__name__.lstrip('_'),
+            'reason': reason,
+        }
+        if analyze:
+            cr.start_split(sort_report_name)
+            self.sortResults(
+                rs, sort_indexes, reverse, limit, True,
+                actual_result_count=rlen, b_start=b_start, b_size=b_size,
+                plan=cr)
+            cr.stop_split(sort_report_name, None)
+            measurement = cr.res[-1]
+            info['strategy'] = cr.strategies.get('sort_on', info['strategy'])
+            info['duration'] = measurement.duration * 1000
+            if measurement.loads is not None:
+                info['loads'] = measurement.loads._asdict()
+        return info
+
+    def getIndexingTelemetry(self):
+        """Indexing time reporting, None unless enabled.
+        """
+        parent = aq_base(aq_parent(self))
+        hotspots = getattr(parent, 'conflict_diagnostics', False)
+        if not hotspots and not getattr(parent, 'indexing_telemetry', False):
+            return None
+        return IndexingTelemetry(self, hotspots=hotspots)
 
     def getCatalogPlan(self, query=None):
         """Query time reporting and planning.
         """
         parent = aq_base(aq_parent(self))
         threshold = getattr(parent, 'long_query_time', 0.1)
-        return CatalogPlan(self, query, threshold)
+        loads = getattr(parent, 'load_accounting', False)
+        sample_rate = getattr(parent, 'query_sample_rate', 1)
+        profile_rate = getattr(parent, 'profile_rate', 0.0)
+        prefetch = getattr(parent, 'query_prefetch', False)
+        return CatalogPlan(self, query, threshold, loads=loads,
+                           sample_rate=sample_rate, profile_rate=profile_rate,
+                           prefetch=prefetch)
+
+    def calibrate(self, size=None, repeat=3):
+        """Measure and store the strategy thresholds of this catalog."""
+        return calibrate(self, size=size, repeat=repeat)
+
+    def getThresholds(self):
+        """Return the strategy thresholds in effect for this catalog."""
+        return dict(get_thresholds(catalog_id(self)))
+
+
+def _describe_record(record):
+    # Return the keys and options of an IndexQuery as a dict.
+    info = {'keys': list(record.keys), 'operator': record.operator}
+    for option in record.options:
+        value = record.get(option, None)
+        if option != 'operator' and value is not None:
+            info[option] = value
+    return info
+
+
+def _intersect_results(rs, index_rs):
+    # weightedIntersection preserves the values from any mappings
+    # we get, as some indexes don't return simple sets.
+    if hasattr(rs, 'items') or hasattr(index_rs, 'items'):
+        _, rs = weightedIntersection(rs, index_rs)
+    else:
+        rs = intersection(rs, index_rs)
+    return rs
+
+
+def _freeze(value):
+    """Return a hashable representation of a query value.
+
+    Raises TypeError for values which can't be represented.
+    """
+    if hasattr(value, 'keys') and not isinstance(value, str):
+        return tuple(sorted((k, _freeze(value[k])) for k in value.keys()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+def _encode_sort_key(key):
+    # Return a JSON representation of a sort key decoding to an equal value.
+    if key is None or isinstance(key, (str, int, float)):
+        return key
+    if isinstance(key, DateTime):
+        return {'DateTime': list(key.__getstate__())}
+    if isinstance(key, datetime):
+        return {'datetime': key.isoformat()}
+    if isinstance(key, date):
+        return {'date': key.isoformat()}
+    raise CatalogError('Sort keys of type %s cannot be used with '
+                       'search_after' % type(key).__name__)
+
+
+def _decode_sort_key(key):
+    if not isinstance(key, dict):
+        return key
+    (kind, value), = key.items()
+    if kind == 'DateTime':
+        key = DateTime.__new__(DateTime)
+        key.__setstate__(tuple(value))
+        return key
+    if kind == 'datetime':
+        return datetime.fromisoformat(value)
+    if kind == 'date':
+        return date.fromisoformat(value)
+    raise ValueError(kind)
+
+
+def _encode_search_after(names, reverse, keys, rid):
+    """Return an opaque search_after token for a result position.
+
+    Raises a CatalogError if the sort keys cannot be represented.
+    """
+    keys = [_encode_sort_key(key) for key in keys]
+    data = json.dumps([names, reverse, keys, rid])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+
+def _decode_search_after(token, names, reverse):
+    """Return the ((keys), rid) position of a search_after token or None
+    for an empty token.
+    """
+    if not token:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(token.encode('ascii'))
+        t_names, t_reverse, keys, rid = json.loads(data.decode('utf-8'))
+        keys = [_decode_sort_key(key) for key in keys]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        raise ValueError('Invalid search_after token')
+    if t_names != names or t_reverse != reverse or \
+            len(keys) != len(names) or not isinstance(rid, int):
+        raise ValueError('The search_after token does not match the sort '
+                         'order of the query')
+    return (tuple(keys), rid)
 
 
 def mergeResults(results, has_sort_keys, reverse):
@@ -13,6 +13,8 @@
 """ ZCatalog product
 """
 
+import ast
+import json
 import logging
 import operator
 import sys
@@ -46,11 +48,18 @@ from zope.interface import implementer
 from ZTUtils.Lazy import LazyMap
 
 from Products.PluginIndexes.interfaces import IPluggableIndex
+from Products.ZCatalog import compaction
+from Products.ZCatalog import footprint
 from Products.ZCatalog.Catalog import Catalog
 from Products.ZCatalog.Catalog import CatalogError
 from Products.ZCatalog.interfaces import IZCatalog
+from Products.ZCatalog.plan import PERCENTILES
+from Products.ZCatalog.plan import THRESHOLDS_KEY
 from Products.ZCatalog.plan import PriorityMap
+from Products.ZCatalog.plan import Profiles
+from Products.ZCatalog.plan import catalog_id
 from Products.ZCatalog.ProgressHandler import ZLogHandler
+from Products.ZCatalog.telemetry import IndexingTelemetry
 from Products.ZCatalog.ZCatalogIndexes import ZCatalogIndexes
 
 
@@ -108,7 +117,11 @@ class ZCatalog(Folder, Persistent, Implicit):
         {'label': 'Find Objects', 'action': 'manage_catalogFind'},
         {'label': 'Advanced', 'action': 'manage_catalogAdvanced'},
         {'label': 'Query Report', 'action': 'manage_catalogReport'},
+        {'label': 'Indexing Report',
+         'action': 'manage_catalogIndexingReport'},
+        {'label': 'Footprint', 'action': 'manage_catalogFootprint'},
         {'label': 'Query Plan', 'action': 'manage_catalogPlan'},
+        {'label': 'Explain', 'action': 'manage_catalogExplain'},
         {'label': 'Security', 'action': 'manage_access'},
         {'label': 'Ownership', 'action': 'manage_owner'},
     )
@@ -134,9 +147,22 @@ class ZCatalog(Folder, Persistent, Implicit):
     security.declareProtected(manage_zcatalog_entries, 'manage_catalogReport')
     manage_catalogReport = DTMLFile('dtml/catalogReport', globals())
 
+    security.declareProtected(manage_zcatalog_entries,
+                              'manage_catalogIndexingReport')
+    manage_catalogIndexingReport = DTMLFile('dtml/catalogIndexingReport',
+                                            globals())
+
+    security.declareProtected(manage_zcatalog_entries,
+                              'manage_catalogFootprint')
+    manage_catalogFootprint = DTMLFile('dtml/catalogFootprint', globals())
+
     security.declareProtected(manage_zcatalog_entries, 'manage_catalogPlan')
     manage_catalogPlan = DTMLFile('dtml/catalogPlan', globals())
 
+    security.declareProtected(manage_zcatalog_entries,
+                              'manage_catalogExplain')
+    manage_catalogExplain = DTMLFile('dtml/catalogExplain', globals())
+
     security.declareProtected(manage_zcatalog_entries,
                               'manage_objectInformation')
     manage_objectInformation = DTMLFile('dtml/catalogObjectInformation',
@@ -149,6 +175,12 @@ class ZCatalog(Folder, Persistent, Implicit):
 
     threshold = 10000
     long_query_time = 0.1
+    load_accounting = False
+    query_sample_rate = 1
+    query_prefetch = False
+    profile_rate = 0.0
+    indexing_telemetry = False
+    conflict_diagnostics = False
 
     # vocabulary and vocab_id are left for backwards
     # compatibility only, they are not used anymore
@@ -611,6 +643,8 @@ class ZCatalog(Folder, Persistent, Implicit):
         """Search the catalog.
 
         Search terms can be passed as a query or as keyword arguments.
+        Pass count_only=True to only get the number of results or
+        rids_only=True to get an unsorted set of record ids.
         """
         return self._catalog.searchResults(query, **kw)
 
@@ -619,7 +653,8 @@ class ZCatalog(Folder, Persistent, Implicit):
 
     @security.protected(search_zcatalog)
     def search(self, query,
-               sort_index=None, reverse=0, limit=None, merge=1):
+               sort_index=None, reverse=0, limit=None, merge=1,
+               count_only=False, rids_only=False):
         """Programmatic search interface, use for searching the catalog from
         scripts.
 
@@ -629,11 +664,46 @@ class ZCatalog(Folder, Persistent, Implicit):
         limit:      Limit sorted result count (optimization hint)
         merge:      Return merged results (like searchResults) or raw
                     results for later merging.
+        count_only: Only return the number of results
+        rids_only:  Only return an unsorted set of record ids
         """
         if sort_index is not None:
             sort_index = self._catalog.indexes[sort_index]
         return self._catalog.search(
-            query, sort_index, reverse, limit, merge)
+            query, sort_index, reverse, limit, merge,
+            count_only=count_only, rids_only=rids_only)
+
+    @security.protected(search_zcatalog)
+    def prepare(self, query):
+        """Prepare a query shape for repeated execution.
+
+        Keys whose value is None (or a dictionary with a 'query' of None)
+        are parameters.  Call the returned object with their values to run
+        the search.
+        """
+        return self._catalog.prepare(query)
+
+    @security.protected(search_zcatalog)
+    def searchMany(self, queries):
+        """Search the catalog with a sequence of queries at once.
+
+        Returns a list with the result of each query.  Index clauses shared
+        by several queries are only evaluated once.
+        """
+        return self._catalog.searchMany(queries)
+
+    @security.protected(search_zcatalog)
+    def facets(self, query, index_names, limit=None):
+        """Return per-value document counts for the result of a query.
+
+        query:       Dictionary containing catalog query
+        index_names: Names of the indexes to count values for
+        limit:       Only return the most frequent values per index
+
+        Returns a mapping of index name to a list of (value, count) tuples
+        ordered by descending count.
+        """
+        return self._catalog.searchFacets(query, index_names, limit)
 
     @security.protected(search_zcatalog)
     def valid_roles(self):
@@ -906,6 +976,9 @@ class ZCatalog(Folder, Persistent, Implicit):
             for querykey, details in plan.items():
                 if isinstance(details, (frozenset, set)):
                     output.append(f'    {querykey!r}: {details!r},')
+                elif querykey == THRESHOLDS_KEY:
+                    details = dict(sorted(details.items()))
+                    output.append(f'    {querykey!r}: {details!r},')
                 else:
                     output.append('    %s: {' % repr(querykey))
                     for indexname, bench in sorted(details.items()):
@@ -917,6 +990,37 @@ class ZCatalog(Folder, Persistent, Implicit):
         output.append('}')
         return '\n'.join(output)
 
+    @security.protected(manage_zcatalog_entries)
+    def explain(self, query, analyze=False):
+        """Describe how a query is executed, see `Catalog.explain`."""
+        return self._catalog.explain(query, analyze)
+
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogExplain(self, query, analyze=False):
+        """Explain a query given as a Python dictionary literal."""
+        try:
+            query = ast.literal_eval(query)
+        except (SyntaxError, ValueError):
+            query = None
+        if not isinstance(query, dict):
+            raise ValueError('The query must be a dictionary literal.')
+        return self.explain(query, analyze)
+
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogThresholds(self):
+        """Strategy thresholds in effect for this catalog."""
+        return sorted(self._catalog.getThresholds().items())
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_calibrate(self, REQUEST=None):
+        """Measure the strategy thresholds on this machine."""
+        self._catalog.calibrate()
+
+        if REQUEST is not None:
+            REQUEST.response.redirect(REQUEST.URL1 + (
+                '/manage_catalogPlan?'
+                'manage_tabs_message=Catalog%20calibrated'))
+
     @security.protected(manage_zcatalog_entries)
     def getCatalogReport(self):
         """Query time reporting."""
@@ -924,6 +1028,59 @@ class ZCatalog(Folder, Persistent, Implicit):
         rval.sort(key=operator.itemgetter('duration'), reverse=True)
         return rval
 
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogEvictions(self):
+        """Number of query keys evicted from the plan and the reports."""
+        return self._catalog.getCatalogPlan().evictions()
+
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogLatencies(self):
+        """Latency percentiles per query key and index and the slowest
+        queries."""
+        return self._catalog.getCatalogPlan().latency_report()
+
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogProfiles(self):
+        """Profiles of slow queries, slowest first."""
+        return self._catalog.getCatalogPlan().profiles()
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_downloadCatalogProfile(self, id, REQUEST=None):
+        """Download a profile of a slow query as pstats file."""
+        plan = self._catalog.getCatalogPlan()
+        profile = Profiles.get_profile(plan.cid, int(id))
+        if profile is None:
+            raise KeyError(id)
+        key, data = profile
+
+        if REQUEST is not None:
+            REQUEST.response.setHeader(
+                'Content-Type', 'application/octet-stream')
+            REQUEST.response.setHeader(
+                'Content-Disposition',
+                'attachment; filename="%s-%s.pstats"' % (self.getId(), id))
+        return data
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_exportCatalogReport(self, export_format='json',
+                                   REQUEST=None):
+        """Export the latency report as JSON or in the Prometheus text
+        format."""
+        latencies = self.getCatalogLatencies()
+        if export_format == 'text':
+            path = '/'.join(self.getPhysicalPath())
+            result = _latency_text(path, latencies)
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif export_format == 'json':
+            result = json.dumps(latencies, default=repr, sort_keys=True)
+            content_type = 'application/json'
+        else:
+            raise ValueError('Unknown export format: %s' % export_format)
+
+        if REQUEST is not None:
+            REQUEST.response.setHeader('Content-Type', content_type)
+        return result
+
     @security.protected(manage_zcatalog_entries)
     def manage_resetCatalogReport(self, REQUEST=None):
         """Resets the catalog report."""
@@ -934,21 +1091,167 @@ class ZCatalog(Folder, Persistent, Implicit):
                 '/manage_catalogReport?manage_tabs_message=Report%20cleared'))
 
     @security.protected(manage_zcatalog_entries)
-    def manage_editCatalogReport(self, long_query_time=0.1, REQUEST=None):
-        """Edit the long query time."""
+    def manage_editCatalogReport(self, long_query_time=0.1,
+                                 load_accounting=None, query_sample_rate=None,
+                                 profile_rate=None, query_prefetch=None,
+                                 REQUEST=None):
+        """Edit the long query time, switch ZODB load accounting and
+        prefetching and set the rates at which queries are measured and
+        profiled."""
         if not isinstance(long_query_time, float):
             long_query_time = float(long_query_time)
         self.long_query_time = long_query_time
+        if load_accounting is not None:
+            self.load_accounting = bool(load_accounting)
+        if query_sample_rate is not None:
+            query_sample_rate = int(query_sample_rate)
+            if query_sample_rate < 1:
+                raise ValueError('The query sample rate must be at least 1.')
+            self.query_sample_rate = query_sample_rate
+        if profile_rate is not None:
+            profile_rate = float(profile_rate)
+            if not 0.0 <= profile_rate <= 1.0:
+                raise ValueError(
+                    'The profile rate must be between 0.0 and 1.0.')
+            self.profile_rate = profile_rate
+        if query_prefetch is not None:
+            self.query_prefetch = bool(query_prefetch)
 
         if REQUEST is not None:
             REQUEST.response.redirect(REQUEST.URL1 + (
                 '/manage_catalogReport?manage_tabs_message='
                 'Long%20query%20time%20changed'))
 
+    @security.protected(manage_zcatalog_entries)
+    def getIndexingReport(self):
+        """Indexing time reporting."""
+        return IndexingTelemetry(self._catalog).report()
+
+    @security.protected(manage_zcatalog_entries)
+    def getConflictHotspots(self):
+        """Persistent objects written most often and with the most write
+        conflicts per index."""
+        return IndexingTelemetry(self._catalog).hotspot_report()
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_resetIndexingReport(self, REQUEST=None):
+        """Resets the indexing report."""
+        IndexingTelemetry(self._catalog).reset()
+
+        if REQUEST is not None:
+            REQUEST.response.redirect(REQUEST.URL1 + (
+                '/manage_catalogIndexingReport?'
+                'manage_tabs_message=Report%20cleared'))
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_editIndexingReport(self, indexing_telemetry=False,
+                                  conflict_diagnostics=False, REQUEST=None):
+        """Switch the indexing telemetry and the conflict diagnostics on or
+        off."""
+        self.indexing_telemetry = bool(indexing_telemetry)
+        self.conflict_diagnostics = bool(conflict_diagnostics)
+
+        if REQUEST is not None:
+            REQUEST.response.redirect(REQUEST.URL1 + (
+                '/manage_catalogIndexingReport?'
+                'manage_tabs_message=Settings%20changed'))
+
+    @security.protected(manage_zcatalog_entries)
+    def analyzeFootprint(self, budget=None, restart=False):
+        """Continue or start the analysis of the storage and memory
+        footprint of the indexes and the metadata and return its report.
+
+        The analysis stops after `budget` seconds, calling it again
+        continues where it stopped.
+        """
+        return footprint.analyze(self._catalog, budget, restart)
+
+    @security.protected(manage_zcatalog_entries)
+    def getCatalogFootprint(self):
+        """Report of the last footprint analysis or None."""
+        analyzer = footprint.Footprints.get(catalog_id(self._catalog))
+        if analyzer is None:
+            return None
+        return analyzer.report()
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_analyzeFootprint(self, budget=5.0, restart=False,
+                                REQUEST=None):
+        """Analyze the footprint for at most budget seconds."""
+        self.analyzeFootprint(float(budget), bool(restart))
+
+        if REQUEST is not None:
+            REQUEST.response.redirect(REQUEST.URL1 + (
+                '/manage_catalogFootprint?'
+                'manage_tabs_message=Footprint%20analyzed'))
+
+    @security.protected(manage_zcatalog_entries)
+    def compactIndex(self, name, pghandler=None):
+        """Rebuild the BTrees of an index into densely filled buckets,
+        committing a transaction per BTree, and return the number of
+        persistent objects before and after.  Raises a CatalogError if the
+        catalog has uncommitted changes."""
+        if name not in self._catalog.indexes:
+            raise CatalogError('The index %s does not exist' % name)
+        return compaction.compact_index(
+            name, self._catalog.getIndex(name), pghandler=pghandler)
+
+    @security.protected(manage_zcatalog_entries)
+    def compactCatalog(self, pghandler=None):
+        """Rebuild the BTrees of all indexes and of the catalog into
+        densely filled buckets, committing a transaction per BTree, and
+        return the number of persistent objects before and after per index
+        and structure.  Raises a CatalogError if the catalog has
+        uncommitted changes."""
+        return compaction.compact_catalog(self._catalog, pghandler=pghandler)
+
+    @security.protected(manage_zcatalog_entries)
+    def manage_compactCatalog(self, REQUEST=None):
+        """Compact the indexes and the catalog."""
+        pgthreshold = self._getProgressThreshold()
+        handler = (pgthreshold > 0) and ZLogHandler(pgthreshold) or None
+        report = self.compactCatalog(pghandler=handler)
+
+        if REQUEST is not None:
+            REQUEST.response.redirect(REQUEST.URL1 + (
+                '/manage_catalogFootprint?manage_tabs_message='
+                + quote('Catalog compacted from %d to %d objects, pack the '
+                        'database to reclaim the space' % (
+                            report['objects_before'],
+                            report['objects_after']))))
+
 
 InitializeClass(ZCatalog)
 
 
+def _label(value):
+    if not isinstance(value, str):
+        value = repr(value)
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def _latency_text(path, latencies):
+    # Prometheus text exposition format, durations in seconds.
+    output = []
+    for kind, label, infos in (('query', 'query', latencies['queries']),
+                               ('index', 'index', latencies['indexes'])):
+        name = 'zcatalog_%s_duration_seconds' % kind
+        output.append('# TYPE %s summary' % name)
+        for info in infos:
+            labels = 'catalog="{}",{}="{}"'.format(
+                _label(path), label,
+                _label(info['query' if kind == 'query' else 'id']))
+            for percent in PERCENTILES:
+                output.append('%s{%s,quantile="%s"} %.6f' % (
+                    name, labels, percent / 100.0,
+                    info['p%d' % percent] / 1000))
+            output.append('%s_sum{%s} %.6f' % (
+                name, labels, info['mean'] * info['count'] / 1000))
+            output.append('%s_count{%s} %d' % (name, labels, info['count']))
+    return '\n'.join(output) + '\n'
+
+
 def absattr(attr):
     if callable(attr):
         return attr()
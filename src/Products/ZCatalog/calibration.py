@@ -0,0 +1,180 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Measure the crossover points of the set operation and sort strategies.
+
+The catalog picks between alternative algorithms using the thresholds in
+`plan.DEFAULT_THRESHOLDS`.  `calibrate` times both sides of each decision
+with synthetic data sized like the catalog on the current machine and
+returns thresholds which can be stored next to the query plan.
+"""
+
+import random
+import time
+from logging import getLogger
+
+from BTrees.IIBTree import IISet
+from BTrees.IIBTree import IITreeSet
+from BTrees.IIBTree import intersection
+from BTrees.IIBTree import multiunion
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+
+from Products.ZCatalog.plan import DEFAULT_THRESHOLDS
+from Products.ZCatalog.plan import catalog_id
+from Products.ZCatalog.plan import set_thresholds
+
+
+MIN_SIZE = 1000
+MAX_SIZE = 100000
+OR_SETS = 8
+
+logger = getLogger('Products.ZCatalog')
+
+
+def _best(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _sizes(low, high):
+    size = low
+    while size <= high:
+        yield size
+        size *= 2
+
+
+class _SortIndex:
+    """Minimal sort index over synthetic integer keys."""
+
+    def __init__(self, keymap):
+        self._unindex = keymap
+        self._index = OOBTree()
+        for documentId, value in keymap.items():
+            row = self._index.get(value)
+            if row is None:
+                row = self._index[value] = IITreeSet()
+            row.insert(documentId)
+
+    def __len__(self):
+        return len(self._index)
+
+    def items(self):
+        return self._index.items()
+
+    def documentToKeyMap(self):
+        return self._unindex
+
+
+def calibrate_or(size, repeat=3, rng=random):
+    """Return the largest result set size for which intersecting every
+    row of an `or` query before unioning them beats unioning first."""
+    setlist = [IITreeSet(rng.sample(range(size), max(size // 16, 1)))
+               for i in range(OR_SETS)]
+    threshold = 0
+    for rlen in _sizes(25, size):
+        rs = IISet(rng.sample(range(size), rlen))
+
+        def small():
+            multiunion([intersection(rs, s) for s in setlist])
+
+        def large():
+            intersection(rs, multiunion(setlist))
+
+        if _best(small, repeat) >= _best(large, repeat):
+            break
+        threshold = rlen
+    return max(threshold, 1)
+
+
+def calibrate_nbest(catalog, size, repeat=3, rng=random):
+    """Return the factor below which a limited sort uses the N-Best
+    algorithm instead of a full sort."""
+    rs = IISet(range(size))
+    keymap = IOBTree([(i, rng.random()) for i in range(size)])
+    sort_index = _SortIndex(keymap)
+    limit = size // 2
+    factor = size
+    while limit >= 1:
+        def full():
+            catalog._sort_iterate_resultset(
+                size, [], rs, limit, True, False, sort_index, 1, [1], None)
+
+        def nbest():
+            catalog._sort_nbest_reverse(
+                size, [], rs, limit, True, False, sort_index, 1, [1], None)
+
+        if _best(nbest, repeat) < _best(full, repeat):
+            factor = size // limit
+            break
+        limit //= 2
+    return max(factor, 1)
+
+
+def calibrate_sort_index(catalog, size, repeat=3, rng=random):
+    """Return the ratio used to decide whether to iterate over the sort
+    index instead of the result set for unlimited sorts."""
+    rs = IISet(range(size))
+    crossover = 0
+    for values in _sizes(4, size // 2):
+        keymap = IOBTree([(i, rng.randrange(values)) for i in range(size)])
+        sort_index = _SortIndex(keymap)
+
+        def index():
+            catalog._sort_iterate_index(
+                size, [], rs, None, True, False, sort_index, 1, [1], None)
+
+        def resultset():
+            catalog._sort_iterate_resultset(
+                size, [], rs, None, True, False, sort_index, 1, [1], None)
+
+        if _best(index, repeat) >= _best(resultset, repeat):
+            break
+        crossover = values
+    if not crossover:
+        return 1
+    # Solve `rlen == values * (rlen / ratio + 1)` for the ratio.
+    return max(int(crossover * size / max(size - crossover, 1)), 1)
+
+
+def calibrate(catalog, size=None, repeat=3, store=True, seed=None):
+    """Measure the strategy thresholds for a catalog.
+
+    The synthetic data is sized like the catalog, bounded by `MIN_SIZE`
+    and `MAX_SIZE`.  If `store` is true the thresholds are kept next to
+    the catalog's query plan and used by subsequent queries.
+    """
+    if size is None:
+        size = len(catalog)
+    size = min(max(size, MIN_SIZE), MAX_SIZE)
+    rng = random.Random(seed)
+
+    start = time.time()
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    thresholds['or_intersect_max'] = calibrate_or(size, repeat, rng)
+    thresholds['sort_nbest_factor'] = calibrate_nbest(
+        catalog, size, repeat, rng)
+    thresholds['sort_index_ratio'] = calibrate_sort_index(
+        catalog, size, repeat, rng)
+
+    cid = catalog_id(catalog)
+    logger.info('calibrated %s in %.2fs: %r',
+                '/'.join(cid), time.time() - start, thresholds)
+    if store:
+        set_thresholds(cid, thresholds)
+    return thresholds
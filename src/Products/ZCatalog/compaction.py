@@ -0,0 +1,389 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Online compaction of the BTrees of indexes and of the catalog.
+
+BTrees filled by churn or by inserting keys in order end up with buckets
+about half full.  `compact_tree` copies a BTree or TreeSet into buckets
+filled up to `FILL` of their capacity, BTrees and TreeSets stored as
+values are compacted as well.  Index rows which are still stored as a
+single int (before Zope 2.13) are migrated to an `IITreeSet` the way
+`insertForwardIndexEntry` would.  Values of dictionary encoded reverse
+indexes which no document uses anymore are collected first.
+
+`compact_index` and `compact_catalog` replace the structures which
+shrink and report the number of persistent objects before and after.
+Every structure is committed in a transaction of its own, using the
+transaction manager of the catalog's connection.  They refuse to run
+with uncommitted changes of that connection, which would be committed
+along with the first structure.  The trees, buckets and rows which are
+copied are marked as read current, a concurrent change to them makes
+the commit fail with a `ConflictError` instead of getting lost with the
+replaced copy.  The structure is compacted again from the current state
+up to `RETRIES` times before the error is raised, the structures
+committed before stay compacted.  Large trees are read in chunks of
+`CHUNK_SIZE` items, the buckets read so far can be removed from the
+cache in between.  The replaced objects remain in the storage until it
+is packed.
+"""
+
+import math
+from itertools import islice
+
+import transaction
+from Acquisition import aq_base
+from BTrees.IIBTree import IITreeSet
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+
+from Products.ZCatalog.Catalog import CatalogError
+from Products.ZCatalog.footprint import _bucket_type
+from Products.ZCatalog.footprint import _is_btrees
+from Products.ZCatalog.footprint import measure
+
+
+# Fraction of the bucket and node capacity used by compacted trees.
+FILL = 0.9
+# Catalog attributes which are compacted.
+CATALOG_STRUCTURES = ('data', 'paths', 'uids')
+# Index attributes whose rows may be single ints.
+ROW_STRUCTURES = ('_index', '_since', '_until', '_since_only', '_until_only')
+# Number of times a structure is compacted again after a conflict.
+RETRIES = 3
+# Number of items read from a tree at once.
+CHUNK_SIZE = 10000
+
+
+def _is_tree(obj):
+    return _is_btrees(obj) and hasattr(type(obj), '_bucket_type')
+
+
+def _is_map(tree_type):
+    return 'TreeSet' not in tree_type.__name__
+
+
+def _bucket_count(tree):
+    state = tree.__getstate__()
+    if state is None:
+        return 0
+    if len(state) == 1:
+        # a single bucket stored inline
+        return 1
+    count = 0
+    bucket = state[1]
+    while bucket is not None:
+        count += 1
+        state = bucket.__getstate__()
+        bucket = state[1] if len(state) > 1 else None
+    return count
+
+
+def _nodes(tree):
+    # Iterate over the persistent nodes and buckets of a tree.
+    yield tree
+    state = tree.__getstate__()
+    if state is None or len(state) == 1:
+        return
+    for child in state[0][0::2]:
+        if _bucket_type(child) is None:
+            yield from _nodes(child)
+        else:
+            yield child
+
+
+def _read_current(tree):
+    # Make a concurrent change to a tree which is copied a conflict.
+    jar = getattr(tree, '_p_jar', None)
+    if jar is None:
+        return
+    for i, node in enumerate(_nodes(tree), 1):
+        if node._p_jar is jar and node._p_oid is not None:
+            jar.readCurrent(node)
+        if not i % CHUNK_SIZE:
+            jar.cacheGC()
+
+
+def _read(tree, mapping):
+    # Return the items or keys of a tree, read in chunks of CHUNK_SIZE.
+    # The buckets read so far can be turned into ghosts in between.
+    jar = getattr(tree, '_p_jar', None)
+    read = tree.items if mapping else tree.keys
+    result = []
+    chunk = list(islice(read(), CHUNK_SIZE))
+    while chunk:
+        result.extend(chunk)
+        if len(chunk) < CHUNK_SIZE:
+            break
+        if jar is not None:
+            jar.cacheGC()
+        last = chunk[-1][0] if mapping else chunk[-1]
+        chunk = list(islice(read(min=last, excludemin=True), CHUNK_SIZE))
+    return result
+
+
+def _split(items, size):
+    # Split items into the least number of chunks of at most size items
+    # of about the same length.
+    count = int(math.ceil(float(len(items)) / size))
+    chunks = []
+    start = 0
+    for i in range(count):
+        end = start + (len(items) - start) // (count - i)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def _build(tree_type, items, fill):
+    # Build a tree of tree_type from sorted items, (key, value) pairs or
+    # keys, with buckets and nodes filled up to fill.
+    mapping = _is_map(tree_type)
+    leaf_size = max(1, int(tree_type.max_leaf_size * fill))
+    if len(items) <= leaf_size:
+        tree = tree_type()
+        tree.update(items)
+        return tree
+
+    chunks = _split(items, leaf_size)
+    buckets = []
+    next_bucket = None
+    for chunk in reversed(chunks):
+        if mapping:
+            flat = tuple(item for pair in chunk for item in pair)
+        else:
+            flat = tuple(chunk)
+        bucket = tree_type._bucket_type()
+        if next_bucket is None:
+            bucket.__setstate__((flat, ))
+        else:
+            bucket.__setstate__((flat, next_bucket))
+        buckets.append(bucket)
+        next_bucket = bucket
+    buckets.reverse()
+
+    # (first key, node, first bucket) per node of the current level
+    level = []
+    for chunk, bucket in zip(chunks, buckets):
+        level.append((chunk[0][0] if mapping else chunk[0], bucket, bucket))
+    node_size = max(2, int(tree_type.max_internal_size * fill))
+    while True:
+        groups = _split(level, node_size)
+        nodes = []
+        for group in groups:
+            children = [group[0][1]]
+            for key, node, first in group[1:]:
+                children.append(key)
+                children.append(node)
+            tree = tree_type()
+            tree.__setstate__((tuple(children), group[0][2]))
+            nodes.append((group[0][0], tree, group[0][2]))
+        if len(nodes) == 1:
+            return nodes[0][1]
+        level = nodes
+
+
+def compact_tree(tree, fill=FILL, int_rows=False):
+    """Return a compacted copy of a BTree or TreeSet or the tree itself
+    if it's compact already.  BTrees and TreeSets stored as values are
+    compacted in place or in the copy.  With `int_rows`, int values are
+    converted to an `IITreeSet`.
+    """
+    mapping = _is_map(type(tree))
+    items = _read(tree, mapping)
+    changed = {}
+    if mapping and type(tree).__name__[1] == 'O':
+        for i, (key, value) in enumerate(items):
+            if int_rows and isinstance(value, int):
+                new = IITreeSet((value, ))
+            elif _is_tree(value):
+                new = compact_tree(value, fill)
+            else:
+                continue
+            if new is not value:
+                changed[key] = new
+                items[i] = (key, new)
+
+    leaf_size = max(1, int(type(tree).max_leaf_size * fill))
+    needed = int(math.ceil(float(len(items)) / leaf_size))
+    if _bucket_count(tree) > needed:
+        _read_current(tree)
+        return _build(type(tree), items, fill)
+    for key, value in changed.items():
+        tree[key] = value
+    return tree
+
+
+def _structures(owner, prefix=''):
+    # Return (name, holder, attribute) for the BTrees of an index or
+    # another persistent object, one level deep for other persistent
+    # objects like the index of a ZCTextIndex.
+    structures = []
+    if isinstance(owner, Persistent):
+        owner._p_activate()
+    for attr, value in sorted(getattr(owner, '__dict__', {}).items()):
+        if attr.startswith('_v_') or not isinstance(value, Persistent):
+            continue
+        if _is_tree(value):
+            structures.append((prefix + attr, owner, attr))
+        elif not _is_btrees(value) and not prefix:
+            structures.extend(_structures(value, prefix + attr + '.'))
+    return structures
+
+
+def _transaction_manager(obj):
+    # Return the transaction manager of the connection of obj, refuse to
+    # commit changes made before the compaction.
+    jar = getattr(aq_base(obj), '_p_jar', None)
+    if jar is None:
+        return transaction.manager
+    if not jar._needs_to_join:
+        raise CatalogError(
+            'The catalog has uncommitted changes, commit or abort them '
+            'before compacting')
+    return jar.transaction_manager
+
+
+def _commit(tm, note, step):
+    # Run step and commit its changes in a transaction of their own, run it
+    # again from the current state if the commit conflicts.
+    for attempt in range(RETRIES + 1):
+        try:
+            result = step()
+            tm.get().note(note)
+            tm.commit()
+        except ConflictError:
+            tm.abort()
+            if attempt == RETRIES:
+                raise
+        else:
+            return result
+
+
+def _compact_structure(holder, attr, fill):
+    tree = getattr(holder, attr)
+    before = measure(tree)
+    # indexes migrating int rows when inserting
+    int_rows = (hasattr(holder, 'insertForwardIndexEntry')
+                and attr in ROW_STRUCTURES)
+    new = compact_tree(tree, fill, int_rows)
+    if new is not tree:
+        setattr(holder, attr, new)
+    return before, measure(new)
+
+
+def _compact_structures(tm, structures, fill, pghandler=None):
+    results = []
+    for i, (index_id, name, holder, attr) in enumerate(structures):
+        if pghandler:
+            pghandler.report(i)
+        # commit each structure on its own, limits the memory use and
+        # the window for conflicts to the structure being compacted
+        before, after = _commit(
+            tm, f'Compacted {index_id} {name}',
+            lambda: _compact_structure(holder, attr, fill))
+        results.append({
+            'index': index_id,
+            'id': name,
+            'objects_before': before['objects'],
+            'objects_after': after['objects'],
+            'fill_before': before['fill'],
+            'fill_after': after['fill'],
+        })
+        jar = getattr(holder, '_p_jar', None)
+        if jar is not None:
+            jar.cacheGC()
+    return results
+
+
+def _collect_values(tm, index_id, index):
+    # Drop the values of a dictionary encoded reverse index which aren't
+    # used anymore, before its value table is compacted.
+    unindex = getattr(aq_base(index), '_unindex', None)
+    if getattr(unindex, 'collect', None) is None:
+        return
+
+    def collect():
+        # a document indexed concurrently may use a value found unused
+        _read_current(unindex._rows)
+        return unindex.collect()
+
+    _commit(tm, f'Collected values of {index_id}', collect)
+
+
+def _index_structures(index_id, index):
+    structures = []
+    for name, holder, attr in _structures(aq_base(index)):
+        structures.append((index_id, name, holder, attr))
+    get_lexicon = getattr(index, 'getLexicon', None)
+    if get_lexicon is not None:
+        lexicon = aq_base(get_lexicon())
+        for name, holder, attr in _structures(lexicon, 'lexicon.'):
+            structures.append((index_id, name, holder, attr))
+    return structures
+
+
+def _report(results):
+    by_index = {}
+    for info in results:
+        by_index.setdefault(info['index'], []).append(info)
+    indexes = []
+    for index_id, structures in by_index.items():
+        indexes.append({
+            'id': index_id,
+            'structures': structures,
+            'objects_before': sum(s['objects_before'] for s in structures),
+            'objects_after': sum(s['objects_after'] for s in structures),
+        })
+    return {
+        'objects_before': sum(info['objects_before'] for info in results),
+        'objects_after': sum(info['objects_after'] for info in results),
+        'indexes': indexes,
+    }
+
+
+def compact_index(index_id, index, fill=FILL, pghandler=None):
+    """Compact the BTrees of an index, committing a transaction per
+    structure, and return a report of the number of persistent objects
+    before and after per structure."""
+    tm = _transaction_manager(index)
+    _collect_values(tm, index_id, index)
+    structures = _index_structures(index_id, index)
+    if pghandler:
+        pghandler.init(f'Compacting index {index_id}', len(structures))
+    results = _compact_structures(tm, structures, fill, pghandler)
+    if pghandler:
+        pghandler.finish()
+    return _report(results)
+
+
+def compact_catalog(catalog, fill=FILL, pghandler=None):
+    """Compact the BTrees of all indexes and of the metadata and uid
+    mappings of a catalog, committing a transaction per structure, and
+    return a report of the number of persistent objects before and after
+    per index and structure."""
+    base = aq_base(catalog)
+    tm = _transaction_manager(base)
+    structures = []
+    for name in CATALOG_STRUCTURES:
+        value = getattr(base, name, None)
+        if _is_tree(value):
+            structures.append(('catalog', name, base, name))
+    for index_id in catalog.indexes.keys():
+        index = catalog.getIndex(index_id)
+        _collect_values(tm, index_id, index)
+        structures.extend(_index_structures(index_id, index))
+    if pghandler:
+        pghandler.init('Compacting catalog', len(structures))
+    results = _compact_structures(tm, structures, fill, pghandler)
+    if pghandler:
+        pghandler.finish()
+    return _report(results)
@@ -0,0 +1,340 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Storage and memory footprint of the catalog structures.
+
+`FootprintAnalyzer` walks the persistent objects of every index and of
+the catalog's own `data`, `paths`, `uids` and `_length` and sums per
+structure the number of persistent objects, the fill factor of the
+buckets, the pickle size and an estimate of the size in memory.  It works
+through the objects in batches limited by a time budget, so large
+catalogs can be analyzed over several requests.
+"""
+
+import io
+import pickle
+import sys
+import time
+from _thread import allocate_lock
+from collections import deque
+
+from Acquisition import aq_base
+from persistent import Persistent
+
+from Products.ZCatalog.plan import catalog_id
+
+
+# Catalog attributes included in the analysis.
+CATALOG_STRUCTURES = ('data', 'paths', 'uids', '_length')
+# Size of the values of the BTrees types by type code.
+ITEM_SIZES = {'I': 4, 'U': 4, 'F': 4, 'L': 8, 'Q': 8, 'O': 8}
+
+
+class StructureFootprint:
+    """Footprint of one structure of an index or the catalog."""
+
+    def __init__(self):
+        self.objects = 0
+        self.buckets = 0
+        self.items = 0
+        self.capacity = 0
+        self.pickle_bytes = 0
+        self.memory = 0
+
+    def add(self, obj):
+        """Add a persistent object and return the persistent objects its
+        state references."""
+        ghost = obj._p_changed is None
+        state = obj.__getstate__()
+        self.objects += 1
+        bucket = _bucket_type(obj)
+        if bucket is not None:
+            self.buckets += 1
+            self.items += len(obj)
+            self.capacity += bucket[1].max_leaf_size
+        self.pickle_bytes += _pickle_bytes(obj, state)
+        self.memory += _memory(obj, bucket)
+        children = [child for child in _children(state, [])
+                    if child is not obj]
+        if ghost:
+            obj._p_deactivate()
+        return children
+
+    def summary(self):
+        return {
+            'objects': self.objects,
+            'buckets': self.buckets,
+            'fill': self.capacity and float(self.items) / self.capacity,
+            'pickle_bytes': self.pickle_bytes,
+            'memory': self.memory,
+        }
+
+
+class _Pickler(pickle.Pickler):
+
+    def __init__(self, file, obj):
+        super().__init__(file, 3)
+        self.obj = obj
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Persistent) and obj is not self.obj:
+            return obj._p_oid or id(obj)
+        return None
+
+
+def _is_btrees(obj):
+    return type(obj).__module__.startswith('BTrees.')
+
+
+def _bucket_type(obj):
+    # Return the type code and the BTree type holding buckets like obj or
+    # None if obj isn't a bucket or set.
+    name = type(obj).__name__
+    prefix, kind = name[:2], name[2:]
+    if kind == 'Bucket':
+        tree = prefix + 'BTree'
+    elif kind == 'Set':
+        tree = prefix + 'TreeSet'
+    else:
+        return None
+    module = sys.modules.get(type(obj).__module__)
+    tree = getattr(module, tree, None)
+    if tree is None:
+        return None
+    return prefix, tree
+
+
+def _children(state, found):
+    # Collect the persistent objects referenced by a pickle state.
+    if isinstance(state, Persistent):
+        found.append(state)
+    elif isinstance(state, (tuple, list)):
+        for value in state:
+            _children(value, found)
+    elif isinstance(state, dict):
+        for value in state.values():
+            _children(value, found)
+    return found
+
+
+def _item_size(code, value):
+    size = ITEM_SIZES.get(code, 8)
+    if code == 'O' and not isinstance(value, Persistent):
+        size += sys.getsizeof(value)
+        if isinstance(value, tuple):
+            # metadata records
+            size += sum(sys.getsizeof(item) for item in value)
+    return size
+
+
+def _memory(obj, bucket):
+    size = sys.getsizeof(obj)
+    if bucket is not None:
+        prefix = bucket[0]
+        if hasattr(obj, 'values'):
+            for key, value in obj.items():
+                size += _item_size(prefix[0], key)
+                size += _item_size(prefix[1], value)
+        else:
+            for key in obj:
+                size += _item_size(prefix[0], key)
+    else:
+        values = getattr(obj, '__dict__', None)
+        if values is not None:
+            size += sys.getsizeof(values)
+            for value in values.values():
+                if not isinstance(value, Persistent):
+                    size += sys.getsizeof(value)
+    return size
+
+
+def _pickle_bytes(obj, state):
+    jar = obj._p_jar
+    if jar is not None and obj._p_oid is not None and not obj._p_changed:
+        try:
+            return len(jar._storage.load(obj._p_oid)[0])
+        except Exception:
+            pass
+    f = io.BytesIO()
+    pickler = _Pickler(f, obj)
+    pickler.dump(type(obj))
+    pickler.dump(state)
+    return len(f.getvalue())
+
+
+def _seeds(owner, prefix=''):
+    # Return the (structure name, object) pairs of the persistent
+    # attributes of an index or another persistent object.
+    seeds = []
+    if isinstance(owner, Persistent):
+        owner._p_activate()
+    for attr, value in sorted(getattr(owner, '__dict__', {}).items()):
+        if attr.startswith('_v_') or not isinstance(value, Persistent):
+            continue
+        seeds.append((prefix + attr, value))
+        if not _is_btrees(value) and not prefix:
+            # e.g. the index of a ZCTextIndex, split it by its trees
+            seeds.extend(_seeds(value, prefix + attr + '.'))
+    return seeds
+
+
+def measure(obj):
+    """Return the footprint of a persistent object and of the persistent
+    objects reachable from it as a dict."""
+    stats = StructureFootprint()
+    # objects turned into ghosts again may be freed and their id reused
+    seen = {obj._p_oid or id(obj)}
+    queue = [obj]
+    while queue:
+        for child in stats.add(queue.pop()):
+            marker = child._p_oid or id(child)
+            if marker not in seen:
+                seen.add(marker)
+                queue.append(child)
+    return stats.summary()
+
+
+class FootprintAnalyzer:
+    """Walk the persistent objects of the catalog structures.
+
+    Objects stored in the database are queued by oid and loaded through
+    the connection of the catalog passed to `step`, objects without an
+    oid are queued as they are.  Objects loaded for the analysis are
+    turned into ghosts again.
+    """
+
+    def __init__(self, catalog):
+        self.cid = catalog_id(catalog)
+        self.queue = deque()
+        self.seen = set()
+        self.stats = {}
+        self.started = time.time()
+        self.finished = None
+        self.duration = 0.0
+
+        base = aq_base(catalog)
+        for name in CATALOG_STRUCTURES:
+            value = getattr(base, name, None)
+            if isinstance(value, Persistent):
+                self._push(('catalog', name), value)
+        for index_id in catalog.indexes.keys():
+            index = catalog.getIndex(index_id)
+            for name, value in _seeds(aq_base(index)):
+                self._push((index_id, name), value)
+            get_lexicon = getattr(index, 'getLexicon', None)
+            if get_lexicon is not None:
+                lexicon = aq_base(get_lexicon())
+                for name, value in _seeds(lexicon, 'lexicon.'):
+                    self._push((index_id, name), value)
+
+    def _push(self, key, obj):
+        marker = obj._p_oid or id(obj)
+        if marker in self.seen:
+            return
+        self.seen.add(marker)
+        if obj._p_oid is not None and obj._p_jar is not None:
+            obj = obj._p_oid
+        self.queue.append((key, obj))
+
+    @property
+    def done(self):
+        return not self.queue
+
+    def step(self, catalog, budget=None):
+        """Analyze queued objects for at most `budget` seconds, or all of
+        them if `budget` is None.  Returns True when done."""
+        jar = aq_base(catalog)._p_jar
+        start = time.time()
+        while self.queue:
+            if budget is not None and time.time() - start >= budget:
+                break
+            key, obj = self.queue.popleft()
+            if not isinstance(obj, Persistent):
+                obj = jar.get(obj)
+            self._analyze(key, obj)
+        self.duration += time.time() - start
+        if not self.queue and self.finished is None:
+            self.finished = time.time()
+        return self.done
+
+    def _analyze(self, key, obj):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = StructureFootprint()
+        for child in stats.add(obj):
+            self._push(key, child)
+
+    def report(self):
+        """Returns the footprint per index and structure as a dict with a
+        list of dicts, largest first, and the progress of the analysis."""
+        by_index = {}
+        for (index_id, name), stats in self.stats.items():
+            info = stats.summary()
+            info['id'] = name
+            by_index.setdefault(index_id, []).append(info)
+        indexes = []
+        for index_id, structures in by_index.items():
+            structures.sort(key=lambda info: info['pickle_bytes'],
+                            reverse=True)
+            total = {'id': index_id, 'structures': structures}
+            for field in ('objects', 'buckets', 'pickle_bytes', 'memory'):
+                total[field] = sum(info[field] for info in structures)
+            indexes.append(total)
+        indexes.sort(key=lambda info: info['pickle_bytes'], reverse=True)
+        return {
+            'done': self.done,
+            'analyzed': len(self.seen) - len(self.queue),
+            'queued': len(self.queue),
+            'duration': self.duration,
+            'indexes': indexes,
+        }
+
+
+class Footprints:
+    """Holds the last footprint analysis per catalog id."""
+
+    lock = allocate_lock()
+    value = {}
+
+    @classmethod
+    def get(cls, cid):
+        return cls.value.get(cid)
+
+    @classmethod
+    def set(cls, cid, analyzer):
+        with cls.lock:
+            cls.value[cid] = analyzer
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.value = {}
+
+
+def analyze(catalog, budget=None, restart=False):
+    """Continue, or start, the footprint analysis of a catalog for at most
+    `budget` seconds and return its report."""
+    cid = catalog_id(catalog)
+    analyzer = Footprints.get(cid)
+    if analyzer is None or restart:
+        analyzer = FootprintAnalyzer(catalog)
+        Footprints.set(cid, analyzer)
+    analyzer.step(catalog, budget)
+    return analyzer.report()
+
+
+# Make sure we provide test isolation
+from zope.testing.cleanup import addCleanUp  # NOQA
+
+
+addCleanUp(Footprints.clear)
+del addCleanUp
@@ -11,8 +11,14 @@
 #
 ##############################################################################
 
+import cProfile
+import heapq
+import itertools
+import marshal
+import math
 import os
 import os.path
+import random
 import time
 from _thread import allocate_lock
 from collections import namedtuple
@@ -31,12 +37,53 @@ from Products.PluginIndexes.interfaces import IUniqueValueIndex
 MAX_DISTINCT_VALUES = 10
 REFRESH_RATE = 100
 VALUE_INDEX_KEY = 'VALUE_INDEXES'
+THRESHOLDS_KEY = 'THRESHOLDS'
+
+# Crossover points of the set operation and sorting strategies, these can
+# be replaced per catalog by measured values, see `calibration.py`.
+DEFAULT_THRESHOLDS = {
+    # largest result set an `or` query intersects with every index row
+    # before unioning them
+    'or_intersect_max': 200,
+    # use a full sort if `limit * sort_nbest_factor` exceeds the result size
+    'sort_nbest_factor': 4,
+    # iterate over the sort index if `rlen > len(sort_index) *
+    # (rlen / sort_index_ratio + 1)`
+    'sort_index_ratio': 100,
+}
+
+# Latency histograms use logarithmic buckets starting at
+# `HISTOGRAM_MIN` seconds, each `2 ** (1 / HISTOGRAM_PRECISION)` times as
+# wide as the previous one.  Durations above the last bucket are counted
+# in the last bucket.
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_PRECISION = 8
+HISTOGRAM_BUCKETS = 256
+PERCENTILES = (50, 95, 99)
+SLOWEST_QUERIES = 20
+
+# Query keys kept per catalog in the plan, the reports and the latency
+# histograms.  Beyond that the keys with the least total query time are
+# evicted until `EVICT_RATIO` of the limit is left.
+MAX_QUERY_KEYS = 1000
+EVICT_RATIO = 0.9
+
+# Profiles of slow queries kept per query key.
+PROFILES_PER_KEY = 5
+
+# Counts the queries of sampling catalogs, see `CatalogPlan.sample`.
+_samples = itertools.count()
 
 Duration = namedtuple('Duration', ['start', 'end'])
 IndexMeasurement = namedtuple('IndexMeasurement',
-                              ['name', 'duration', 'limit'])
+                              ['name', 'duration', 'limit', 'loads'],
+                              defaults=(None, ))
 Benchmark = namedtuple('Benchmark', ['duration', 'hits', 'limit'])
-RecentQuery = namedtuple('RecentQuery', ['duration', 'details'])
+RecentQuery = namedtuple('RecentQuery',
+                         ['duration', 'details', 'strategies', 'loads'],
+                         defaults=(None, None))
+# objects loaded from the storage and objects unghosted in the cache
+Loads = namedtuple('Loads', ['loaded', 'activated'])
 Report = namedtuple('Report', ['hits', 'duration', 'last'])
 
 logger = getLogger('Products.ZCatalog')
@@ -83,7 +130,69 @@ class NestedDict:
         cls.set(key, {})
 
 
-class PriorityMap(NestedDict):
+class BoundedNestedDict(NestedDict):
+    """Holds a structure of two nested dicts with at most `max_entries`
+    keys per inner dict.
+
+    Every inner key is weighed by the total query time spent on it. When
+    an inner dict grows beyond `max_entries`, the lightest keys are
+    evicted. Like in the space saving algorithm, new keys start with the
+    largest weight evicted so far, so a query shape which just became hot
+    isn't evicted right away.
+    """
+
+    max_entries = MAX_QUERY_KEYS
+    pinned = ()
+
+    @classmethod
+    def clear(cls):
+        with cls.lock:
+            cls.value = {}
+            cls.weights = {}
+            cls.floors = {}
+            cls.evictions = {}
+
+    @classmethod
+    def clear_entry(cls, key):
+        with cls.lock:
+            cls.value[key] = {}
+            cls.weights.pop(key, None)
+            cls.floors.pop(key, None)
+            cls.evictions.pop(key, None)
+
+    @classmethod
+    def weigh(cls, key, key2, weight):
+        """Add weight to an inner key, evicting light keys if needed."""
+        with cls.lock:
+            weights = cls.weights.setdefault(key, {})
+            current = weights.get(key2)
+            if current is None:
+                current = cls.floors.get(key, 0.0)
+            weights[key2] = current + weight
+            outer = cls.value.get(key)
+            if outer is not None and len(outer) > cls.max_entries:
+                cls._evict(key, outer, weights)
+
+    @classmethod
+    def _evict(cls, key, outer, weights):
+        keep = int(cls.max_entries * EVICT_RATIO)
+        candidates = [k for k in outer if k not in cls.pinned]
+        candidates.sort(key=lambda k: weights.get(k, 0.0))
+        victims = candidates[:len(outer) - keep]
+        floor = cls.floors.get(key, 0.0)
+        for key2 in victims:
+            floor = max(floor, weights.pop(key2, 0.0))
+            del outer[key2]
+        cls.floors[key] = floor
+        cls.evictions[key] = cls.evictions.get(key, 0) + len(victims)
+
+    @classmethod
+    def get_evictions(cls, key):
+        """Return the number of keys evicted from an inner dict."""
+        return cls.evictions.get(key, 0)
+
+
+class PriorityMap(BoundedNestedDict):
     """This holds a structure of nested dicts.
 
     The outer dict is a mapping of catalog id to plans. The inner dict holds
@@ -92,6 +201,10 @@ class PriorityMap(NestedDict):
 
     lock = allocate_lock()
     value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+    pinned = (VALUE_INDEX_KEY, THRESHOLDS_KEY)
 
     @classmethod
     def get_value(cls):
@@ -130,15 +243,19 @@ class PriorityMap(NestedDict):
                 new_plan[cid][querykey] = {}
                 if isinstance(details, (frozenset, set)):
                     new_plan[cid][querykey] = details
+                elif querykey == THRESHOLDS_KEY:
+                    new_plan[cid][querykey] = dict(details)
                 else:
                     for indexname, benchmark in details.items():
                         new_plan[cid][querykey][indexname] = \
                             Benchmark(*benchmark)
         with cls.lock:
             cls.value = new_plan
+            cls.weights = {}
+            cls.floors = {}
 
 
-class Reports(NestedDict):
+class Reports(BoundedNestedDict):
     """This holds a structure of nested dicts.
 
     The outer dict is a mapping of catalog id to reports. The inner dict holds
@@ -147,6 +264,180 @@ class Reports(NestedDict):
 
     lock = allocate_lock()
     value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+
+
+def catalog_id(catalog):
+    """Return the key identifying a catalog in the plan."""
+    parent = aq_parent(catalog)
+    path = getattr(aq_base(parent), 'getPhysicalPath', None)
+    if path is None:
+        path = ('', 'NonPersistentCatalog')
+    else:
+        path = tuple(parent.getPhysicalPath())
+    return path
+
+
+def get_thresholds(cid):
+    """Return the strategy thresholds in effect for a catalog id."""
+    plan = PriorityMap.value.get(cid)
+    thresholds = plan and plan.get(THRESHOLDS_KEY)
+    if not thresholds:
+        return DEFAULT_THRESHOLDS
+    return dict(DEFAULT_THRESHOLDS, **thresholds)
+
+
+def set_thresholds(cid, thresholds):
+    """Store the strategy thresholds of a catalog id next to its plan.
+
+    Passing None restores the defaults.
+    """
+    if thresholds is None:
+        thresholds = {}
+    unknown = set(thresholds) - set(DEFAULT_THRESHOLDS)
+    if unknown:
+        raise ValueError('Unknown thresholds: %s' % ', '.join(sorted(unknown)))
+    PriorityMap.set_entry(cid, THRESHOLDS_KEY, dict(thresholds))
+
+
+class Histogram:
+    """Fixed memory latency histogram with logarithmic buckets."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, duration, weight=1):
+        # a sampled duration stands in for `weight` executions
+        if duration > HISTOGRAM_MIN:
+            bucket = math.ceil(math.log2(duration / HISTOGRAM_MIN) *
+                               HISTOGRAM_PRECISION)
+            bucket = min(bucket, HISTOGRAM_BUCKETS - 1)
+        else:
+            bucket = 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + weight
+        self.count += weight
+        self.total += duration * weight
+        if duration > self.max:
+            self.max = duration
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile."""
+        if not self.count:
+            return 0.0
+        rank = max(math.ceil(self.count * percent / 100.0), 1)
+        seen = 0
+        for bucket, count in sorted(self.buckets.items()):
+            seen += count
+            if seen >= rank:
+                break
+        upper = HISTOGRAM_MIN * 2 ** (bucket / HISTOGRAM_PRECISION)
+        return min(upper, self.max)
+
+    def summary(self):
+        """Return count, mean, max and percentiles in milliseconds."""
+        info = {
+            'count': self.count,
+            'mean': self.count and self.total / self.count * 1000,
+            'max': self.max * 1000,
+        }
+        for percent in PERCENTILES:
+            info['p%d' % percent] = self.percentile(percent) * 1000
+        return info
+
+
+class Latencies(BoundedNestedDict):
+    """This holds a structure of nested dicts.
+
+    The outer dict is a mapping of catalog id to histograms. The inner dict
+    holds a ('query', query key) or ('index', split name) to Histogram
+    mapping.
+    """
+
+    lock = allocate_lock()
+    value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+
+    @classmethod
+    def record(cls, cid, kind, key, duration, weight=1):
+        outer = cls.get(cid)
+        with cls.lock:
+            histogram = outer.get((kind, key))
+            if histogram is None:
+                histogram = outer[(kind, key)] = Histogram()
+            histogram.record(duration, weight)
+        cls.weigh(cid, (kind, key), duration * weight)
+
+
+class SlowQueries(NestedDict):
+    """This holds a mapping of catalog id to a heap of the
+    `SLOWEST_QUERIES` slowest executions as (duration, sequence, query key,
+    RecentQuery) tuples.
+    """
+
+    lock = allocate_lock()
+    value = {}
+    sequence = itertools.count()
+
+    @classmethod
+    def record(cls, cid, key, recent):
+        entry = (recent.duration, next(cls.sequence), key, recent)
+        with cls.lock:
+            heap = cls.value.setdefault(cid, [])
+            if len(heap) < SLOWEST_QUERIES:
+                heapq.heappush(heap, entry)
+            elif recent.duration > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+
+    @classmethod
+    def clear_entry(cls, key):
+        cls.set(key, [])
+
+
+class Profiles(BoundedNestedDict):
+    """This holds a structure of nested dicts.
+
+    The outer dict is a mapping of catalog id to profiles. The inner dict
+    holds a query key to heap mapping of the `PROFILES_PER_KEY` slowest
+    profiled executions as (duration, sequence, marshalled pstats data)
+    tuples.
+    """
+
+    lock = allocate_lock()
+    value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+    sequence = itertools.count(1)
+
+    @classmethod
+    def record(cls, cid, key, duration, data):
+        outer = cls.get(cid)
+        entry = (duration, next(cls.sequence), data)
+        with cls.lock:
+            heap = outer.get(key)
+            if heap is None:
+                heap = outer[key] = []
+            if len(heap) < PROFILES_PER_KEY:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+        cls.weigh(cid, key, duration)
+
+    @classmethod
+    def get_profile(cls, cid, sequence):
+        """Return the query key and pstats data of a profile or None."""
+        for key, heap in list(cls.get(cid).items()):
+            for duration, seq, data in list(heap):
+                if seq == sequence:
+                    return key, data
+        return None
 
 
 class CatalogPlan:
@@ -154,36 +445,77 @@ class CatalogPlan:
     their execution.
     """
 
-    def __init__(self, catalog, query=None, threshold=0.1):
+    def __init__(self, catalog, query=None, threshold=0.1,
+                 querykey_to_index=None, key=None, loads=False,
+                 sample_rate=1, profile_rate=0.0, prefetch=False):
         self.catalog = catalog
         self.cid = self.get_id()
-        querykey_to_index = {}
-        for index in self.catalog.indexes.values():
-            for querykey in self.catalog._get_index_query_names(index):
-                querykey_to_index[querykey] = index.getId()
-        self.querykey_to_index = querykey_to_index
+        self._querykey_to_index = querykey_to_index
         self.query = query
-        self.key = self.make_key(query)
+        if key is None:
+            key = self.make_key(query)
+        self.key = key
         self.benchmark = {}
         self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.sampled = True
+        self.weight = 1
+        self.profile_rate = profile_rate
+        self.profiler = None
+        self.prefetch = prefetch
+        self.jar = None
+        if loads:
+            self.jar = getattr(aq_base(catalog), '_p_jar', None)
         self.init_timer()
 
+    @property
+    def querykey_to_index(self):
+        # Only measured queries need the mapping, build it on first use.
+        if self._querykey_to_index is None:
+            querykey_to_index = {}
+            for index in self.catalog.indexes.values():
+                for querykey in self.catalog._get_index_query_names(index):
+                    querykey_to_index[querykey] = index.getId()
+            self._querykey_to_index = querykey_to_index
+        return self._querykey_to_index
+
     def get_id(self):
-        parent = aq_parent(self.catalog)
-        path = getattr(aq_base(parent), 'getPhysicalPath', None)
-        if path is None:
-            path = ('', 'NonPersistentCatalog')
-        else:
-            path = tuple(parent.getPhysicalPath())
-        return path
+        return catalog_id(self.catalog)
+
+    def thresholds(self):
+        # resolved once when the search starts
+        if self._thresholds is None:
+            return get_thresholds(self.cid)
+        return self._thresholds
 
     def init_timer(self):
         self.res = []
+        self.strategies = {}
+        self._thresholds = None
         self.start_time = None
         self.interim = {}
+        self.interim_loads = {}
+        self.start_loads = None
+        self.loads = None
         self.stop_time = None
         self.duration = None
 
+    def load_counters(self):
+        """Return the objects loaded by the catalog's connection and the
+        number of non-ghost objects in its cache, or None if load
+        accounting is off."""
+        jar = self.jar
+        if jar is None:
+            return None
+        return (jar.getTransferCounts()[0],
+                jar._cache.cache_non_ghost_count)
+
+    def _loads_since(self, counters):
+        if counters is None:
+            return None
+        loaded, non_ghosts = self.load_counters()
+        return Loads(loaded - counters[0], non_ghosts - counters[1])
+
     def valueindexes(self):
         indexes = self.catalog.indexes
 
@@ -267,19 +599,78 @@ class CatalogPlan:
                           if '#' not in name])
         return [r[1] for r in ranking]
 
+    def sample(self):
+        """Decide whether the query is measured.
+
+        One in `sample_rate` queries is timed and updates the plan and
+        the reports, the others only read the plan.  Queries without a
+        plan are always measured, so new query keys get planned.  A
+        sampled query counts as `sample_rate` queries in the reports.
+        """
+        self.weight = 1
+        if self.sample_rate <= 1:
+            return True
+        if not PriorityMap.get_entry(self.cid, self.key):
+            return True
+        self.weight = self.sample_rate
+        return next(_samples) % self.sample_rate == 0
+
+    def profile(self):
+        """Decide whether the query is profiled.
+
+        A `profile_rate` fraction of the queries whose key is already in
+        the report of slow queries runs under cProfile.
+        """
+        if self.profile_rate <= 0:
+            return False
+        # look the report up without adding an empty entry for the key
+        if not Reports.value.get(self.cid, {}).get(self.key):
+            return False
+        return random.random() < self.profile_rate
+
     def start(self):
         self.init_timer()
-        self.start_time = time.time()
+        self._thresholds = get_thresholds(self.cid)
+        self.profiler = None
+        if self.profile():
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # another profiler is active in this thread
+                pass
+            else:
+                # The profiler distorts the timings, profiled queries
+                # don't update the plan or the reports.
+                self.profiler = profiler
+                self.sampled = False
+                self.start_time = time.perf_counter_ns()
+                return
+        self.sampled = self.sample()
+        if not self.sampled:
+            return
+        self.start_loads = self.load_counters()
+        self.start_time = time.perf_counter_ns()
 
     def start_split(self, name):
-        self.interim[name] = Duration(time.time(), None)
+        if not self.sampled:
+            return
+        if self.jar is not None:
+            self.interim_loads[name] = self.load_counters()
+        self.interim[name] = Duration(time.perf_counter_ns(), None)
 
     def stop_split(self, name, result=None, limit=False):
-        current = time.time()
+        if not self.sampled:
+            return
+        current = time.perf_counter_ns()
         start_time, stop_time = self.interim.get(name, Duration(None, None))
         self.interim[name] = Duration(start_time, current)
-        dt = current - start_time
-        self.res.append(IndexMeasurement(name=name, duration=dt, limit=limit))
+        dt = (current - start_time) / 1e9
+        loads = None
+        if self.jar is not None:
+            loads = self._loads_since(self.interim_loads.get(name))
+        self.res.append(IndexMeasurement(
+            name=name, duration=dt, limit=limit, loads=loads))
 
         if name.startswith('sort_on'):
             # sort_on isn't an index. We only do time reporting on it
@@ -298,9 +689,25 @@ class CatalogPlan:
             hits += 1
             benchmark[name] = Benchmark(duration, hits, limit)
 
+    def strategy(self, name, strategy):
+        """Remember the strategy chosen for a step of the query."""
+        self.strategies[name] = strategy
+
+    def abort(self):
+        """Stop a query which raised an exception without measuring it."""
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler = None
+
     def stop(self):
-        self.end_time = time.time()
-        self.duration = self.end_time - self.start_time
+        if self.profiler is not None:
+            self.stop_profile()
+            return
+        if not self.sampled:
+            return
+        self.end_time = time.perf_counter_ns()
+        self.duration = (self.end_time - self.start_time) / 1e9
+        self.loads = self._loads_since(self.start_loads)
         # Make absolutely sure we never omit query keys from the plan
         current = PriorityMap.get_entry(self.cid, self.key)
         for key in self.query.keys():
@@ -316,33 +723,60 @@ class CatalogPlan:
                     else:
                         self.benchmark[key] = Benchmark(0, 0, False)
         PriorityMap.set_entry(self.cid, self.key, self.benchmark)
+        PriorityMap.weigh(self.cid, self.key, self.duration * self.weight)
         self.log()
 
+    def stop_profile(self):
+        profiler = self.profiler
+        profiler.disable()
+        self.profiler = None
+        self.end_time = time.perf_counter_ns()
+        self.duration = (self.end_time - self.start_time) / 1e9
+        if self.duration < self.threshold:
+            return
+        profiler.create_stats()
+        Profiles.record(self.cid, self.key, self.duration,
+                        marshal.dumps(profiler.stats))
+
     def log(self):
         # result of stopwatch
         total = self.duration
+        key = self.key
+        weight = self.weight
+        recent = RecentQuery(duration=total, details=self.res,
+                             strategies=self.strategies, loads=self.loads)
+
+        Latencies.record(self.cid, 'query', key, total, weight)
+        for measurement in self.res:
+            Latencies.record(self.cid, 'index', measurement.name,
+                             measurement.duration, weight)
+        SlowQueries.record(self.cid, key, recent)
+
         if total < self.threshold:
             return
 
-        key = self.key
-        recent = RecentQuery(duration=total, details=self.res)
-
         previous = Reports.get_entry(self.cid, key)
         if previous:
             counter, mean, last = previous
-            mean = (mean * counter + total) / float(counter + 1)
-            Reports.set_entry(self.cid, key, Report(counter + 1, mean, recent))
+            mean = (mean * counter + total * weight) / float(counter + weight)
+            Reports.set_entry(
+                self.cid, key, Report(counter + weight, mean, recent))
         else:
-            Reports.set_entry(self.cid, key, Report(1, total, recent))
+            Reports.set_entry(self.cid, key, Report(weight, total, recent))
+        Reports.weigh(self.cid, key, total * weight)
 
     def reset(self):
         Reports.clear_entry(self.cid)
+        Latencies.clear_entry(self.cid)
+        SlowQueries.clear_entry(self.cid)
+        Profiles.clear_entry(self.cid)
 
     def report(self):
         """Returns a statistic report of catalog queries as list of dicts.
         The duration is provided in millisecond.
         """
         rval = []
+        latencies = Latencies.get(self.cid)
         for key, report in Reports.get(self.cid).items():
             last = report.last
             info = {
@@ -352,16 +786,81 @@ class CatalogPlan:
                 'last': {
                     'duration':
                     last.duration * 1000,
-                    'details': [
-                        dict(id=d.name, duration=d.duration * 1000)
-                        for d in last.details
-                    ],
+                    'details': [_measurement(d) for d in last.details],
+                    'strategies': dict(last.strategies or {}),
+                    'loads': _loads(last.loads),
                 },
             }
+            histogram = latencies.get(('query', key))
+            if histogram is not None:
+                info['latency'] = histogram.summary()
             rval.append(info)
 
         return rval
 
+    def profiles(self):
+        """Returns the stored profiles as list of dicts, slowest first.
+        The duration is provided in millisecond.
+        """
+        rval = []
+        for key, heap in Profiles.get(self.cid).items():
+            for duration, sequence, data in heap:
+                rval.append({
+                    'id': sequence,
+                    'query': key,
+                    'duration': duration * 1000,
+                })
+        rval.sort(key=lambda info: info['duration'], reverse=True)
+        return rval
+
+    def evictions(self):
+        """Returns the number of query keys evicted from the plan, the
+        report and the latency histograms of this catalog."""
+        return {
+            'plan': PriorityMap.get_evictions(self.cid),
+            'report': Reports.get_evictions(self.cid),
+            'latency': Latencies.get_evictions(self.cid),
+        }
+
+    def latency_report(self):
+        """Returns latency percentiles per query key and per index and the
+        slowest executions as a dict of lists of dicts.
+        The durations are provided in millisecond.
+        """
+        rval = {'queries': [], 'indexes': [], 'slowest': []}
+        for (kind, key), histogram in Latencies.get(self.cid).items():
+            info = histogram.summary()
+            if kind == 'index':
+                info['id'] = key
+                rval['indexes'].append(info)
+            else:
+                info['query'] = key
+                rval['queries'].append(info)
+        for value in rval.values():
+            value.sort(key=lambda info: info['p99'], reverse=True)
+
+        slowest = sorted(SlowQueries.value.get(self.cid, ()), reverse=True)
+        for duration, sequence, key, recent in slowest:
+            rval['slowest'].append({
+                'query': key,
+                'duration': duration * 1000,
+                'details': [_measurement(d) for d in recent.details],
+                'strategies': dict(recent.strategies or {}),
+                'loads': _loads(recent.loads),
+            })
+        return rval
+
+
+def _loads(loads):
+    if loads is None:
+        return None
+    return dict(loaded=loads.loaded, activated=loads.activated)
+
+
+def _measurement(measurement):
+    return dict(id=measurement.name, duration=measurement.duration * 1000,
+                loads=_loads(measurement.loads))
+
 
 # Make sure we provide test isolation
 from zope.testing.cleanup import addCleanUp  # NOQA
@@ -369,4 +868,7 @@ from zope.testing.cleanup import addCleanUp  # NOQA
 
 addCleanUp(PriorityMap.clear)
 addCleanUp(Reports.clear)
+addCleanUp(Latencies.clear)
+addCleanUp(SlowQueries.clear)
+addCleanUp(Profiles.clear)
 del addCleanUp
@@ -0,0 +1,148 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Prefetch the index structures a query is going to load.
+
+Evaluating the clauses of a query one by one loads every BTree node,
+bucket and row of an index on first touch, one storage round trip at a
+time.  `prefetch_query` walks the forward indexes of all planned clauses
+level by level instead and asks the storage to load the ghosts of each
+level with a single `Connection.prefetch` call.  Storages which load in
+parallel, like ZEO or RelStorage, overlap the round trips, for other
+storages prefetching does nothing.
+
+Only clauses with exact keys are followed, range and not queries load
+their rows while iterating anyway.
+"""
+
+from bisect import bisect_left
+from bisect import bisect_right
+
+from Acquisition import aq_base
+from persistent import Persistent
+
+from Products.PluginIndexes.interfaces import IQueryIndex
+from Products.ZCatalog.footprint import _bucket_type
+from Products.ZCatalog.footprint import _is_btrees
+from Products.ZCatalog.query import IndexQuery
+
+
+def _prefetch(jar, objects):
+    # Prefetch the ghosts among objects, return their number.
+    oids = [obj._p_oid for obj in objects
+            if obj._p_changed is None and obj._p_oid is not None]
+    if oids:
+        jar.prefetch(oids)
+    return len(oids)
+
+
+def _clause_keys(index, query):
+    # Return the converted keys of an exact clause of the query for the
+    # index or None.
+    if not IQueryIndex.providedBy(index):
+        return None
+    record = IndexQuery(query, index.id, index.query_options,
+                        index.operators, index.useOperator)
+    if record.keys is None or record.get('range', None) or \
+            record.get('not', None):
+        return None
+    convert = getattr(index, '_convert', None)
+    keys = []
+    for key in record.keys:
+        if convert is not None:
+            key = convert(key)
+        if key is not None:
+            keys.append(key)
+    return keys
+
+
+def _lookup(node, keys):
+    # Return the children of a BTree node to look the keys up in, as a
+    # list of (child, keys), and the values of the keys found in a bucket.
+    state = node.__getstate__()
+    if state is None:
+        return [], []
+    if _bucket_type(node) is not None:
+        flat = state[0]
+    elif len(state) == 1:
+        # a single bucket stored inline
+        flat = state[0][0][0]
+    else:
+        items = state[0]
+        children = items[0::2]
+        separators = items[1::2]
+        by_child = {}
+        for key in keys:
+            i = bisect_right(separators, key)
+            by_child.setdefault(i, []).append(key)
+        return [(children[i], child_keys)
+                for i, child_keys in sorted(by_child.items())], []
+    bucket_keys = flat[0::2]
+    values = []
+    for key in keys:
+        i = bisect_left(bucket_keys, key)
+        if i < len(bucket_keys) and bucket_keys[i] == key:
+            values.append(flat[2 * i + 1])
+    return [], values
+
+
+def prefetch_query(catalog, plan, query):
+    """Prefetch the indexes of the plan, the nodes of their forward index
+    leading to the keys of the query and the rows of these keys.
+
+    Returns the number of objects prefetched.
+    """
+    jar = getattr(aq_base(catalog), '_p_jar', None)
+    if jar is None:
+        return 0
+    indexes = [aq_base(catalog.getIndex(index_id)) for index_id in plan
+               if index_id in catalog.indexes]
+    count = _prefetch(jar, indexes)
+
+    lookups = []
+    for index in indexes:
+        tree = getattr(index, '_index', None)
+        if not _is_btrees(tree) or not hasattr(type(tree), '_bucket_type'):
+            continue
+        try:
+            keys = _clause_keys(index, query)
+        except Exception:
+            # the index reports invalid queries when it's searched
+            continue
+        if keys:
+            lookups.append((tree, keys))
+
+    rows = []
+    while lookups:
+        count += _prefetch(jar, [node for node, keys in lookups])
+        next_lookups = []
+        for node, keys in lookups:
+            try:
+                children, values = _lookup(node, sorted(keys))
+            except TypeError:
+                # keys which can't be compared with the keys of the index
+                continue
+            next_lookups.extend(children)
+            rows.extend(value for value in values
+                        if isinstance(value, Persistent))
+        lookups = next_lookups
+
+    count += _prefetch(jar, rows)
+    # the buckets of rows too large to be stored inline
+    buckets = []
+    for row in rows:
+        if _is_btrees(row) and hasattr(type(row), '_bucket_type'):
+            state = row.__getstate__()
+            if state is not None and len(state) > 1:
+                buckets.extend(state[0][0::2])
+    count += _prefetch(jar, buckets)
+    return count
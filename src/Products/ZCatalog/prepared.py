@@ -0,0 +1,203 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+import copy
+
+from Acquisition import aq_base
+from Acquisition import aq_parent
+
+from Products.PluginIndexes.interfaces import IQueryIndex
+from Products.PluginIndexes.interfaces import ITransposeQuery
+from Products.ZCatalog.plan import CatalogPlan
+from Products.ZCatalog.prefetch import prefetch_query
+from Products.ZCatalog.query import IndexQuery
+
+
+class PreparedQuery:
+    """A catalog query prepared once and executed many times.
+
+    The query shape is a catalog query in which the value of every key
+    to be bound at execution time is None, or a dictionary with None as
+    'query', e.g.::
+
+      {'portal_type': None,
+       'path': {'query': None, 'depth': 1},
+       'sort_on': 'modified'}
+
+    Preparing precomputes the index order, the parsed IndexQuery of every
+    clause and the query plan key.  Calling the prepared query with the
+    parameter values runs the search like `Catalog.searchResults`.
+    """
+
+    def __init__(self, catalog, shape):
+        self.catalog = catalog
+        shape = catalog.merge_query_args(shape)
+
+        self.static = {}
+        self.parameters = {}
+        for key, value in shape.items():
+            if value is None:
+                self.parameters[key] = {}
+            elif isinstance(value, dict) and value.get('query', 0) is None:
+                self.parameters[key] = dict(
+                    (k, v) for k, v in value.items() if k != 'query')
+            else:
+                self.static[key] = value
+
+        querykey_to_index = {}
+        for index in catalog.indexes.values():
+            for querykey in catalog._get_index_query_names(index):
+                querykey_to_index[querykey] = index.getId()
+        self.querykey_to_index = querykey_to_index
+
+        # ITransposeQuery indexes rewrite whole queries, these have to go
+        # through make_query on every execution.
+        self.transpose = any(ITransposeQuery.providedBy(index)
+                             for index in catalog.indexes.values())
+
+        parent = aq_base(aq_parent(catalog))
+        self.threshold = getattr(parent, 'long_query_time', 0.1)
+        self.loads = getattr(parent, 'load_accounting', False)
+        self.sample_rate = getattr(parent, 'query_sample_rate', 1)
+        self.profile_rate = getattr(parent, 'profile_rate', 0.0)
+        self.prefetch = getattr(parent, 'query_prefetch', False)
+
+        self.order = catalog._sorted_search_indexes(shape)
+        self.records = {}
+        self.index_parameters = {}
+        for index_id in self.order:
+            index = catalog.getIndex(index_id)
+            if not IQueryIndex.providedBy(index):
+                continue
+            template = {}
+            parameters = []
+            for key in catalog._get_index_query_names(index):
+                if key in self.parameters:
+                    template[key] = dict(self.parameters[key], query=())
+                    parameters.append(key)
+                elif key in self.static:
+                    template[key] = self.static[key]
+            self.index_parameters[index_id] = parameters
+            record = IndexQuery(catalog.make_query(template), index.id,
+                                index.query_options, index.operators,
+                                index.useOperator)
+            self.records[index_id] = record
+
+        # The plan key only depends on the parameter values for indexes
+        # with few distinct values, see `CatalogPlan.make_key`.
+        self.plan_key = None
+        plan = self._plan({})
+        valueindexes = plan.valueindexes()
+        if not [key for key in self.parameters if key in valueindexes]:
+            query = dict(self.static)
+            for key, options in self.parameters.items():
+                query[key] = options and dict(options, query=0) or 0
+            self.plan_key = plan.make_key(catalog.make_query(query))
+
+    def _plan(self, query, key=None):
+        return CatalogPlan(self.catalog, query, self.threshold,
+                           querykey_to_index=self.querykey_to_index,
+                           key=key, loads=self.loads,
+                           sample_rate=self.sample_rate,
+                           profile_rate=self.profile_rate,
+                           prefetch=self.prefetch)
+
+    def _record(self, index_id, params):
+        # Return a fresh IndexQuery for the index with the bound parameter
+        # values or None if the clause has to be parsed from the query.
+        template = self.records.get(index_id)
+        if template is None:
+            return None
+        keys = None
+        for name in self.index_parameters.get(index_id, ()):
+            if keys is not None:
+                # more than one parameter for the same index
+                return None
+            value = params[name]
+            if isinstance(value, (list, tuple)):
+                keys = sorted(value)
+            else:
+                keys = [value]
+        record = copy.copy(template)
+        if keys is not None:
+            record.keys = keys
+        elif record.keys is not None:
+            record.keys = list(record.keys)
+        return record
+
+    def __call__(self, query=None, **kw):
+        """Execute the prepared query with the given parameter values."""
+        catalog = self.catalog
+        values = catalog.merge_query_args(query, **kw)
+        query = dict(self.static)
+        params = {}
+        bound = not self.transpose
+        plan_key = self.plan_key
+        for key, value in values.items():
+            if key in self.parameters:
+                if isinstance(value, dict):
+                    bound = False
+                else:
+                    params[key] = value
+                    if self.parameters[key]:
+                        # keep the options given in the shape
+                        value = dict(self.parameters[key], query=value)
+            elif key in self.static:
+                if value != self.static[key]:
+                    bound = False
+            elif key in self.querykey_to_index:
+                # a clause which isn't part of the shape
+                bound = False
+            else:
+                # e.g. batching arguments, these are part of the plan key
+                plan_key = None
+            query[key] = value
+        if len(params) != len(self.parameters):
+            bound = False
+
+        if not bound:
+            # fall back to a regular search
+            return catalog.searchResults(query)
+
+        # Canonicalize tuple/list query arguments like `make_query`.
+        for key, value in query.items():
+            if isinstance(value, (list, tuple)):
+                query[key] = list(sorted(value))
+
+        cr = self._plan(query, key=plan_key)
+        cr.start()
+        try:
+            plan = cr.plan()
+            if not plan:
+                plan = self.order
+            if cr.prefetch:
+                prefetch_query(catalog, plan, query)
+
+            rs = None
+            for index_id in plan:
+                if index_id not in catalog.indexes:
+                    continue
+                record = self._record(index_id, params)
+                rs = catalog._search_index(cr, index_id, query, rs,
+                                           index_query=record)
+                if not rs:
+                    break
+
+            sort_indexes, reverse, sort_limit = catalog._sort_arguments(query)
+            return catalog._search_result(
+                cr, query, rs, sort_indexes, reverse, sort_limit, True)
+        except BaseException:
+            cr.abort()
+            raise
+
+    execute = __call__
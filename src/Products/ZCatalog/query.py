@@ -43,6 +43,8 @@ class IndexQuery:
       other parameters depend on the the index.
     """
     operators = ('or', 'and')
+    # the query plan of the catalog search, if any
+    plan = None
 
     def __init__(self, request, iid, options=(), operators=('or', 'and'),
                  default_operator='or'):
@@ -0,0 +1,333 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Timing and write accounting for cataloging objects.
+
+`CatalogPlan` covers queries.  `IndexingTelemetry` measures the other
+side: the time `index_object` and `unindex_object` take per index, the
+time spent on the metadata record and on every column of it, and the
+number of persistent objects each index modifies per transaction.
+
+In the conflict diagnostics mode it also remembers which persistent
+objects each index writes and attributes the write conflicts of failed
+commits to them, see `Hotspots`.
+"""
+
+import sys
+import time
+from _thread import allocate_lock
+
+from Acquisition import aq_base
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+from ZODB.utils import oid_repr
+
+from Products.ZCatalog.plan import BoundedNestedDict
+from Products.ZCatalog.plan import catalog_id
+
+
+OUTCOMES = ('new', 'changed', 'unchanged')
+
+# Hotspots reported per index.
+HOTSPOTS_PER_INDEX = 5
+# A conflict weighs like this many writes when hotspots are evicted.
+CONFLICT_WEIGHT = 100
+
+
+class IndexingStats:
+    """Aggregated measurements of one index, column or the metadata
+    record."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.max = 0.0
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.modified = 0
+        self.transactions = 0
+        self.transaction_modified = 0
+        self.transaction_max = 0
+
+    def record(self, duration, outcome=None, modified=None):
+        self.count += 1
+        self.duration += duration
+        if duration > self.max:
+            self.max = duration
+        if outcome is not None:
+            self.outcomes[outcome] += 1
+        if modified:
+            self.modified += modified
+
+    def record_transaction(self, modified):
+        self.transactions += 1
+        self.transaction_modified += modified
+        if modified > self.transaction_max:
+            self.transaction_max = modified
+
+    def summary(self):
+        """Return the statistics as a dict, durations in millisecond."""
+        info = {
+            'count': self.count,
+            'duration': self.duration * 1000,
+            'mean': self.count and self.duration * 1000 / self.count,
+            'max': self.max * 1000,
+            'modified': self.modified,
+            'transactions': self.transactions,
+            'modified_per_transaction': (
+                self.transactions
+                and self.transaction_modified / self.transactions),
+            'max_modified_per_transaction': self.transaction_max,
+        }
+        info.update(self.outcomes)
+        return info
+
+
+class IndexingReports(BoundedNestedDict):
+    """This holds a structure of nested dicts.
+
+    The outer dict is a mapping of catalog id to indexing reports. The
+    inner dict holds a (kind, name) to IndexingStats mapping, where kind
+    is one of 'index', 'unindex', 'metadata', 'column' or 'catalog' for
+    the catalog's own uid mappings.
+    """
+
+    lock = allocate_lock()
+    value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+
+    @classmethod
+    def record(cls, cid, kind, name, duration, outcome=None, modified=None):
+        outer = cls.get(cid)
+        with cls.lock:
+            stats = outer.get((kind, name))
+            if stats is None:
+                stats = outer[(kind, name)] = IndexingStats()
+            stats.record(duration, outcome, modified)
+        cls.weigh(cid, (kind, name), duration)
+
+    @classmethod
+    def record_transaction(cls, counts):
+        # before commit hook, see `IndexingTelemetry.stop`
+        with cls.lock:
+            for (cid, key), modified in counts.items():
+                stats = cls.value.get(cid, {}).get(key)
+                if stats is not None:
+                    stats.record_transaction(modified)
+
+
+class HotspotStats:
+    """Number of transactions which wrote a persistent object and how many
+    of them failed with a write conflict on it."""
+
+    def __init__(self):
+        self.writes = 0
+        self.conflicts = 0
+
+
+class Hotspots(BoundedNestedDict):
+    """This holds a structure of nested dicts.
+
+    The outer dict is a mapping of catalog id to hotspots. The inner dict
+    holds an (index name, structure, oid) to HotspotStats mapping, where
+    structure names the attribute holding the object or its class.
+    `totals` maps catalog ids to the number of transactions writing to
+    the catalog and the number of them which failed with a conflict.
+    """
+
+    lock = allocate_lock()
+    value = {}
+    weights = {}
+    floors = {}
+    evictions = {}
+    totals = {}
+
+    @classmethod
+    def clear(cls):
+        super().clear()
+        cls.totals = {}
+
+    @classmethod
+    def clear_entry(cls, key):
+        super().clear_entry(key)
+        cls.totals.pop(key, None)
+
+    @classmethod
+    def record_transaction(cls, status, writes):
+        # after commit hook, see `IndexingTelemetry._record_writes`
+        conflict = None
+        if not status:
+            error = sys.exc_info()[1]
+            if isinstance(error, ConflictError):
+                conflict = error.oid
+        cids = set()
+        for cid, name, structure, oid in writes:
+            cids.add(cid)
+            key = (name, structure, oid)
+            conflicted = conflict is not None and oid == conflict
+            outer = cls.get(cid)
+            with cls.lock:
+                stats = outer.get(key)
+                if stats is None:
+                    stats = outer[key] = HotspotStats()
+                stats.writes += 1
+                if conflicted:
+                    stats.conflicts += 1
+            cls.weigh(cid, key, 1 + conflicted * CONFLICT_WEIGHT)
+        with cls.lock:
+            for cid in cids:
+                transactions, conflicts = cls.totals.get(cid, (0, 0))
+                cls.totals[cid] = (transactions + 1,
+                                   conflicts + (conflict is not None))
+
+
+def _structures(owner):
+    # Name the persistent attributes of an index or the catalog, of their
+    # persistent attributes and of a ZCTextIndex lexicon by id.
+    labels = {}
+
+    def walk(obj, prefix, depth):
+        for attr, value in getattr(obj, '__dict__', {}).items():
+            if attr.startswith('_v_') or not isinstance(value, Persistent):
+                continue
+            if id(value) not in labels:
+                labels[id(value)] = prefix + attr
+                if depth:
+                    walk(value, prefix + attr + '.', depth - 1)
+
+    walk(aq_base(owner), '', 1)
+    get_lexicon = getattr(owner, 'getLexicon', None)
+    if get_lexicon is not None:
+        lexicon = get_lexicon()
+        labels[id(aq_base(lexicon))] = 'lexicon'
+        walk(aq_base(lexicon), 'lexicon.', 0)
+    return labels
+
+
+class IndexingTelemetry:
+    """Measure the indexing steps of a catalog."""
+
+    def __init__(self, catalog, hotspots=False):
+        self.cid = catalog_id(catalog)
+        self.jar = getattr(aq_base(catalog), '_p_jar', None)
+        self.hotspots = hotspots
+
+    def _registered(self):
+        # Objects modified in the current transaction are registered with
+        # the connection once.
+        if self.jar is None:
+            return None
+        return len(self.jar._registered_objects)
+
+    def start(self):
+        return time.perf_counter_ns(), self._registered()
+
+    def stop(self, kind, name, start, outcome=None, owner=None):
+        started, registered = start
+        duration = (time.perf_counter_ns() - started) / 1e9
+        modified = None
+        if registered is not None:
+            modified = self._registered() - registered
+            if modified > 0:
+                self._count_transaction((kind, name), modified)
+                if self.hotspots and owner is not None:
+                    label = name
+                    if kind not in ('index', 'unindex'):
+                        # metadata and uid mappings
+                        label = 'catalog'
+                    self._record_writes(label, registered, owner)
+        IndexingReports.record(
+            self.cid, kind, name, duration, outcome, modified)
+
+    def _record_writes(self, name, registered, owner):
+        objects = self.jar._registered_objects[registered:]
+        labels = _structures(owner)
+        txn = self.jar.transaction_manager.get()
+        try:
+            writes = txn.data(Hotspots)
+        except KeyError:
+            writes = set()
+            txn.set_data(Hotspots, writes)
+            txn.addAfterCommitHook(Hotspots.record_transaction, (writes, ))
+        for obj in objects:
+            structure = labels.get(id(obj), obj.__class__.__name__)
+            writes.add((self.cid, name, structure, obj._p_oid))
+
+    def _count_transaction(self, key, modified):
+        txn = self.jar.transaction_manager.get()
+        try:
+            counts = txn.data(IndexingReports)
+        except KeyError:
+            counts = {}
+            txn.set_data(IndexingReports, counts)
+            txn.addBeforeCommitHook(
+                IndexingReports.record_transaction, (counts, ))
+        key = (self.cid, key)
+        counts[key] = counts.get(key, 0) + modified
+
+    def reset(self):
+        IndexingReports.clear_entry(self.cid)
+        Hotspots.clear_entry(self.cid)
+
+    def report(self):
+        """Returns the indexing statistics as list of dicts, the most
+        expensive first. The durations are provided in millisecond.
+        """
+        rval = []
+        for (kind, name), stats in IndexingReports.get(self.cid).items():
+            info = stats.summary()
+            info['kind'] = kind
+            info['id'] = name
+            rval.append(info)
+        rval.sort(key=lambda info: info['duration'], reverse=True)
+        return rval
+
+    def hotspot_report(self, limit=HOTSPOTS_PER_INDEX):
+        """Returns the persistent objects written most often and with the
+        most conflicts for each index as dict with the number of
+        transactions and conflicts and a list of dicts per index.
+        """
+        by_index = {}
+        for (name, structure, oid), stats in Hotspots.get(self.cid).items():
+            by_index.setdefault(name, []).append({
+                'structure': structure,
+                'oid': oid_repr(oid),
+                'writes': stats.writes,
+                'conflicts': stats.conflicts,
+            })
+        indexes = []
+        for name, hotspots in by_index.items():
+            hotspots.sort(key=lambda info: (info['conflicts'],
+                                            info['writes']), reverse=True)
+            indexes.append({
+                'id': name,
+                'conflicts': sum(info['conflicts'] for info in hotspots),
+                'hotspots': hotspots[:limit],
+            })
+        indexes.sort(key=lambda info: (
+            info['conflicts'], info['hotspots'][0]['writes']), reverse=True)
+        transactions, conflicts = Hotspots.totals.get(self.cid, (0, 0))
+        return {
+            'transactions': transactions,
+            'conflicts': conflicts,
+            'indexes': indexes,
+        }
+
+
+# Make sure we provide test isolation
+from zope.testing.cleanup import addCleanUp  # NOQA
+
+
+addCleanUp(IndexingReports.clear)
+addCleanUp(Hotspots.clear)
+del addCleanUp
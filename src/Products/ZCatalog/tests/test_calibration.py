@@ -0,0 +1,51 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import unittest
+
+from zope.testing import cleanup
+
+from Products.ZCatalog.plan import DEFAULT_THRESHOLDS
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class TestCalibration(cleanup.CleanUp, unittest.TestCase):
+
+    def _makeOne(self):
+        return ZCatalog('catalog')
+
+    def test_calibrate(self):
+        from ..calibration import calibrate
+        zcat = self._makeOne()
+        thresholds = calibrate(zcat._catalog, repeat=1, store=False, seed=1)
+        self.assertEqual(set(thresholds), set(DEFAULT_THRESHOLDS))
+        for value in thresholds.values():
+            self.assertGreaterEqual(value, 1)
+        self.assertEqual(zcat._catalog.getThresholds(), DEFAULT_THRESHOLDS)
+
+    def test_calibrate_store(self):
+        zcat = self._makeOne()
+        thresholds = zcat._catalog.calibrate(repeat=1)
+        self.assertEqual(zcat._catalog.getThresholds(), thresholds)
+        self.assertIn('THRESHOLDS', zcat.getCatalogPlan())
+
+    def test_manage_calibrate(self):
+        zcat = self._makeOne()
+        zcat.manage_calibrate()
+        self.assertEqual(len(zcat.getCatalogThresholds()),
+                         len(DEFAULT_THRESHOLDS))
+
+    def test_calibrate_or(self):
+        from ..calibration import calibrate_or
+        threshold = calibrate_or(2000, repeat=1)
+        self.assertTrue(1 <= threshold <= 2000)
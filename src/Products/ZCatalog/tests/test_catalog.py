@@ -16,12 +16,18 @@ import unittest
 from itertools import chain
 
 import ExtensionClass
+from Acquisition import aq_base
 from BTrees.IIBTree import IISet
+from zope.interface import implementer_only
 
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import \
+    DateRangeIndex
 from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.interfaces import IPluggableIndex
 from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
 from Products.ZCTextIndex.OkapiIndex import OkapiIndex
 from Products.ZCTextIndex.ZCTextIndex import PLexicon
+from Products.ZCatalog.query import IndexQuery
 from Products.ZCTextIndex.ZCTextIndex import ZCTextIndex
 
 
@@ -61,6 +67,14 @@ class MultiFieldIndex(FieldIndex):
         return [self.id, 'bar']
 
 
+@implementer_only(IPluggableIndex)
+class UnlimitedFieldIndex(FieldIndex):
+    # A field index which ignores the incoming result set.
+
+    def _apply_index(self, request):
+        return FieldIndex._apply_index(self, request)
+
+
 class ObjRS(ExtensionClass.Base):
 
     def __init__(self, num):
@@ -420,6 +434,422 @@ class TestCatalog(unittest.TestCase):
             a = catalog({'keywords': {"not": [10]}, 'field': 'foo'})
             self.assertEqual(len(a), 2)
 
+    def _make_facets(self):
+        from Products.ZCatalog.Catalog import Catalog
+        catalog = Catalog()
+        catalog.addIndex('num', FieldIndex('num'))
+        catalog.addIndex('parity', FieldIndex('parity'))
+        catalog.addIndex('keywords', KeywordIndex('keywords'))
+
+        class FacetDummy(ExtensionClass.Base):
+
+            def __init__(self, num):
+                self.num = num
+                self.parity = num % 2 and 'odd' or 'even'
+                self.keywords = [k for k in ('two', 'three', 'five')
+                                 if num % {'two': 2, 'three': 3,
+                                           'five': 5}[k] == 0]
+
+        for x in range(30):
+            catalog.catalogObject(FacetDummy(x), repr(x))
+        return catalog.__of__(Dummy('foo'))
+
+    def test_facets(self):
+        from Products.ZCatalog import Catalog as catalog_module
+        catalog = self._make_facets()
+        rs = catalog.search({'num': {'query': 10, 'range': 'max'}},
+                            merge=False)
+        rs = IISet([r.getRID() for r in rs])
+        expected = {
+            'parity': [('even', 6), ('odd', 5)],
+            'keywords': [('two', 6), ('three', 4), ('five', 3)],
+        }
+        for cost in (0, 10 ** 6):
+            # force the lookup and intersection strategy
+            old_cost = catalog_module.FACET_LOOKUP_COST
+            catalog_module.FACET_LOOKUP_COST = cost
+            try:
+                result = catalog.facets(rs, ['parity', 'keywords'])
+            finally:
+                catalog_module.FACET_LOOKUP_COST = old_cost
+            self.assertEqual(result, expected)
+
+        result = catalog.facets(rs, 'keywords', limit=2)
+        self.assertEqual(result, {'keywords': [('two', 6), ('three', 4)]})
+        self.assertEqual(catalog.facets(None, ['parity']), {'parity': []})
+
+    def test_facets_boolean(self):
+        from Products.PluginIndexes.BooleanIndex.BooleanIndex import \
+            BooleanIndex
+        from Products.ZCatalog import Catalog as catalog_module
+        catalog = self._make_facets()
+        catalog.addIndex('small', BooleanIndex('small', 'num'))
+        for x in range(30):
+            obj = ZDummy(x)
+            obj.small = x < 10
+            catalog.catalogObject(obj, repr(x), idxs=['small'])
+        rs = IISet(catalog.uids.values())
+        results = []
+        for cost in (0, 10 ** 6):
+            old_cost = catalog_module.FACET_LOOKUP_COST
+            catalog_module.FACET_LOOKUP_COST = cost
+            try:
+                result = catalog.facets(rs, ['small'])['small']
+            finally:
+                catalog_module.FACET_LOOKUP_COST = old_cost
+            results.append([(type(v), v, c) for v, c in result])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], [(int, 0, 20), (int, 1, 10)])
+
+    def test_searchFacets(self):
+        catalog = self._make_facets()
+        result = catalog.searchFacets({'parity': 'odd'},
+                                      ['keywords', 'parity'], limit=1)
+        self.assertEqual(result, {'keywords': [('three', 5)],
+                                  'parity': [('odd', 15)]})
+
+    def test_facets_unknown_index(self):
+        from Products.ZCatalog.Catalog import CatalogError
+        catalog = self._make_facets()
+        self.assertRaises(CatalogError, catalog.facets, IISet([1]), ['foo'])
+
+    def test_count_only(self):
+        catalog = self._make_facets()
+        query = {'parity': 'odd', 'keywords': 'three'}
+        self.assertEqual(catalog.searchResults(query, count_only=True), 5)
+        self.assertEqual(
+            catalog.search({'keywords': 'none'}, count_only=True), 0)
+        self.assertEqual(catalog.searchResults(count_only=True), 0)
+
+    def test_count_only_shortcut(self):
+        from unittest.mock import patch
+
+        from Products.ZCatalog.Catalog import Catalog
+        catalog = self._make_facets()
+        with patch.object(Catalog, '_search_indexes') as search_indexes:
+            self.assertEqual(
+                catalog.searchResults(parity='even', count_only=True), 15)
+            self.assertEqual(
+                catalog.searchResults(keywords=['five'], count_only=True), 6)
+            self.assertEqual(
+                catalog.searchResults(num=3, count_only=True), 1)
+            self.assertFalse(search_indexes.called)
+        # options need the result set
+        self.assertEqual(catalog.searchResults(
+            num={'query': 3, 'range': 'min'}, count_only=True), 27)
+
+    def test_count_only_date_range(self):
+        catalog = self._make_facets()
+        catalog.addIndex('work', DateRangeIndex('work', 'num', 'until'))
+        for path in list(catalog.paths.values()):
+            obj = ZDummy(int(path))
+            obj.until = obj.num + 5
+            catalog.catalogObject(obj, path)
+        self.assertEqual(catalog.searchResults(work=3, count_only=True), 4)
+
+    def test_rids_only(self):
+        catalog = self._make_facets()
+        rids = catalog.searchResults(
+            {'keywords': 'five'}, sort_on='num', rids_only=True)
+        self.assertIsInstance(rids, IISet)
+        self.assertEqual(
+            sorted(catalog.paths[rid] for rid in rids),
+            sorted(repr(x) for x in range(0, 30, 5)))
+        rids = catalog.search({'keywords': 'none'}, rids_only=True)
+        self.assertIsInstance(rids, IISet)
+        self.assertEqual(len(rids), 0)
+
+    def _page(self, catalog, query, b_size):
+        pages = []
+        token = ''
+        while token is not None:
+            query['search_after'] = token
+            result = catalog.searchResults(query, b_size=b_size)
+            pages.append([catalog.paths[b.getRID()] for b in result])
+            token = result.next_search_after
+        return pages
+
+    def test_search_after(self):
+        catalog = self._make_facets()
+        query = {'parity': 'odd', 'sort_on': 'num'}
+        pages = self._page(catalog, query, 4)
+        expected = [repr(x) for x in range(1, 30, 2)]
+        self.assertEqual(pages, [expected[:4], expected[4:8],
+                                 expected[8:12], expected[12:]])
+
+        query['sort_order'] = 'reverse'
+        pages = self._page(catalog, query, 5)
+        expected.reverse()
+        self.assertEqual(pages, [expected[:5], expected[5:10],
+                                 expected[10:], []])
+
+    def test_search_after_ties(self):
+        catalog = self._make_facets()
+        query = {'num': {'query': 10, 'range': 'max'},
+                 'sort_on': ['parity', 'num'],
+                 'sort_order': ['ascending', 'descending']}
+        pages = self._page(catalog, query, 4)
+        self.assertEqual(
+            sum(pages, []),
+            [repr(x) for x in (10, 8, 6, 4, 2, 0, 9, 7, 5, 3, 1)])
+        self.assertEqual(len(pages), 3)
+
+        # unsorted results are paged in rid order
+        pages = self._page(catalog, {'parity': 'even'}, 10)
+        rids = [catalog.uids[p] for p in sum(pages, [])]
+        self.assertEqual(rids, sorted(set(rids)))
+        self.assertEqual(len(rids), 15)
+        self.assertEqual([len(p) for p in pages], [10, 5])
+
+    def test_search_after_strategies(self):
+        from ..plan import CatalogPlan
+        catalog = self._make_facets()
+        query = {'parity': 'odd', 'sort_on': 'num'}
+        rs = IISet([catalog.uids[repr(x)] for x in range(1, 30, 2)])
+        expected = [repr(x) for x in range(1, 30, 2)]
+        # small batches walk the sort index, larger ones sort the result
+        # set as there are many more sort values than results
+        for b_size, strategy in ((3, 'search_after_index'),
+                                 (8, 'search_after_resultset')):
+            pages = self._page(catalog, dict(query), b_size)
+            self.assertEqual(sum(pages, []), expected)
+            pages = self._page(catalog, dict(query, sort_order='reverse'),
+                               b_size)
+            self.assertEqual(sum(pages, []), expected[::-1])
+            plan = CatalogPlan(catalog, query)
+            catalog._search_after(rs, catalog.getIndex('num'), True,
+                                  b_size, '', len(rs), plan=plan)
+            self.assertEqual(plan.strategies['sort_on'], strategy)
+
+    def test_search_after_invalid(self):
+        catalog = self._make_facets()
+        result = catalog.searchResults(
+            parity='odd', sort_on='num', b_size=2, search_after='')
+        token = result.next_search_after
+        self.assertRaises(ValueError, catalog.searchResults,
+                          parity='odd', sort_on='parity', b_size=2,
+                          search_after=token)
+        self.assertRaises(ValueError, catalog.searchResults,
+                          parity='odd', sort_on='num', b_size=2,
+                          search_after='garbage')
+        self.assertRaises(ValueError, catalog.searchResults,
+                          parity='odd', sort_on='num', search_after='')
+        from Products.ZCatalog.Catalog import CatalogError
+        self.assertRaises(CatalogError, catalog.searchResults,
+                          parity='odd', sort_on='keywords', b_size=2,
+                          search_after='')
+
+    def test_search_after_dates(self):
+        from datetime import date
+        from datetime import datetime
+
+        from DateTime import DateTime
+
+        from Products.ZCatalog.Catalog import Catalog
+        from Products.ZCatalog.Catalog import CatalogError
+        catalog = Catalog()
+        for name in ('num', 'modified', 'day', 'when', 'pair'):
+            catalog.addIndex(name, FieldIndex(name))
+        for x in range(10):
+            obj = ZDummy(x)
+            obj.modified = DateTime('2020/01/01 10:00:00.5 GMT+2') + x
+            obj.day = date(2020, 1, 1 + x % 4)
+            obj.when = datetime(2020, 1, 1, 12, x)
+            obj.pair = (x, x)
+            catalog.catalogObject(obj, repr(x))
+        catalog = catalog.__of__(Dummy('foo'))
+        query = {'num': {'query': 0, 'range': 'min'}, 'sort_on': 'modified'}
+        pages = self._page(catalog, query, 3)
+        expected = [repr(x) for x in range(10)]
+        self.assertEqual(pages, [expected[:3], expected[3:6],
+                                 expected[6:9], expected[9:]])
+
+        query['sort_on'] = ['day', 'when']
+        pages = self._page(catalog, query, 4)
+        self.assertEqual(
+            sum(pages, []),
+            [repr(x) for x in (0, 4, 8, 1, 5, 9, 2, 6, 3, 7)])
+        self.assertEqual(len(pages), 3)
+
+        # sort keys which can't be put into a token
+        self.assertRaises(CatalogError, catalog.searchResults,
+                          num={'query': 0, 'range': 'min'}, sort_on='pair',
+                          b_size=3, search_after='')
+
+    def test_search_after_ranked(self):
+        from Products.ZCatalog.Catalog import CatalogError
+        catalog = self._make_one()
+        self.assertRaises(CatalogError, catalog.searchResults,
+                          att2='att2', b_size=3, search_after='')
+        pages = self._page(catalog, {'att2': 'att2', 'sort_on': 'att1'}, 3)
+        self.assertEqual(len(sum(pages, [])), self.upper)
+
+    def test_searchMany(self):
+        from unittest.mock import patch
+        catalog = self._make_facets()
+        queries = [
+            {'parity': 'odd', 'keywords': 'three'},
+            {'parity': 'odd', 'keywords': 'five', 'sort_on': 'num',
+             'sort_order': 'reverse'},
+            {'parity': 'odd', 'keywords': ['three', 'five'],
+             'num': {'query': 20, 'range': 'min'}},
+            {'parity': 'even', 'keywords': 'three'},
+            {'num': 3},
+        ]
+        expected = [[b.getRID() for b in catalog.searchResults(q)]
+                    for q in queries]
+
+        calls = []
+        original = FieldIndex.query_index
+
+        def query_index(self, record, resultset=None):
+            if record.id == 'parity':
+                calls.append(record.keys)
+            return original(self, record, resultset)
+
+        with patch.object(FieldIndex, 'query_index', query_index):
+            results = catalog.searchMany(queries)
+        self.assertEqual(
+            [[b.getRID() for b in result] for result in results], expected)
+        # the shared parity clause is only evaluated once
+        self.assertEqual(calls, [['odd'], ['even']])
+
+    def test_searchMany_empty(self):
+        catalog = self._make_facets()
+        results = catalog.searchMany(
+            [{'parity': 'odd', 'num': 2}, {'parity': 'odd', 'num': 3}, {}])
+        self.assertEqual([len(r) for r in results], [0, 1, 0])
+
+    def test_prepare(self):
+        from unittest.mock import patch
+        catalog = self._make_facets()
+        prepared = catalog.prepare({
+            'parity': None,
+            'num': {'query': None, 'range': 'min'},
+            'sort_on': 'num',
+            'sort_order': 'reverse'})
+
+        def rids(result):
+            return [b.getRID() for b in result]
+
+        with patch('Products.ZCatalog.Catalog.IndexQuery',
+                   wraps=IndexQuery) as index_query:
+            for parity, num in (('odd', 20), ('even', 3), ('even', 40),
+                                (['odd', 'even'], 25)):
+                expected = catalog.searchResults(
+                    parity=parity, num={'query': num, 'range': 'min'},
+                    sort_on='num', sort_order='reverse')
+                index_query.reset_mock()
+                result = prepared(parity=parity, num=num)
+                self.assertEqual(rids(result), rids(expected))
+                self.assertFalse(index_query.called)
+
+        # batching arguments
+        result = prepared(parity='odd', num=0, b_start=2, b_size=3)
+        self.assertEqual([catalog.paths[r] for r in rids(result)[:3]],
+                         ['25', '23', '21'])
+
+    def test_prepare_fallback(self):
+        catalog = self._make_facets()
+        prepared = catalog.prepare({'parity': None, 'keywords': 'five'})
+        # a different static value, an additional clause, a full clause
+        # for a parameter and a missing parameter use a regular search
+        for kw, expected in (
+                ({'parity': 'odd', 'keywords': 'three'}, 5),
+                ({'parity': 'odd', 'num': 15}, 1),
+                ({'parity': {'query': 'odd', 'not': 'even'}}, 3),
+                ({}, 6)):
+            self.assertEqual(len(prepared(**kw)), expected, kw)
+        self.assertEqual(len(prepared(parity='odd')), 3)
+
+    def test_facets_request_cache(self):
+        from OFS.SimpleItem import SimpleItem
+        from Testing.makerequest import makerequest
+        catalog = self._make_facets()
+        parent = Dummy('foo')
+        parent.REQUEST = makerequest(SimpleItem()).REQUEST
+        catalog = aq_base(catalog).__of__(parent)
+        query = {'keywords': 'three'}
+        result = catalog.searchFacets(query, ['parity'])
+        cache = catalog.getIndex('parity').getRequestCache()
+        stats = cache.stats()
+        self.assertEqual(catalog.searchFacets(query, ['parity']), result)
+        self.assertEqual(cache.stats()['sets'], stats['sets'])
+        self.assertEqual(cache.stats()['hits'], stats['hits'] + 2)
+
+        # a change to a searched index makes it a different result set
+        catalog.uncatalogObject('3')
+        stats = cache.stats()
+        self.assertEqual(catalog.searchFacets(query, ['parity']),
+                         {'parity': [('even', 5), ('odd', 4)]})
+        self.assertEqual(cache.stats()['hits'], stats['hits'])
+
+        # result sets without a query aren't cached
+        stats = cache.stats()
+        catalog.facets(IISet(range(10)), ['parity'])
+        self.assertEqual(cache.stats(), stats)
+
+    def test_explain(self):
+        catalog = self._make_facets()
+        explained = catalog.explain({
+            'keywords': 'three',
+            'parity': {'query': 'odd', 'not': 'even'},
+            'num': {'query': 20, 'range': 'max'},
+            'sort_on': 'num', 'sort_order': 'reverse', 'sort_limit': 2})
+        self.assertEqual(explained['source'], 'default')
+        self.assertEqual(explained['order'], ['keywords', 'num', 'parity'])
+        self.assertEqual(
+            [(s['input'], s['output']) for s in explained['steps']],
+            [(None, 10), (10, 7), (7, 3)])
+        steps = explained['steps']
+        self.assertEqual(steps[0]['record'],
+                         {'keys': ['three'], 'operator': 'or'})
+        self.assertEqual(steps[1]['record'],
+                         {'keys': [20], 'operator': 'or', 'range': 'max'})
+        self.assertEqual(steps[2]['record']['not'], ['even'])
+        self.assertIsNone(steps[0]['cached'])
+        self.assertNotIn('duration', steps[0])
+        self.assertEqual(explained['result'], 3)
+        self.assertEqual(explained['sort'], {
+            'indexes': ['num'], 'reverse': True, 'limit': 2,
+            'strategy': 'sort_iterate_resultset',
+            'reason': 'limit close to the result size'})
+        self.assertNotIn('duration', explained)
+
+        # explaining doesn't update the query plan
+        self.assertIsNone(catalog.getCatalogPlan(explained['query']).plan())
+        catalog.searchResults(explained['query'])
+        explained = catalog.explain(explained['query'], analyze=True)
+        self.assertEqual(explained['source'], 'benchmark')
+        self.assertIsNotNone(explained['steps'][0]['benchmark'])
+        self.assertIn('duration', explained['steps'][0])
+        self.assertIn('intersection', explained['steps'][1])
+        self.assertIn('duration', explained['sort'])
+        self.assertIn('duration', explained)
+
+    def test_explain_empty(self):
+        catalog = self._make_facets()
+        explained = catalog.explain(
+            {'keywords': 'seven', 'num': 3, 'sort_on': 'num'}, analyze=True)
+        self.assertEqual(len(explained['steps']), 1)
+        self.assertEqual(explained['result'], 0)
+        self.assertIsNone(explained['sort'])
+
+    def test_explain_nbest(self):
+        from ..plan import catalog_id
+        from ..plan import set_thresholds
+        catalog = self._make_facets()
+        set_thresholds(catalog_id(catalog), {'sort_nbest_factor': 2})
+        try:
+            explained = catalog.explain(
+                {'parity': 'even', 'sort_on': 'num', 'sort_limit': 3},
+                analyze=True)
+        finally:
+            set_thresholds(catalog_id(catalog), None)
+        self.assertEqual(explained['sort']['strategy'], 'sort_nbest_reverse')
+        self.assertEqual(explained['sort']['reason'],
+                         'limit small compared to the result')
+
 
 class TestCatalogSortBatch(unittest.TestCase):
 
@@ -473,13 +903,23 @@ class TestCatalogSortBatch(unittest.TestCase):
         self.assertEqual(set(result), {'att1', 'att2', 'num'})
 
     def test_sorted_search_indexes_priority(self):
-        # att2 and col2 don't support ILimitedResultIndex, att1 does
-        catalog = self._make_one()
-        query = {'att1': 'a', 'att2': 'b', 'col2': 'c'}
+        # att3 and col2 don't support ILimitedResultIndex, att1 does
+        def extra(catalog):
+            catalog.addIndex('att3', UnlimitedFieldIndex('att3'))
+
+        catalog = self._make_one(extra=extra)
+        query = {'att1': 'a', 'att3': 'b', 'col2': 'c'}
         result = catalog._sorted_search_indexes(query)
-        self.assertEqual(result.index('att2'), 0)
+        self.assertEqual(result.index('att3'), 0)
         self.assertEqual(result.index('att1'), 1)
 
+    def test_sorted_search_indexes_text_limited(self):
+        # ZCTextIndex supports ILimitedResultIndex as well
+        catalog = self._make_one()
+        query = {'att1': 'a', 'att2': 'b'}
+        result = catalog._sorted_search_indexes(query)
+        self.assertEqual(result, ['att1', 'att2'])
+
     def test_sorted_search_indexes_match_alternate_attr(self):
         catalog = self._make_one()
         query = {'bar': 'b'}
@@ -0,0 +1,305 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import unittest
+
+import transaction
+from BTrees.check import check
+from BTrees.IIBTree import IITreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from ZODB.POSException import ConflictError
+from zope.testing import cleanup
+
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import \
+    DateRangeIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.ZCatalog.Catalog import CatalogError
+from Products.ZCatalog.footprint import _bucket_type
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class Dummy:
+
+    def __init__(self, num):
+        self.num = num
+        self.start = num
+        self.end = num + 10
+
+
+class TestCompactTree(unittest.TestCase):
+
+    def _compact(self, tree, **kw):
+        from Products.ZCatalog.compaction import compact_tree
+        return compact_tree(tree, **kw)
+
+    def _buckets(self, tree):
+        from Products.ZCatalog.compaction import _bucket_count
+        return _bucket_count(tree)
+
+    def test_btree(self):
+        tree = OOBTree()
+        for i in range(20000):
+            tree['%05d' % i] = i
+        compacted = self._compact(tree)
+        self.assertIsNot(compacted, tree)
+        compacted._check()
+        check(compacted)
+        self.assertEqual(list(compacted.items()), list(tree.items()))
+        # keys inserted in order leave the buckets half full
+        self.assertLess(self._buckets(compacted), self._buckets(tree) * 0.6)
+
+    def test_treeset(self):
+        treeset = IITreeSet(range(0, 100000, 3))
+        compacted = self._compact(treeset)
+        compacted._check()
+        check(compacted)
+        self.assertEqual(list(compacted), list(treeset))
+        self.assertLess(self._buckets(compacted), self._buckets(treeset))
+
+    def test_compact(self):
+        tree = IOBTree()
+        tree.update({i: str(i) for i in range(10)})
+        self.assertIs(self._compact(tree), tree)
+        self.assertIs(self._compact(IOBTree()).__class__, IOBTree)
+
+    def test_values(self):
+        tree = OOBTree()
+        tree['a'] = 1
+        tree['b'] = IITreeSet(range(10000))
+        compacted = self._compact(tree)
+        # the tree itself is compact, its large value is replaced
+        self.assertIs(compacted, tree)
+        self.assertEqual(tree['a'], 1)
+        tree['b']._check()
+        self.assertEqual(list(tree['b']), list(range(10000)))
+
+    def test_chunks(self):
+        from unittest.mock import patch
+        tree = IOBTree()
+        for i in range(1000):
+            tree[i * 2] = IITreeSet(range(i % 7))
+        with patch('Products.ZCatalog.compaction.CHUNK_SIZE', 30):
+            compacted = self._compact(tree)
+        self.assertIsNot(compacted, tree)
+        compacted._check()
+        self.assertEqual([(k, list(v)) for k, v in compacted.items()],
+                         [(k, list(v)) for k, v in tree.items()])
+
+    def test_int_rows(self):
+        tree = OOBTree()
+        tree['a'] = 1
+        tree['b'] = IITreeSet((2, 3))
+        self._compact(tree, int_rows=True)
+        self.assertIsInstance(tree['a'], IITreeSet)
+        self.assertEqual(list(tree['a']), [1])
+        self.assertEqual(list(tree['b']), [2, 3])
+
+
+class TestCompaction(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.zcat = ZCatalog('catalog')
+        self.zcat.addIndex('num', FieldIndex('num'))
+        self.zcat.addIndex('range', DateRangeIndex('range', 'start', 'end'))
+        self.zcat.addColumn('num')
+        for i in range(2000):
+            self.zcat.catalog_object(Dummy(i % 50), str(i))
+
+    def _query(self):
+        return [
+            [brain.getRID() for brain in self.zcat(num=7)],
+            [brain.getRID() for brain in self.zcat(num={
+                'query': (10, 20), 'range': 'min:max'})],
+            [brain.getRID() for brain in self.zcat(range=15)],
+            [brain.num for brain in self.zcat(num=3, sort_on='num')],
+        ]
+
+    def test_compactCatalog(self):
+        results = self._query()
+        report = self.zcat.compactCatalog()
+        self.assertLess(report['objects_after'], report['objects_before'])
+        indexes = {index['id']: index for index in report['indexes']}
+        self.assertIn('catalog', indexes)
+        structures = {info['id']: info
+                      for info in indexes['num']['structures']}
+        unindex = structures['_unindex']
+        self.assertLess(unindex['objects_after'], unindex['objects_before'])
+        self.assertGreater(unindex['fill_after'], unindex['fill_before'])
+
+        self.assertEqual(self._query(), results)
+        catalog = self.zcat._catalog
+        catalog.getIndex('num')._unindex._check()
+        catalog.data._check()
+        self.assertEqual(len(catalog.paths), 2000)
+
+        # further cataloging works on the compacted trees
+        self.zcat.catalog_object(Dummy(7), 'new')
+        self.assertEqual(len(self.zcat(num=7)), 41)
+        self.zcat.uncatalog_object('new')
+        self.assertEqual(self._query(), results)
+
+    def test_compactIndex(self):
+        index = self.zcat._catalog.getIndex('num')
+        index._index[1000] = 5000
+        report = self.zcat.compactIndex('num')
+        self.assertEqual([info['id'] for info in report['indexes']], ['num'])
+        self.assertIsInstance(index._index[1000], IITreeSet)
+        with self.assertRaises(CatalogError):
+            self.zcat.compactIndex('missing')
+
+    def test_collect_values(self):
+        index = self.zcat._catalog.getIndex('num')
+        index.setDictionaryEncoding(True)
+        for i in range(49, 2000, 50):
+            self.zcat.catalog_object(Dummy(1000), str(i))
+        self.assertIsNotNone(index._unindex.ordinal(49))
+        self.zcat.compactIndex('num')
+        self.assertIsNone(index._unindex.ordinal(49))
+        self.assertEqual(index.getEntryForObject(
+            self.zcat._catalog.uids['99']), 1000)
+
+    def test_progress(self):
+        from Products.ZCatalog.ProgressHandler import StdoutHandler
+
+        class Handler(StdoutHandler):
+
+            def output(self, text):
+                self.messages.append(text)
+
+        handler = Handler(1)
+        handler.messages = []
+        self.zcat.compactIndex('range', pghandler=handler)
+        self.assertIn('Process started', handler.messages[0])
+        self.assertIn('Process terminated', handler.messages[-1])
+
+
+class TestConcurrentCompaction(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.db = DB(MappingStorage())
+        conn = self.db.open()
+        zcat = conn.root()['catalog'] = ZCatalog('catalog')
+        zcat.addIndex('num', FieldIndex('num'))
+        for i in range(2000):
+            zcat.catalog_object(Dummy(i % 50), str(i))
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+        cleanup.CleanUp.tearDown(self)
+
+    def _open(self, tm=None):
+        return self.db.open(transaction_manager=tm).root()['catalog']
+
+    def test_measure(self):
+        from Products.ZCatalog.compaction import _nodes
+        from Products.ZCatalog.footprint import measure
+        zcat = self._open()
+        conn = zcat._p_jar
+        conn.cacheMinimize()
+        index = zcat._catalog.getIndex('num')
+        # objects loaded for measuring are ghosts again and may be freed
+        objects = measure(index._index)['objects']
+        expected = 0
+        for node in _nodes(index._index):
+            expected += 1
+            if _bucket_type(node) is not None:
+                expected += sum(len(list(_nodes(row)))
+                                for row in node.values())
+        self.assertEqual(objects, expected)
+
+        conn.cacheMinimize()
+        report = zcat.compactCatalog()
+        self.assertLess(report['objects_after'], report['objects_before'])
+
+    def _transactions(self):
+        return [txn.description for txn in self.db.storage.iterator()]
+
+    def test_commits(self):
+        zcat = self._open()
+        before = len(self._transactions())
+        zcat.compactIndex('num')
+        descriptions = self._transactions()[before:]
+        # a transaction per compacted structure
+        self.assertGreater(len(descriptions), 1)
+        self.assertIn(b'Compacted num _unindex', descriptions)
+
+    def test_concurrent_change(self):
+        zcat = self._open()
+        zcat._catalog.getIndex('num')._unindex._p_activate()
+
+        # another connection reindexes a document in the meantime
+        tm = transaction.TransactionManager()
+        other = self._open(tm)
+        dummy = Dummy(1000)
+        other.catalog_object(dummy, '7')
+        tm.commit()
+
+        # copying the trees it has read doesn't lose the change, the
+        # structures are compacted again from the current state
+        report = zcat.compactIndex('num')
+        self.assertLess(report['objects_after'], report['objects_before'])
+        self.assertEqual([brain.getPath() for brain in zcat(num=1000)],
+                         ['7'])
+        zcat = self._open()
+        self.assertEqual([brain.getPath() for brain in zcat(num=1000)],
+                         ['7'])
+
+    def test_concurrent_change_retries(self):
+        from unittest.mock import patch
+        zcat = self._open()
+        zcat._catalog.getIndex('num')._unindex._p_activate()
+        tm = transaction.TransactionManager()
+        other = self._open(tm)
+        other.catalog_object(Dummy(1000), '7')
+        tm.commit()
+
+        with patch('Products.ZCatalog.compaction.RETRIES', 0):
+            with self.assertRaises(ConflictError):
+                zcat.compactIndex('num')
+        transaction.abort()
+        zcat = self._open()
+        self.assertEqual([brain.getPath() for brain in zcat(num=1000)],
+                         ['7'])
+
+    def test_transaction_manager(self):
+        # a change pending in the thread's default transaction
+        root = self.db.open().root()
+        root['pending'] = 1
+
+        tm = transaction.TransactionManager()
+        zcat = self._open(tm)
+        before = len(self._transactions())
+        zcat.compactIndex('num')
+        self.assertGreater(len(self._transactions()), before)
+        # the compaction didn't commit the default transaction
+        transaction.abort()
+        self.assertNotIn('pending', self.db.open().root())
+
+    def test_pending_changes(self):
+        from Products.ZCatalog.Catalog import CatalogError
+        zcat = self._open()
+        zcat.catalog_object(Dummy(1000), '7')
+        before = len(self._transactions())
+        with self.assertRaises(CatalogError):
+            zcat.compactIndex('num')
+        with self.assertRaises(CatalogError):
+            zcat.compactCatalog()
+        self.assertEqual(len(self._transactions()), before)
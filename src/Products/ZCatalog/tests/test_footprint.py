@@ -0,0 +1,94 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import unittest
+
+from zope.testing import cleanup
+
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import \
+    DateRangeIndex
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class Dummy:
+
+    def __init__(self, num):
+        self.num = num
+        self.start = num
+        self.end = num + 10
+
+
+class TestFootprint(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.zcat = ZCatalog('catalog')
+        self.zcat.addIndex('num', FieldIndex('num'))
+        self.zcat.addIndex('range', DateRangeIndex('range', 'start', 'end'))
+        self.zcat.addColumn('num')
+        for i in range(500):
+            self.zcat.catalog_object(Dummy(i % 50), str(i))
+
+    def _structures(self, report):
+        return {(index['id'], info['id']): info
+                for index in report['indexes']
+                for info in index['structures']}
+
+    def test_analyze(self):
+        report = self.zcat.analyzeFootprint()
+        self.assertTrue(report['done'])
+        self.assertEqual(report['queued'], 0)
+        structures = self._structures(report)
+
+        index = structures[('num', '_index')]
+        # 50 tree sets of 10 documents plus the tree and its buckets
+        self.assertGreater(index['objects'], 50)
+        self.assertGreater(index['pickle_bytes'], 0)
+        self.assertGreater(index['memory'], 0)
+        self.assertTrue(0 < index['fill'] <= 1)
+
+        unindex = structures[('num', '_unindex')]
+        self.assertGreaterEqual(unindex['buckets'], 5)
+        self.assertIn(('range', '_since'), structures)
+        self.assertIn(('range', '_unindex'), structures)
+
+        data = structures[('catalog', 'data')]
+        self.assertGreaterEqual(data['buckets'], 1)
+        self.assertIn(('catalog', 'uids'), structures)
+        self.assertIn(('catalog', '_length'), structures)
+
+        totals = {index['id']: index for index in report['indexes']}
+        self.assertEqual(
+            totals['num']['objects'],
+            sum(info['objects'] for (name, structure), info
+                in structures.items() if name == 'num'))
+
+    def test_budget(self):
+        self.assertIsNone(self.zcat.getCatalogFootprint())
+        report = self.zcat.analyzeFootprint(budget=0)
+        self.assertFalse(report['done'])
+        self.assertEqual(report['analyzed'], 0)
+        self.assertEqual(self.zcat.getCatalogFootprint(), report)
+
+        report = self.zcat.analyzeFootprint()
+        self.assertTrue(report['done'])
+        analyzed = report['analyzed']
+        # continuing a finished analysis doesn't count objects twice
+        self.assertEqual(self.zcat.analyzeFootprint()['analyzed'], analyzed)
+        report = self.zcat.analyzeFootprint(restart=True)
+        self.assertEqual(report['analyzed'], analyzed)
+
+    def test_manage_analyzeFootprint(self):
+        self.zcat.manage_analyzeFootprint(budget=10)
+        self.assertTrue(self.zcat.getCatalogFootprint()['done'])
@@ -16,6 +16,7 @@ import os.path
 import time
 import unittest
 from _thread import LockType
+from _thread import allocate_lock
 
 from zope.testing import cleanup
 
@@ -26,6 +27,7 @@ from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
 from Products.PluginIndexes.PathIndex.PathIndex import PathIndex
 from Products.PluginIndexes.UUIDIndex.UUIDIndex import UUIDIndex
 from Products.ZCatalog.Catalog import Catalog
+from Products.ZCatalog.Catalog import CatalogError
 from Products.ZCatalog.plan import MAX_DISTINCT_VALUES
 from Products.ZCatalog.ZCatalog import ZCatalog
 
@@ -163,6 +165,59 @@ class TestPriorityMapDefault(unittest.TestCase):
         self.assertEqual(self.pmap.get_value(), expected)
 
 
+class TestBoundedNestedDict(cleanup.CleanUp, unittest.TestCase):
+
+    def _makeOne(self, max_entries=10):
+        from ..plan import BoundedNestedDict
+
+        class Bounded(BoundedNestedDict):
+            lock = allocate_lock()
+            value = {}
+            weights = {}
+            floors = {}
+            evictions = {}
+            pinned = ('pinned', )
+
+        Bounded.max_entries = max_entries
+        return Bounded
+
+    def test_evict_lightest(self):
+        bounded = self._makeOne()
+        bounded.set_entry('cid', 'pinned', 'x')
+        for i in range(9):
+            bounded.set_entry('cid', i, i)
+            bounded.weigh('cid', i, float(i))
+        self.assertEqual(len(bounded.get('cid')), 10)
+        self.assertEqual(bounded.get_evictions('cid'), 0)
+        bounded.set_entry('cid', 9, 9)
+        bounded.weigh('cid', 9, 9.0)
+        # evicted down to 90% of the limit, never the pinned key
+        self.assertEqual(set(bounded.get('cid')),
+                         {'pinned'} | set(range(2, 10)))
+        self.assertEqual(bounded.get_evictions('cid'), 2)
+        self.assertEqual(bounded.get_evictions('other'), 0)
+
+    def test_new_key_inherits_floor(self):
+        bounded = self._makeOne()
+        for i in range(11):
+            bounded.set_entry('cid', i, i)
+            bounded.weigh('cid', i, 5.0)
+        self.assertEqual(bounded.get_evictions('cid'), 2)
+        bounded.set_entry('cid', 'new', None)
+        bounded.weigh('cid', 'new', 0.1)
+        self.assertEqual(bounded.weights['cid']['new'], 5.1)
+
+    def test_clear_entry(self):
+        bounded = self._makeOne(max_entries=1)
+        for i in range(3):
+            bounded.set_entry('cid', i, i)
+            bounded.weigh('cid', i, 1.0)
+        self.assertTrue(bounded.get_evictions('cid'))
+        bounded.clear_entry('cid')
+        self.assertEqual(bounded.get('cid'), {})
+        self.assertEqual(bounded.get_evictions('cid'), 0)
+
+
 class TestReports(unittest.TestCase):
 
     def setUp(self):
@@ -182,6 +237,42 @@ class TestReports(unittest.TestCase):
         self.assertEqual(type(self.reports.lock), LockType)
 
 
+class TestHistogram(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..plan import Histogram
+        return Histogram()
+
+    def test_empty(self):
+        histogram = self._makeOne()
+        self.assertEqual(histogram.percentile(50), 0.0)
+        self.assertEqual(histogram.summary()['count'], 0)
+
+    def test_percentiles(self):
+        histogram = self._makeOne()
+        for i in range(1, 101):
+            histogram.record(i / 1000.0)
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.005)
+        self.assertAlmostEqual(histogram.percentile(99), 0.099, delta=0.01)
+        self.assertEqual(histogram.percentile(100), 0.1)
+        summary = histogram.summary()
+        self.assertEqual(summary['max'], 100.0)
+        self.assertAlmostEqual(summary['mean'], 50.5)
+
+    def test_outlier(self):
+        from ..plan import HISTOGRAM_BUCKETS
+        histogram = self._makeOne()
+        for i in range(1000):
+            histogram.record(0.001)
+        histogram.record(1e6)
+        histogram.record(0)
+        self.assertLessEqual(len(histogram.buckets), 3)
+        self.assertIn(HISTOGRAM_BUCKETS - 1, histogram.buckets)
+        self.assertAlmostEqual(histogram.percentile(99), 0.001, delta=1e-4)
+        self.assertEqual(histogram.summary()['max'], 1e9)
+
+
 class TestCatalogPlan(cleanup.CleanUp, unittest.TestCase):
 
     def assertRegex(self, *args, **kwargs):
@@ -358,7 +449,7 @@ class TestCatalogPlan(cleanup.CleanUp, unittest.TestCase):
     def test_start(self):
         plan = self._makeOne()
         plan.start()
-        self.assertLessEqual(plan.start_time, time.time())
+        self.assertLessEqual(plan.start_time, time.perf_counter_ns())
 
     def test_start_split(self):
         plan = self._makeOne()
@@ -428,6 +519,80 @@ class TestCatalogPlan(cleanup.CleanUp, unittest.TestCase):
         PriorityMap.set_entry(plan.cid, VALUE_INDEX_KEY, indexes)
         self.assertEqual(plan.valueindexes(), frozenset(indexes))
 
+    def test_thresholds_default(self):
+        from ..plan import DEFAULT_THRESHOLDS
+        plan = self._makeOne()
+        self.assertEqual(plan.thresholds(), DEFAULT_THRESHOLDS)
+
+    def test_thresholds_set(self):
+        from ..plan import DEFAULT_THRESHOLDS
+        from ..plan import set_thresholds
+        plan = self._makeOne()
+        set_thresholds(plan.cid, {'or_intersect_max': 50})
+        thresholds = plan.thresholds()
+        self.assertEqual(thresholds['or_intersect_max'], 50)
+        self.assertEqual(thresholds['sort_nbest_factor'],
+                         DEFAULT_THRESHOLDS['sort_nbest_factor'])
+        set_thresholds(plan.cid, None)
+        self.assertEqual(plan.thresholds(), DEFAULT_THRESHOLDS)
+        with self.assertRaises(ValueError):
+            set_thresholds(plan.cid, {'foo': 1})
+
+    def test_thresholds_dump_and_load(self):
+        from ..plan import THRESHOLDS_KEY
+        from ..plan import PriorityMap
+        from ..plan import set_thresholds
+        zcat = ZCatalog('catalog')
+        plan = self._makeOne(zcat._catalog)
+        set_thresholds(plan.cid, {'sort_index_ratio': 42})
+        _locals = {}
+        exec(zcat.getCatalogPlan(), {}, _locals)
+        PriorityMap.clear()
+        PriorityMap.load_pmap('dump', _locals['queryplan'])
+        self.assertEqual(PriorityMap.get_entry(plan.cid, THRESHOLDS_KEY),
+                         {'sort_index_ratio': 42})
+        self.assertEqual(zcat.getCatalogThresholds()[1],
+                         ('sort_index_ratio', 42))
+
+    def test_strategy_report(self):
+        plan = self._makeOne(query={'index1': 1})
+        plan.threshold = 0.0
+        plan.start()
+        plan.strategy('sort_on', 'sort_nbest')
+        plan.stop()
+        report = plan.report()
+        self.assertEqual(report[0]['last']['strategies'],
+                         {'sort_on': 'sort_nbest'})
+
+    def test_sample(self):
+        from ..plan import PriorityMap
+        plan = self._makeOne(query={'index1': 1})
+        plan.sample_rate = 1000
+        # queries without a plan are always measured
+        plan.start()
+        self.assertTrue(plan.sampled)
+        plan.stop()
+        self.assertEqual(PriorityMap.get_entry(plan.cid, plan.key)[
+            'index1'].hits, 0)
+        sampled = 0
+        for i in range(1000):
+            plan.start()
+            plan.start_split('index1')
+            plan.stop_split('index1')
+            plan.stop()
+            sampled += plan.sampled
+        self.assertEqual(sampled, 1)
+        self.assertEqual(plan.weight, 1000)
+        self.assertEqual(PriorityMap.get_entry(plan.cid, plan.key)[
+            'index1'].hits, 1)
+        latency = plan.latency_report()['queries'][0]
+        self.assertEqual(latency['count'], 1001)
+
+    def test_querykey_to_index_lazy(self):
+        plan = self._makeOne(query={'index1': 1})
+        self.assertIsNone(plan._querykey_to_index)
+        self.assertEqual(plan.querykey_to_index, {})
+
     # Test the actual logic for determining value indexes
     # Test make_key
 
@@ -516,6 +681,179 @@ class TestCatalogReport(cleanup.CleanUp, unittest.TestCase):
         r = self.zcat.getCatalogReport()[0]
         self.assertEqual(r['counter'], 3)
 
+    def test_ReportSampled(self):
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.manage_editCatalogReport(
+            long_query_time=0.0, query_sample_rate=3)
+        for i in range(9):
+            self.zcat.searchResults(numbers=i, sort_on='num')
+        r = self.zcat.getCatalogReport()[0]
+        # the first query is measured to build the plan, then one in three,
+        # each counting as three queries
+        self.assertIn(r['counter'], (7, 10))
+        self.assertEqual(r['latency']['count'], r['counter'])
+        latencies = self.zcat.getCatalogLatencies()
+        self.assertEqual(latencies['queries'][0]['count'], r['counter'])
+        with self.assertRaises(ValueError):
+            self.zcat.manage_editCatalogReport(query_sample_rate=0)
+
+    def test_ReportProfiles(self):
+        import marshal
+
+        from ..plan import PROFILES_PER_KEY
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.searchResults(numbers=1, sort_on='num')
+        self.assertEqual(self.zcat.getCatalogProfiles(), [])
+
+        self.zcat.manage_editCatalogReport(
+            long_query_time=0.0, profile_rate=1.0)
+        for i in range(PROFILES_PER_KEY + 2):
+            self.zcat.searchResults(numbers=i, sort_on='num')
+        profiles = self.zcat.getCatalogProfiles()
+        self.assertEqual(len(profiles), PROFILES_PER_KEY)
+        self.assertEqual(profiles[0]['query'], ('numbers', 'sort_on'))
+        # profiled queries don't update the report
+        self.assertEqual(self.zcat.getCatalogReport()[0]['counter'], 1)
+
+        stats = marshal.loads(
+            self.zcat.manage_downloadCatalogProfile(profiles[0]['id']))
+        self.assertIn('sortResults', {func[2] for func in stats})
+        with self.assertRaises(KeyError):
+            self.zcat.manage_downloadCatalogProfile(0)
+        with self.assertRaises(ValueError):
+            self.zcat.manage_editCatalogReport(profile_rate=2.0)
+
+        self.zcat.manage_resetCatalogReport()
+        self.assertEqual(self.zcat.getCatalogProfiles(), [])
+
+    def test_ReportProfileNewKeys(self):
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.manage_editCatalogReport(
+            long_query_time=10.0, profile_rate=1.0)
+        self.zcat.searchResults(numbers=1)
+        self.zcat.searchResults(numbers=1, sort_on='num')
+        # keys without a report don't get an empty one
+        self.assertEqual(self.zcat.getCatalogReport(), [])
+        self.assertEqual(self.zcat.getCatalogProfiles(), [])
+
+    def test_ReportProfileAbort(self):
+        import sys
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.searchResults(numbers=1)
+        self.zcat.profile_rate = 1.0
+        with self.assertRaises(CatalogError):
+            self.zcat.searchResults(numbers=1, sort_on='foo')
+        self.assertIsNone(sys.getprofile())
+
+    def test_ReportLatency(self):
+        self.zcat.manage_resetCatalogReport()
+        for i in range(5):
+            self.zcat.searchResults(numbers=i, sort_on='num')
+        r = self.zcat.getCatalogReport()[0]
+        self.assertEqual(r['latency']['count'], 5)
+        self.assertLessEqual(r['latency']['p50'], r['latency']['max'])
+
+        latencies = self.zcat.getCatalogLatencies()
+        self.assertEqual(
+            [info['query'] for info in latencies['queries']],
+            [('numbers', 'sort_on')])
+        self.assertEqual(
+            {info['id'] for info in latencies['indexes']},
+            {'numbers', 'numbers#intersection', 'sort_on#num#asc'})
+        self.assertEqual(len(latencies['slowest']), 5)
+        durations = [info['duration'] for info in latencies['slowest']]
+        self.assertEqual(durations, sorted(durations, reverse=True))
+
+        self.zcat.manage_resetCatalogReport()
+        latencies = self.zcat.getCatalogLatencies()
+        self.assertEqual(latencies['slowest'], [])
+        self.assertEqual(latencies['queries'], [])
+
+    def test_ReportSlowestBounded(self):
+        from ..plan import SLOWEST_QUERIES
+        self.zcat.long_query_time = 10.0
+        self.zcat.manage_resetCatalogReport()
+        for i in range(SLOWEST_QUERIES + 5):
+            self.zcat.searchResults(numbers=i)
+        self.assertEqual(self.zcat.getCatalogReport(), [])
+        latencies = self.zcat.getCatalogLatencies()
+        self.assertEqual(len(latencies['slowest']), SLOWEST_QUERIES)
+        self.assertEqual(latencies['queries'][0]['count'],
+                         SLOWEST_QUERIES + 5)
+
+    def test_ReportExport(self):
+        import json
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.searchResults(numbers=4, sort_on='num')
+        data = json.loads(self.zcat.manage_exportCatalogReport())
+        self.assertEqual(data['queries'][0]['query'], ['numbers', 'sort_on'])
+        text = self.zcat.manage_exportCatalogReport(export_format='text')
+        self.assertIn('# TYPE zcatalog_query_duration_seconds summary', text)
+        self.assertIn(
+            'zcatalog_query_duration_seconds_count{catalog="catalog",'
+            'query="(\'numbers\', \'sort_on\')"} 1', text)
+        self.assertIn(
+            'zcatalog_index_duration_seconds{catalog="catalog",'
+            'index="numbers",quantile="0.99"}', text)
+        with self.assertRaises(ValueError):
+            self.zcat.manage_exportCatalogReport('xml')
+
+    def test_ReportEvictions(self):
+        from ..plan import PriorityMap
+        from ..plan import Reports
+        self.zcat.manage_resetCatalogReport()
+        old = (PriorityMap.max_entries, Reports.max_entries)
+        PriorityMap.max_entries = Reports.max_entries = 3
+        try:
+            for i in range(6):
+                self.zcat.searchResults(num=i, sort_on='num')
+        finally:
+            PriorityMap.max_entries, Reports.max_entries = old
+        self.assertLessEqual(len(self.zcat.getCatalogReport()), 3)
+        evictions = self.zcat.getCatalogEvictions()
+        self.assertGreater(evictions['report'], 0)
+        self.assertGreater(evictions['plan'], 0)
+        self.assertEqual(evictions['latency'], 0)
+
+    def test_ReportStrategies(self):
+        from ..plan import set_thresholds
+        self.zcat.manage_resetCatalogReport()
+        self.zcat.searchResults(big=False, sort_on='num', sort_limit=2)
+        r = self.zcat.getCatalogReport()[0]
+        self.assertEqual(r['last']['strategies'],
+                         {'sort_on': 'sort_iterate_resultset'})
+
+        set_thresholds(('catalog', ), {'sort_nbest_factor': 1})
+        self.zcat.manage_resetCatalogReport()
+        result = self.zcat.searchResults(
+            big=False, sort_on='num', sort_limit=2)
+        self.assertEqual([b.getPath() for b in result], ['0', '1'])
+        r = self.zcat.getCatalogReport()[0]
+        self.assertEqual(r['last']['strategies'],
+                         {'sort_on': 'sort_nbest_reverse'})
+
+    def test_ReportOrStrategies(self):
+        from unittest.mock import patch
+
+        from ..plan import set_thresholds
+        query = {'big': False, 'num': {'query': [1, 2, 3]},
+                 'sort_on': 'num'}
+        # the thresholds are resolved by the plan, not per index query
+        with patch.object(FieldIndex, 'getThreshold',
+                          side_effect=AssertionError):
+            self.zcat.manage_resetCatalogReport()
+            self.zcat.searchResults(query)
+            r = self.zcat.getCatalogReport()[0]
+            strategies = r['last']['strategies']
+            self.assertEqual(strategies['num#or'], 'intersect')
+
+            set_thresholds(('catalog', ), {'or_intersect_max': 1})
+            self.zcat.manage_resetCatalogReport()
+            result = self.zcat.searchResults(query)
+            self.assertEqual([b.getPath() for b in result], ['1', '2', '3'])
+            r = self.zcat.getCatalogReport()[0]
+            self.assertEqual(r['last']['strategies']['num#or'], 'union')
+
     def test_ReportKey(self):
         """ tests the query keys for uniqueness """
         # query key 1
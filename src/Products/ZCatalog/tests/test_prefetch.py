@@ -0,0 +1,118 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import unittest
+
+import transaction
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from zope.testing import cleanup
+
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.PluginIndexes.KeywordIndex.KeywordIndex import KeywordIndex
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class PrefetchStorage(MappingStorage):
+
+    def __init__(self):
+        super().__init__()
+        self.prefetched = []
+
+    def prefetch(self, oids, tid):
+        self.prefetched.append(list(oids))
+
+
+class Dummy:
+
+    def __init__(self, num):
+        self.num = num
+        self.tags = ['tag%d' % (num % 7), 'all']
+
+
+class TestPrefetch(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.storage = PrefetchStorage()
+        self.db = DB(self.storage)
+        conn = self.db.open()
+        root = conn.root()
+        zcat = root['catalog'] = ZCatalog('catalog')
+        zcat.addIndex('num', FieldIndex('num'))
+        zcat.addIndex('tags', KeywordIndex('tags'))
+        for i in range(3000):
+            zcat.catalog_object(Dummy(i % 500), str(i))
+        transaction.commit()
+        conn.close()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+        cleanup.CleanUp.tearDown(self)
+
+    def _open(self, prefetch):
+        conn = self.db.open()
+        conn.cacheMinimize()
+        zcat = conn.root()['catalog']
+        zcat.query_prefetch = prefetch
+        self.storage.prefetched = []
+        return zcat
+
+    def _search(self, zcat):
+        return [brain.getRID()
+                for brain in zcat(num=[3, 250, 499], tags='tag3')]
+
+    def test_prefetch_query(self):
+        from Products.ZCatalog.prefetch import prefetch_query
+        zcat = self._open(False)
+        catalog = zcat._catalog
+        count = prefetch_query(
+            catalog, ['num', 'tags'],
+            catalog.make_query({'num': [3, 250, 499], 'tags': 'tag3'}))
+        prefetched = sum(self.storage.prefetched, [])
+        self.assertEqual(count, len(prefetched))
+        self.assertEqual(len(set(prefetched)), len(prefetched))
+
+        index = catalog.getIndex('num')
+        # the rows of the keys are prefetched, others are not
+        self.assertIn(index._index[250]._p_oid, prefetched)
+        self.assertNotIn(index._index[251]._p_oid, prefetched)
+        # the nodes are walked down in batches, one per level
+        self.assertGreater(len(self.storage.prefetched), 2)
+        self.assertLess(len(self.storage.prefetched), 8)
+
+    def test_search(self):
+        expected = self._search(self._open(False))
+        self.assertEqual(self.storage.prefetched, [])
+        self.assertEqual(self._search(self._open(True)), expected)
+        self.assertTrue(self.storage.prefetched)
+
+    def test_range_query(self):
+        from Products.ZCatalog.prefetch import prefetch_query
+        zcat = self._open(False)
+        catalog = zcat._catalog
+        query = catalog.make_query(
+            {'num': {'query': (3, 250), 'range': 'min:max'}})
+        prefetch_query(catalog, ['num'], query)
+        prefetched = sum(self.storage.prefetched, [])
+        self.assertNotIn(catalog.getIndex('num')._index[3]._p_oid,
+                         prefetched)
+
+    def test_unstored(self):
+        from Products.ZCatalog.prefetch import prefetch_query
+        zcat = ZCatalog('catalog')
+        zcat.addIndex('num', FieldIndex('num'))
+        zcat.catalog_object(Dummy(1), '1')
+        self.assertEqual(
+            prefetch_query(zcat._catalog, ['num'], {'num': 1}), 0)
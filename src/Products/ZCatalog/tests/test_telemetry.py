@@ -0,0 +1,120 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import unittest
+
+from zope.testing import cleanup
+
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class Dummy:
+
+    def __init__(self, num):
+        self.num = num
+
+    def title(self):
+        return 'Dummy %d' % self.num
+
+
+class TestIndexingStats(unittest.TestCase):
+
+    def _makeOne(self):
+        from ..telemetry import IndexingStats
+        return IndexingStats()
+
+    def test_empty(self):
+        summary = self._makeOne().summary()
+        self.assertEqual(summary['count'], 0)
+        self.assertEqual(summary['mean'], 0)
+        self.assertEqual(summary['modified_per_transaction'], 0)
+
+    def test_record(self):
+        stats = self._makeOne()
+        stats.record(0.002, 'new', 3)
+        stats.record(0.004, 'unchanged', 0)
+        stats.record_transaction(3)
+        stats.record_transaction(1)
+        summary = stats.summary()
+        self.assertEqual(summary['count'], 2)
+        self.assertAlmostEqual(summary['duration'], 6.0)
+        self.assertAlmostEqual(summary['mean'], 3.0)
+        self.assertAlmostEqual(summary['max'], 4.0)
+        self.assertEqual(summary['new'], 1)
+        self.assertEqual(summary['unchanged'], 1)
+        self.assertEqual(summary['changed'], 0)
+        self.assertEqual(summary['modified'], 3)
+        self.assertEqual(summary['transactions'], 2)
+        self.assertEqual(summary['modified_per_transaction'], 2)
+        self.assertEqual(summary['max_modified_per_transaction'], 3)
+
+
+class TestIndexingTelemetry(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.zcat = ZCatalog('catalog')
+        self.zcat.addIndex('num', FieldIndex('num'))
+        self.zcat.addColumn('title')
+
+    def _report(self):
+        return {(info['kind'], info['id']): info
+                for info in self.zcat.getIndexingReport()}
+
+    def test_disabled(self):
+        self.assertIsNone(self.zcat._catalog.getIndexingTelemetry())
+        self.zcat.catalog_object(Dummy(1), '1')
+        self.assertEqual(self.zcat.getIndexingReport(), [])
+
+    def test_catalog_object(self):
+        self.zcat.manage_editIndexingReport(indexing_telemetry=True)
+        obj = Dummy(1)
+        self.zcat.catalog_object(obj, '1')
+        self.zcat.catalog_object(obj, '1')
+        obj.num = 2
+        self.zcat.catalog_object(obj, '1')
+
+        report = self._report()
+        index = report[('index', 'num')]
+        self.assertEqual(index['count'], 3)
+        self.assertEqual(
+            (index['new'], index['changed'], index['unchanged']), (1, 1, 1))
+        # no connection, so no objects are counted
+        self.assertEqual(index['modified'], 0)
+        self.assertEqual(index['transactions'], 0)
+
+        record = report[('metadata', 'record')]
+        self.assertEqual(
+            (record['new'], record['changed'], record['unchanged']),
+            (1, 1, 1))
+        self.assertEqual(report[('column', 'title')]['count'], 3)
+
+        self.zcat.catalog_object(obj, '1', update_metadata=False)
+        self.assertEqual(self._report()[('metadata', 'record')]['count'], 3)
+
+    def test_uncatalog_object(self):
+        self.zcat.manage_editIndexingReport(indexing_telemetry=True)
+        self.zcat.catalog_object(Dummy(1), '1')
+        self.zcat.uncatalog_object('1')
+        self.zcat.uncatalog_object('1')
+        self.assertEqual(self._report()[('unindex', 'num')]['count'], 1)
+
+    def test_reset(self):
+        self.zcat.manage_editIndexingReport(indexing_telemetry=True)
+        self.zcat.catalog_object(Dummy(1), '1')
+        self.assertTrue(self.zcat.getIndexingReport())
+        self.zcat.manage_resetIndexingReport()
+        self.assertEqual(self.zcat.getIndexingReport(), [])
+        self.zcat.manage_editIndexingReport()
+        self.assertFalse(self.zcat.indexing_telemetry)
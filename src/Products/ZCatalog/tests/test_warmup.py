@@ -0,0 +1,133 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+
+import os
+import unittest
+
+import transaction
+from OFS.Application import Application
+from ZODB.DB import DB
+from ZODB.MappingStorage import MappingStorage
+from zope.processlifetime import DatabaseOpenedWithRoot
+from zope.testing import cleanup
+
+from Products.PluginIndexes.FieldIndex.FieldIndex import FieldIndex
+from Products.ZCatalog.plan import Benchmark
+from Products.ZCatalog.plan import PriorityMap
+from Products.ZCatalog.plan import catalog_id
+from Products.ZCatalog.ZCatalog import ZCatalog
+
+
+class Dummy:
+
+    def __init__(self, num):
+        self.num = num
+        self.kind = 'kind%d' % (num % 3)
+
+
+class TestWarmup(cleanup.CleanUp, unittest.TestCase):
+
+    def setUp(self):
+        cleanup.CleanUp.setUp(self)
+        self.db = DB(MappingStorage())
+        conn = self.db.open()
+        app = conn.root()['Application'] = Application()
+        app._setObject('catalog', ZCatalog('catalog'))
+        zcat = app.catalog
+        zcat.addIndex('num', FieldIndex('num'))
+        zcat.addIndex('kind', FieldIndex('kind'))
+        zcat.addColumn('num')
+        for i in range(3000):
+            zcat.catalog_object(Dummy(i % 600), str(i))
+        transaction.commit()
+        self.cid = catalog_id(zcat._catalog)
+        self.oid = zcat._catalog._p_oid
+        PriorityMap.set(self.cid, {
+            ('num', ('kind', "'kind1'")): {
+                'num': Benchmark(0.002, 10, False),
+                'kind': Benchmark(0.001, 10, False),
+                'kind#intersection': Benchmark(0.001, 10, False),
+            },
+            (('kind', "{'query': ['kind2', 'kind0']}"), ): {
+                'kind': Benchmark(0.001, 3, False),
+            },
+            ('num', ): {
+                'num': Benchmark(0.001, 5, False),
+            },
+        })
+        conn.cacheMinimize()
+        conn.close()
+
+    def tearDown(self):
+        transaction.abort()
+        self.db.close()
+        os.environ.pop('ZCATALOGWARMUP', None)
+        cleanup.CleanUp.tearDown(self)
+
+    def _index(self, conn, name):
+        return conn.get(self.oid).indexes[name]
+
+    def test_warmup_plan(self):
+        from Products.ZCatalog.warmup import warmup_plan
+        values, indexes = warmup_plan(self.cid)
+        self.assertEqual(values, [('kind', 'kind1'), ('kind', 'kind2'),
+                                  ('kind', 'kind0')])
+        self.assertEqual(indexes, ['num', 'kind'])
+        self.assertEqual(warmup_plan(('', 'missing')), ([], []))
+
+    def test_run(self):
+        from Products.ZCatalog.warmup import CatalogWarmup
+        warmup = CatalogWarmup(self.db, self.oid, self.cid, budget=10)
+        self.assertGreater(warmup.run(), 0)
+        # the warm connection is handed out next
+        conn = self.db.open()
+        index = self._index(conn, 'kind')
+        self.assertIsNotNone(index._index['kind1']._p_changed)
+        self.assertIsNone(index._unindex._p_changed)
+        conn.close()
+
+    def test_budget(self):
+        from Products.ZCatalog.warmup import CatalogWarmup
+        warmup = CatalogWarmup(self.db, self.oid, self.cid, budget=10,
+                               max_objects=0)
+        self.assertEqual(warmup.run(), 0)
+        warmup = CatalogWarmup(self.db, self.oid, self.cid, budget=0)
+        self.assertEqual(warmup.run(), 0)
+
+    def test_progress(self):
+        from Products.ZCatalog.ProgressHandler import StdoutHandler
+        from Products.ZCatalog.warmup import CatalogWarmup
+
+        class Handler(StdoutHandler):
+
+            def output(self, text):
+                self.messages.append(text)
+
+        handler = Handler(1)
+        handler.messages = []
+        CatalogWarmup(self.db, self.oid, self.cid, budget=10,
+                      pghandler=handler).run()
+        self.assertIn('(6 objects to go)', handler.messages[0])
+        self.assertIn('Process terminated', handler.messages[-1])
+
+    def test_warmup_on_start(self):
+        from Products.ZCatalog.warmup import warmup_on_start
+        event = DatabaseOpenedWithRoot(self.db)
+        self.assertEqual(warmup_on_start(event), [])
+
+        os.environ['ZCATALOGWARMUP'] = '10'
+        threads = warmup_on_start(event)
+        self.assertEqual(len(threads), 1)
+        threads[0].join(10)
+        self.assertFalse(threads[0].is_alive())
+        self.assertGreater(threads[0].warmup.loaded, 0)
@@ -310,6 +310,23 @@ class TestZCatalog(ZCatalogBase, unittest.TestCase):
         sr = self._catalog.search(query)
         self.assertEqual(len(sr), 9)
 
+    def testExplain(self):
+        catalog = makerequest(self._catalog)
+        catalog.getPhysicalPath = None
+        query = "{'title': ['5', '6', '7'], 'sort_on': 'title'}"
+        explained = catalog.getCatalogExplain(query)
+        step = explained['steps'][0]
+        self.assertEqual((step['cached'], step['output']), (False, 3))
+        self.assertEqual(explained['sort']['strategy'],
+                         'sort_iterate_resultset')
+        catalog.search({'title': ['5', '6', '7']})
+        explained = catalog.getCatalogExplain(query, analyze=True)
+        self.assertTrue(explained['steps'][0]['cached'])
+        self.assertIn('duration', explained)
+        for query in ('', "['title']", 'foo('):
+            with self.assertRaises(ValueError):
+                catalog.getCatalogExplain(query)
+
     # resolve_url
     # resolve_path
     # manage_setProgress
@@ -126,3 +126,145 @@ class TestPersistentZCatalog(unittest.TestCase):
         # ZODB connection cache stays within its size limit
         actual_size = self._actual_cache_size(catalog)
         self.assertLessEqual(actual_size, cache_size_limit + threshold)
+
+    def test_load_accounting(self):
+        catalog = self.layer.app.Catalog
+        catalog.long_query_time = 0.0
+        catalog.manage_resetCatalogReport()
+        catalog.manage_editCatalogReport(0.0, load_accounting=True)
+        try:
+            catalog._p_jar.cacheMinimize()
+            catalog(meta_type='Folder', sort_on='meta_type', sort_limit=5)
+            report = catalog.getCatalogReport()[0]
+            loads = report['last']['loads']
+            self.assertGreater(loads['loaded'], 0)
+            self.assertGreater(loads['activated'], 0)
+            details = {d['id']: d['loads'] for d in report['last']['details']}
+            self.assertGreater(details['meta_type']['loaded'], 0)
+            self.assertIn('sort_on#meta_type#asc#limit-5', details)
+        finally:
+            catalog.manage_editCatalogReport(0.1, load_accounting=False)
+            catalog.manage_resetCatalogReport()
+
+        catalog(meta_type='Folder')
+        self.assertIsNone(
+            catalog.getCatalogLatencies()['slowest'][0]['loads'])
+
+    def test_indexing_telemetry(self):
+        from ..telemetry import IndexingReports
+        catalog = self.layer.app.Catalog
+        catalog.manage_editIndexingReport(indexing_telemetry=True)
+        try:
+            transaction.savepoint()
+            obj = self.layer._make_dummy()
+            catalog.catalog_object(obj, uid=obj.id)
+            catalog.uncatalog_object(obj.id)
+            report = {(info['kind'], info['id']): info
+                      for info in catalog.getIndexingReport()}
+            index = report[('index', 'meta_type')]
+            self.assertEqual(index['new'], 1)
+            self.assertGreater(index['modified'], 0)
+            self.assertIn(('unindex', 'meta_type'), report)
+            self.assertEqual(index['transactions'], 0)
+
+            # the transaction counts are recorded on commit
+            txn = transaction.get()
+            for hook, args, kws in txn.getBeforeCommitHooks():
+                if hook == IndexingReports.record_transaction:
+                    hook(*args, **kws)
+            index = [info for info in catalog.getIndexingReport()
+                     if info['kind'] == 'index'][0]
+            self.assertEqual(index['transactions'], 1)
+            # the layer's transaction is shared with the other tests
+            self.assertGreaterEqual(index['modified_per_transaction'],
+                                    index['modified'])
+        finally:
+            catalog.manage_editIndexingReport(indexing_telemetry=False)
+            catalog.manage_resetIndexingReport()
+
+    def test_conflict_hotspots(self):
+        from ZODB.POSException import ConflictError
+
+        from ..telemetry import Hotspots
+        catalog = self.layer.app.Catalog
+        catalog.manage_editIndexingReport(conflict_diagnostics=True)
+        try:
+            transaction.savepoint()
+            obj = self.layer._make_dummy()
+            catalog.catalog_object(obj, uid=obj.id)
+            txn = transaction.get()
+            hooks = [(hook, args) for hook, args, kws
+                     in txn.getAfterCommitHooks()
+                     if hook == Hotspots.record_transaction]
+            self.assertEqual(len(hooks), 1)
+            hook, (writes, ) = hooks[0]
+            names = {(name, structure) for cid, name, structure, oid
+                     in writes}
+            self.assertIn(('catalog', '_length'), names)
+            self.assertIn(('meta_type', '_counter'), names)
+
+            hook(True, writes)
+            conflict = [oid for cid, name, structure, oid in writes
+                        if name == 'catalog' and structure == '_length'][0]
+            try:
+                raise ConflictError(oid=conflict)
+            except ConflictError:
+                hook(False, writes)
+
+            report = catalog.getConflictHotspots()
+            self.assertEqual(report['transactions'], 2)
+            self.assertEqual(report['conflicts'], 1)
+            top = report['indexes'][0]
+            self.assertEqual(top['id'], 'catalog')
+            self.assertEqual(top['conflicts'], 1)
+            self.assertEqual(top['hotspots'][0]['structure'], '_length')
+            self.assertEqual(top['hotspots'][0]['writes'], 2)
+        finally:
+            catalog.manage_editIndexingReport()
+            catalog.manage_resetIndexingReport()
+        self.assertEqual(catalog.getConflictHotspots()['indexes'], [])
+
+    def test_conflict_hotspots_report_keys(self):
+        catalog = self.layer.app.Catalog
+        catalog.manage_editIndexingReport(
+            indexing_telemetry=True, conflict_diagnostics=True)
+        try:
+            transaction.savepoint()
+            obj = self.layer._make_dummy()
+            catalog.catalog_object(obj, uid=obj.id)
+            keys = {(info['kind'], info['id'])
+                    for info in catalog.getIndexingReport()}
+            self.assertIn(('metadata', 'record'), keys)
+            self.assertIn(('catalog', 'uids'), keys)
+            self.assertIn(('index', 'meta_type'), keys)
+            self.assertNotIn(('metadata', 'catalog'), keys)
+            self.assertNotIn(('catalog', 'catalog'), keys)
+        finally:
+            catalog.manage_editIndexingReport()
+            catalog.manage_resetIndexingReport()
+
+    def test_footprint(self):
+        catalog = self.layer.app.Catalog
+        catalog._p_jar.cacheMinimize()
+        before = self._actual_cache_size(catalog)
+        report = catalog.analyzeFootprint(restart=True)
+        self.assertTrue(report['done'])
+        structures = {(index['id'], info['id']): info
+                      for index in report['indexes']
+                      for info in index['structures']}
+        self.assertGreater(structures[('meta_type', '_unindex')]['buckets'],
+                           1)
+        self.assertGreater(structures[('catalog', 'data')]['pickle_bytes'], 0)
+        # the analyzed objects are turned into ghosts again
+        self.assertLess(self._actual_cache_size(catalog),
+                        before + report['analyzed'] // 2)
+
+    def test_compact_index(self):
+        from ..Catalog import CatalogError
+        catalog = self.layer.app.Catalog
+        # the layer's changes aren't committed, compacting would commit
+        # them along with the first structure
+        with self.assertRaises(CatalogError):
+            catalog.compactIndex('meta_type')
+        with self.assertRaises(CatalogError):
+            catalog.compactCatalog()
@@ -0,0 +1,252 @@
+##############################################################################
+#
+# Copyright (c) 2010 Zope Foundation and Contributors.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Load the hot parts of a catalog into the caches after a restart.
+
+`warmup_plan` ranks the indexes of a catalog by the query time the query
+plan attributes to them and the values of the indexes whose values are
+part of the query keys by the number of queries for them.  `CatalogWarmup`
+loads, within a time and an object budget, the rows of the hottest
+values, the buckets of the forward index of the hottest indexes and then
+the metadata records.
+
+The loading happens in a thread with its own connection.  It warms the
+storage caches shared by all connections, like the ZEO client cache, and
+the cache of the connection, which goes back to the pool of the database
+for the next request.
+
+Setting the ZCATALOGWARMUP environment variable to a number of seconds
+starts a warmup of every catalog of the query plan loaded from
+ZCATALOGQUERYPLAN when the database is opened.
+"""
+
+import logging
+import threading
+import time
+from ast import literal_eval
+from os import environ
+
+import transaction
+from persistent import Persistent
+
+from Products.ZCatalog.footprint import _is_btrees
+from Products.ZCatalog.plan import THRESHOLDS_KEY
+from Products.ZCatalog.plan import VALUE_INDEX_KEY
+from Products.ZCatalog.plan import PriorityMap
+from Products.ZCatalog.ProgressHandler import ZLogHandler
+
+
+logger = logging.getLogger('Zope.ZCatalog')
+
+# Seconds a warmup may take by default.
+BUDGET = 60.0
+
+
+def _query_values(value):
+    # Return the values of a query part as stored in a query key.
+    if isinstance(value, dict):
+        value = value.get('query')
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def warmup_plan(cid):
+    """Return the (index name, value) pairs of the query keys of the plan
+    of a catalog, the most queried first, and the index names, the most
+    expensive first."""
+    plan = PriorityMap.get_value().get(cid) or {}
+    index_weights = {}
+    value_weights = {}
+    for key, benchmarks in plan.items():
+        if key in (VALUE_INDEX_KEY, THRESHOLDS_KEY) or not key:
+            continue
+        hits = 0
+        for name, benchmark in benchmarks.items():
+            if '#' in name:
+                continue
+            hits = max(hits, benchmark.hits)
+            index_weights[name] = (index_weights.get(name, 0.0)
+                                   + benchmark.hits * benchmark.duration)
+        for part in key:
+            if not isinstance(part, tuple) or part[1] == 'not':
+                continue
+            try:
+                values = _query_values(literal_eval(part[1]))
+            except (ValueError, SyntaxError):
+                continue
+            for value in values:
+                try:
+                    item = (part[0], value)
+                    value_weights[item] = value_weights.get(item, 0) + hits
+                except TypeError:
+                    # unhashable values
+                    continue
+    values = sorted(value_weights, key=value_weights.get, reverse=True)
+    indexes = sorted(index_weights, key=index_weights.get, reverse=True)
+    return values, indexes
+
+
+def _buckets(tree):
+    # Iterate over the buckets of a BTree or TreeSet, loading them.
+    state = tree.__getstate__()
+    if state is None or len(state) == 1:
+        return
+    bucket = state[1]
+    while bucket is not None:
+        yield bucket
+        state = bucket.__getstate__()
+        bucket = state[1] if len(state) > 1 else None
+
+
+def _is_tree(obj):
+    return _is_btrees(obj) and hasattr(type(obj), '_bucket_type')
+
+
+class CatalogWarmup:
+    """Load the hot rows and structures of a catalog in a connection of
+    its own within `budget` seconds and until the cache of the connection
+    holds `max_objects` objects, by default the cache size of the
+    database.
+    """
+
+    def __init__(self, db, oid, cid, budget=BUDGET, max_objects=None,
+                 pghandler=None):
+        self.db = db
+        self.oid = oid
+        self.cid = cid
+        self.budget = budget
+        if max_objects is None:
+            max_objects = db.getCacheSize()
+        self.max_objects = max_objects
+        self.pghandler = pghandler
+        self.loaded = 0
+        self.deadline = None
+        self.cache = None
+
+    def exhausted(self):
+        return (time.time() >= self.deadline
+                or self.cache.cache_non_ghost_count >= self.max_objects)
+
+    def run(self):
+        """Warm up, returns the number of objects loaded."""
+        tm = transaction.TransactionManager()
+        conn = self.db.open(transaction_manager=tm)
+        try:
+            self.deadline = time.time() + self.budget
+            self.cache = conn._cache
+            before = self.cache.cache_non_ghost_count
+            self._warmup(conn.get(self.oid))
+            self.loaded = self.cache.cache_non_ghost_count - before
+        finally:
+            tm.abort()
+            conn.close()
+        return self.loaded
+
+    def _warmup(self, catalog):
+        values, indexes = warmup_plan(self.cid)
+        steps = [('row', item) for item in values]
+        steps.extend(('index', name) for name in indexes)
+        steps.append(('metadata', None))
+        pghandler = self.pghandler
+        if pghandler:
+            pghandler.init('Warming up catalog %s' % '/'.join(self.cid),
+                           len(steps))
+        for i, (kind, arg) in enumerate(steps):
+            if self.exhausted():
+                if pghandler:
+                    pghandler.info('Warmup budget exhausted')
+                break
+            if pghandler:
+                pghandler.report(i)
+            try:
+                if kind == 'row':
+                    self._load_row(catalog, *arg)
+                elif kind == 'index':
+                    self._load_index(catalog, arg)
+                else:
+                    self._load_tree(getattr(catalog, 'data', None))
+            except Exception:
+                logger.warning('Warming up %s %r failed', kind, arg,
+                               exc_info=True)
+        if pghandler:
+            pghandler.finish()
+
+    def _load_tree(self, tree):
+        if not _is_tree(tree):
+            return
+        # loading a bucket reads the reference to the next one
+        for bucket in _buckets(tree):
+            if self.exhausted():
+                break
+
+    def _load_row(self, catalog, name, value):
+        index = catalog.indexes.get(name)
+        tree = getattr(index, '_index', None)
+        if not _is_tree(tree):
+            return
+        convert = getattr(index, '_convert', None)
+        if convert is not None:
+            value = convert(value)
+        row = tree.get(value)
+        if isinstance(row, Persistent):
+            row._p_activate()
+            self._load_tree(row)
+
+    def _load_index(self, catalog, name):
+        index = catalog.indexes.get(name)
+        self._load_tree(getattr(index, '_index', None))
+
+
+def start_warmup(db, oid, cid, budget=BUDGET, max_objects=None,
+                 pghandler=None):
+    """Warm up a catalog in a daemon thread and return the thread."""
+    warmup = CatalogWarmup(db, oid, cid, budget, max_objects, pghandler)
+    thread = threading.Thread(target=warmup.run, daemon=True,
+                              name='ZCatalog warmup %s' % '/'.join(cid))
+    thread.warmup = warmup
+    thread.start()
+    return thread
+
+
+def warmup_on_start(event):
+    """Subscriber warming up the catalogs of the query plan when the
+    database is opened if ZCATALOGWARMUP is set."""
+    budget = environ.get('ZCATALOGWARMUP')
+    if not budget:
+        return []
+    try:
+        budget = float(budget)
+    except ValueError:
+        logger.warning('invalid ZCATALOGWARMUP budget %r', budget)
+        return []
+
+    db = event.database
+    targets = []
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    try:
+        app = conn.root().get('Application')
+        for cid in list(PriorityMap.get_value()):
+            zcatalog = None
+            if app is not None:
+                zcatalog = app.unrestrictedTraverse('/'.join(cid), None)
+            catalog = getattr(zcatalog, '_catalog', None)
+            if getattr(catalog, '_p_oid', None) is None:
+                continue
+            targets.append((catalog._p_oid, cid))
+    finally:
+        tm.abort()
+        conn.close()
+
+    return [start_warmup(db, oid, cid, budget, pghandler=ZLogHandler())
+            for oid, cid in targets]